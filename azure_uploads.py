@@ -0,0 +1,336 @@
+# azure_uploads.py
+##
+## Concurrent uploads to Azure Blob Storage for `post_processing`.
+##
+## Each upload is an `exists( )` round trip followed, if needed, by `upload_blob( )`, and nearly all of
+## that time is spent waiting on the network.  An UploadPool runs up to `workers` of them at once on a
+## thread pool.  Streamlit elements and st.session_state can only be touched from the script's own
+## thread, so the worker threads do nothing but talk to Azure.  Each upload's `on_done` callback is run
+## back on the submitting thread, and callbacks run in the order the uploads were submitted.  So the
+## copied/exists counters, log messages and dataframe updates happen in the same order as a serial run.
+##
+## Ordering guarantees:
+##   - uploads start in submission order, so each container's uploads go out in worksheet row order
+##   - two uploads of the same blob to the same container never overlap; the later one waits for the
+##     earlier one to finish and then finds the blob already exists
+##
+## To save most of the `exists( )` round trips, a BlobInventory lists the containers' blob names once, up
+## front, optionally only those starting with a prefix.  A pool given an inventory decides EXISTS from
+## it for every blob the listing covered, uploads without asking first when the blob isn't listed,
+## and adds each blob it uploads to the inventory.  Blobs the listing didn't cover (other prefixes,
+## containers that couldn't be listed) are still checked with `exists( )`.
+##
+## Files of LARGE_FILE bytes or more (multi-GB TIFFs and PDFs) go up as a block blob instead, staging
+## `block_size` blocks `max_concurrency` at a time and committing the block list at the end.  Block IDs
+## are derived from the file's size and mtime, so if an upload fails part way the next attempt asks
+## Azure which blocks are already staged, skips them and only sends the rest.  Azure discards blocks
+## that are never committed after a week.  Every upload logs its throughput in MB/s.  Each block is
+## read into memory whole while it's staged, so up to workers * max_concurrency * block_size bytes of
+## file data can be held at once; `block_size` is capped at MAX_BLOCK_SIZE (100 MiB, the size Azure
+## suggests for blocks) to keep that bounded.
+##
+## Given a HashCache, the pool also compares contents, not just names.  Every upload stores the local
+## file's MD5 as the blob's `content_md5` (Azure only does that by itself for single-shot uploads).
+## When a blob of the same name already exists, its `content_md5` (from the listing, or one properties
+## request) is compared with the local file's.  The blob is only replaced if they differ; a blob with
+## no `content_md5` to compare is left alone.
+##
+## Anything made in memory (derivatives, see derivatives.py) can be uploaded straight from its bytes
+## instead of a file path; its MD5 is then taken from the bytes rather than the HashCache.
+##
+## Uploads can carry blob metadata, e.g. the fingerprint of the original a derivative was made from,
+## which the inventory lists along with the names so it can be checked without another request.
+##
+## The pool only needs a BlobServiceClient, so it can be pointed at a local Azurite emulator by using
+## the emulator's connection string, or at any stand-in with the same get_blob_client( ) interface
+## (see blob_stand_in.py, used by tests/test_azure_uploads.py and `python benchmark.py uploads`).
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, ResourceExistsError, ResourceNotFoundError, ResourceModifiedError
+from azure.storage.blob import BlobBlock, ContentSettings
+from loguru import logger
+
+UPLOAD_WORKERS = 8    # default number of uploads in flight at once
+WINDOW = 4            # uploads queued per worker before submit( ) waits for the oldest to finish
+
+CONTAINERS = ('objs', 'thumbs', 'smalls', 'transcripts')
+AZURE_BASE_URL = "https://dgobjects.blob.core.windows.net/"
+
+LARGE_FILE = 64 * 2**20       # files this big or bigger are uploaded block by block
+BLOCK_SIZE = 8 * 2**20        # default size of each staged block
+MAX_BLOCK_SIZE = 100 * 2**20  # largest block staged; each one is read into memory whole while it's sent
+BLOCK_CONCURRENCY = 4         # default number of blocks of one file staged at once
+
+
+# blob_url(match, mode='OBJ', base_url=AZURE_BASE_URL)
+# The Azure URL a matched file is copied to, by its name and `mode` ('OBJ', 'TN', 'JPG' or
+# 'TRANSCRIPT').  Raises ValueError if the name doesn't fit the mode.
+# ---------------------------------------------------------------------------------------
+def blob_url(match, mode='OBJ', base_url=AZURE_BASE_URL):
+
+    # Check for obvious mode/match errors
+    for marker in ('TN', 'JPG', 'OBJ'):
+        if f"_{marker}." in match and mode != marker:
+            raise ValueError(f"_{marker} in '{match}' and mode '{mode}' is an error!")
+
+    # Determine the type of URL to build... OBJ, TN, JPG or TRANSCRIPT
+    if mode == 'TRANSCRIPT':
+        return base_url + "transcripts/" + match
+    elif mode == 'TN':
+        return base_url + "thumbs/" + match
+    elif mode == 'JPG':
+        return base_url + "smalls/" + match
+    elif mode == 'OBJ':
+        return base_url + "objs/" + match
+    raise ValueError(f"'{match}' and mode '{mode}' is an error!")
+
+
+# container_for(url, transcript=False) - The container an Azure URL built by blob_url( ) points into
+# ---------------------------------------------------------------------------------------
+def container_for(url, transcript=False):
+    if transcript:
+        return "transcripts"
+    elif "thumbs/" in url:
+        return "thumbs"
+    elif "smalls/" in url:
+        return "smalls"
+    else:
+        return "objs"
+
+
+# same_content(remote_md5, md5) - False only if both hashes are known and they differ
+# ---------------------------------------------------------------------------------------
+def same_content(remote_md5, md5):
+    return md5 is None or remote_md5 is None or bytes(remote_md5) == md5
+
+
+# upload_file(blob_service_client, container, blob, path, check_exists=True, md5=None, overwrite=False,
+#             metadata=None, block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY)
+# Upload the local file at `path`, or `path` itself if it's bytes, as `blob` unless it's already there.
+# With `md5` an existing blob is replaced if its content differs, and with `overwrite` it's replaced
+# without checking.  `metadata` is a dict stored with the blob.  Returns "EXISTS" or "COPIED".
+# ---------------------------------------------------------------------------------------
+def upload_file(blob_service_client, container, blob, path, check_exists=True, md5=None, overwrite=False,
+                metadata=None, block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY):
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob)
+    if check_exists and not overwrite:
+        try:
+            properties = blob_client.get_blob_properties( )
+        except ResourceNotFoundError:
+            properties = None
+        if properties:
+            if same_content(properties.content_settings.content_md5, md5):
+                return "EXISTS"
+            overwrite = True
+
+    start = time.perf_counter( )
+    try:
+        if isinstance(path, bytes):
+            blob_client.upload_blob(path, overwrite=overwrite, content_settings=ContentSettings(content_md5=md5),
+                                    metadata=metadata)
+            sent = len(path)
+        elif os.path.getsize(path) >= LARGE_FILE:
+            sent = upload_blocks(blob_client, path, block_size, max_concurrency, md5, overwrite, metadata)
+        else:
+            with open(file=path, mode="rb") as data:
+                blob_client.upload_blob(data, overwrite=overwrite, content_settings=ContentSettings(content_md5=md5),
+                                        metadata=metadata)
+            sent = os.path.getsize(path)
+    except (ResourceExistsError, ResourceModifiedError):    # someone else got there between our check and the upload
+        return "EXISTS"
+
+    elapsed = time.perf_counter( ) - start
+    action = "Replaced changed blob with" if overwrite else "Uploaded"
+    logger.info(f"{action} {sent / 2**20:.1f} MB of '{blob}' to '{container}' in {elapsed:.1f} s, {sent / 2**20 / max(elapsed, 1e-6):.1f} MB/s")
+    return "COPIED"
+
+
+# block_ids(path, block_size) - The IDs of the blocks `path` is split into, fixed for a given version of the file
+# ---------------------------------------------------------------------------------------
+def block_ids(path, block_size):
+    info = os.stat(path)
+    fingerprint = hashlib.sha1(f"{info.st_size}:{info.st_mtime_ns}:{block_size}".encode( )).hexdigest( )[:16]
+    count = max(1, -(-info.st_size // block_size))
+    return [f"{fingerprint}-{number:06d}" for number in range(count)]
+
+
+# upload_blocks(blob_client, path, block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY, md5=None, overwrite=False, metadata=None)
+# Stage `path` block by block, skipping blocks a failed attempt already staged, then commit them all.
+# Unless `overwrite` is set the commit fails if the blob has appeared in the meantime.  Returns the
+# number of bytes sent.
+# ---------------------------------------------------------------------------------------
+def upload_blocks(blob_client, path, block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY, md5=None, overwrite=False,
+                  metadata=None):
+    ids = block_ids(path, block_size)
+    size = os.path.getsize(path)
+
+    try:
+        (committed, uncommitted) = blob_client.get_block_list('uncommitted')
+        staged = {block.id: block.size for block in uncommitted}
+    except ResourceNotFoundError:
+        staged = { }
+
+    def stage(number):
+        length = min(block_size, size - number * block_size)
+        if staged.get(ids[number]) == length:
+            return 0
+        with open(file=path, mode="rb") as data:
+            data.seek(number * block_size)
+            blob_client.stage_block(ids[number], data.read(length), length=length)
+        return length
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='block') as blocks:
+        sent = sum(blocks.map(stage, range(len(ids))))
+
+    if sent < size:
+        logger.info(f"Resumed '{blob_client.blob_name}' with {(size - sent) / 2**20:.1f} MB already staged")
+
+    conditions = { } if overwrite else {'etag': '*', 'match_condition': MatchConditions.IfMissing}
+    blob_client.commit_block_list([BlobBlock(block_id) for block_id in ids],
+                                  content_settings=ContentSettings(content_md5=md5), metadata=metadata, **conditions)
+    return sent
+
+
+class BlobInventory:
+
+    # BlobInventory(blob_service_client, containers=CONTAINERS, prefix=None)
+    # List the blobs in each container, or only those starting with `prefix`, keeping
+    # {name: (content_md5, metadata)}
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, blob_service_client, containers=CONTAINERS, prefix=None):
+        self.prefix = prefix or ''
+        self.names = { }
+        self.lock = threading.Lock( )
+        for container in containers:
+            container_client = blob_service_client.get_container_client(container)
+            try:
+                self.names[container] = {properties.name: (properties.content_settings.content_md5, properties.metadata or { })
+                                         for properties in container_client.list_blobs(name_starts_with=prefix or None, include=['metadata'])}
+            except AzureError as e:    # missing, refused (auth, SAS without list permission), throttled, unreachable...
+                logger.warning(f"Azure Storage container '{container}' could not be listed, its blobs will be checked one at a time: {e}")
+
+    # exists(container, blob) - True or False if the listing covered `blob`, None if it didn't
+    # ---------------------------------------------------------------------------------------
+    def exists(self, container, blob):
+        if container not in self.names or not blob.startswith(self.prefix):
+            return None
+        with self.lock:
+            return blob in self.names[container]
+
+    # md5(container, blob) - The listed content_md5 of `blob`, or None
+    # ---------------------------------------------------------------------------------------
+    def md5(self, container, blob):
+        with self.lock:
+            return self.names.get(container, { }).get(blob, (None, { }))[0]
+
+    # metadata(container, blob) - The listed metadata of `blob`, { } if it has none or wasn't listed
+    # ---------------------------------------------------------------------------------------
+    def metadata(self, container, blob):
+        with self.lock:
+            return self.names.get(container, { }).get(blob, (None, { }))[1]
+
+    # add(container, blob, md5=None, metadata=None) - Record a blob that has just been uploaded
+    # ---------------------------------------------------------------------------------------
+    def add(self, container, blob, md5=None, metadata=None):
+        if container in self.names:
+            with self.lock:
+                self.names[container][blob] = (md5, metadata or { })
+
+    def __len__(self):
+        return sum(len(names) for names in self.names.values( ))
+
+
+class UploadPool:
+
+    # UploadPool(blob_service_client, workers=UPLOAD_WORKERS, inventory=None, hashes=None, block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY)
+    # `block_size` (at most MAX_BLOCK_SIZE) and `max_concurrency` apply to each large file, so up to
+    # workers * max_concurrency blocks, and that many times `block_size` bytes, may be in flight at once.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, blob_service_client, workers=UPLOAD_WORKERS, inventory=None, hashes=None,
+                 block_size=BLOCK_SIZE, max_concurrency=BLOCK_CONCURRENCY):
+        self.blob_service_client = blob_service_client
+        self.inventory = inventory
+        self.hashes = hashes
+        if block_size > MAX_BLOCK_SIZE:
+            logger.warning(f"Block size of {block_size / 2**20:.0f} MB reduced to {MAX_BLOCK_SIZE // 2**20} MB")
+            block_size = MAX_BLOCK_SIZE
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self.window = workers * WINDOW
+        self.pending = deque( )    # (key, future, on_done) in submission order
+        self.latest = { }          # (container, blob) -> future of its most recent upload
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish( )
+
+    # submit(container, blob, path, on_done, metadata=None, replace=False)
+    # Queue an upload of the file at `path`, or of `path` itself if it's bytes.  on_done(result, error)
+    # is called later, on this thread, with "EXISTS" or "COPIED" and None, or with None and the
+    # exception the upload raised.  With `replace` an existing blob is overwritten without checking it
+    # first.
+    # ---------------------------------------------------------------------------------------
+    def submit(self, container, blob, path, on_done, metadata=None, replace=False):
+        key = (container, blob)
+        future = self.executor.submit(self.transfer, container, blob, path, self.latest.get(key), metadata, replace)
+        self.latest[key] = future
+        self.pending.append((key, future, on_done))
+
+        # Don't let the queue run too far ahead of the uploads, and report those already finished
+        while len(self.pending) > self.window:
+            self.complete_oldest( )
+        while self.pending and self.pending[0][1].done( ):
+            self.complete_oldest( )
+
+    # transfer(container, blob, path, previous, metadata=None, replace=False) - Runs on a worker thread
+    # ---------------------------------------------------------------------------------------
+    def transfer(self, container, blob, path, previous, metadata=None, replace=False):
+        # Uploads start in submission order, so `previous` is already running and can't be waiting on us
+        if previous is not None:
+            wait([previous])
+        if self.hashes is None:
+            md5 = None
+        elif isinstance(path, bytes):
+            md5 = hashlib.md5(path).digest( )
+        else:
+            md5 = self.hashes.md5(path)
+        known = self.inventory.exists(container, blob) if self.inventory is not None else None
+        if known and not replace and same_content(self.inventory.md5(container, blob), md5):
+            return "EXISTS"
+        result = upload_file(self.blob_service_client, container, blob, path, check_exists=known is None,
+                             md5=md5, overwrite=bool(known) or replace, metadata=metadata,
+                             block_size=self.block_size, max_concurrency=self.max_concurrency)
+        if self.inventory is not None:
+            self.inventory.add(container, blob, md5, metadata)
+        return result
+
+    # complete_oldest( ) - Wait for the oldest pending upload and run its callback
+    # ---------------------------------------------------------------------------------------
+    def complete_oldest(self):
+        (key, future, on_done) = self.pending.popleft( )
+        try:
+            (result, error) = (future.result( ), None)
+        except Exception as e:
+            (result, error) = (None, e)
+        if self.latest.get(key) is future:
+            del self.latest[key]
+        on_done(result, error)
+
+    # finish( ) - Wait for every upload, run the remaining callbacks and shut the pool down
+    # ---------------------------------------------------------------------------------------
+    def finish(self):
+        try:
+            while self.pending:
+                self.complete_oldest( )
+        finally:
+            self.executor.shutdown(wait=True)
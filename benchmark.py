@@ -0,0 +1,228 @@
+# benchmark.py
+##
+## Quick benchmarks for the file finder's building blocks.  Run them like so:
+##
+##   python benchmark.py walk [--depth 6] [--fanout 3] [--files 20] [--latency 5] [--workers 8]
+##   python benchmark.py catalog [--files 1000000] [--dirs 5000]
+##   python benchmark.py uploads [--files 200] [--existing 50] [--latency 50] [--workers 8] [--connection-string ...]
+##
+## `walk` builds a synthetic deep directory tree in a temporary directory and times os.walk( ) against
+## the parallel `walk_files( )` crawler.  A local disk answers directory listings from cache in
+## microseconds, so --latency (milliseconds) adds a delay to every os.scandir( ) call, for both walkers,
+## to mimic the round trip to an SMB/AFP mount.
+##
+## `catalog` measures the memory needed to hold a tree listing, as parallel Python lists of filenames
+## and paths (one path string per file, as rows come back from the tree index) versus a FileCatalog,
+## and then what the FileMatcher built over that catalog adds.
+##
+## `uploads` pushes small files through an UploadPool with one worker and then with --workers, checking
+## that the EXISTS/COPIED counts come out the same.  By default it runs against the in-memory stand-in
+## for Azure Blob Storage in blob_stand_in.py, which the tests use too, waiting --latency milliseconds
+## per request.  Give it --connection-string (e.g. Azurite's "UseDevelopmentStorage=true") to run
+## against a real or emulated account instead.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import tree_index
+from file_catalog import FileCatalog
+from file_matcher import FileMatcher
+from azure_uploads import UploadPool, UPLOAD_WORKERS
+from blob_stand_in import StandInBlobService
+
+
+# build_tree(top, depth, fanout, files) - Create `fanout` subdirectories per level and `files` files in each
+# ---------------------------------------------------------------------------------------
+def build_tree(top, depth, fanout, files):
+    count = 0
+    for f in range(files):
+        open(os.path.join(top, f"grinnell_{count:05d}_{f}_OBJ.tiff"), 'w').close( )
+        count += 1
+    if depth > 0:
+        for d in range(fanout):
+            subdir = os.path.join(top, f"dir_{d}")
+            os.mkdir(subdir)
+            count += build_tree(subdir, depth - 1, fanout, files)
+    return count
+
+
+# add_latency(seconds) - Make every os.scandir( ) call wait `seconds` first
+# ---------------------------------------------------------------------------------------
+def add_latency(seconds):
+    scandir = os.scandir
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(seconds)
+        return scandir(*args, **kwargs)
+
+    os.scandir = slow_scandir
+
+
+# os_walk_files(top) - The walk `fuzzy_search_for_files` used to do
+# ---------------------------------------------------------------------------------------
+def os_walk_files(top):
+    for root, dirs, files in os.walk(top):
+        files = [f for f in files if not f[0] == '.']
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        for filename in files:
+            yield (root, filename)
+
+
+# timed(label, records) - Drain a (directory, filename) generator and report how long it took
+# ---------------------------------------------------------------------------------------
+def timed(label, records):
+    start = time.perf_counter( )
+    found = sorted(records)
+    elapsed = time.perf_counter( ) - start
+    print(f"{label:<28} {len(found):>8} files  {elapsed:8.3f} s")
+    return (found, elapsed)
+
+
+# bench_walk(args)
+# ---------------------------------------------------------------------------------------
+def bench_walk(args):
+    with tempfile.TemporaryDirectory( ) as top:
+        total = build_tree(top, args.depth, args.fanout, args.files)
+        print(f"Synthetic tree: depth={args.depth} fanout={args.fanout} files/dir={args.files} -> {total} files, latency={args.latency} ms per listing")
+
+        if args.latency:
+            add_latency(args.latency / 1000)
+
+        (expected, baseline) = timed("os.walk", os_walk_files(top))
+        for workers in sorted({1, args.workers}):
+            (found, elapsed) = timed(f"walk_files(workers={workers})", tree_index.walk_files(top, workers=workers))
+            if found != expected:
+                print(f"  !!! walk_files(workers={workers}) found different files than os.walk")
+            else:
+                print(f"  {baseline / elapsed:.1f}x os.walk")
+
+
+# synthetic_records(files, dirs) - (directory, filename) records shaped like a DGIngest listing
+# ---------------------------------------------------------------------------------------
+def synthetic_records(files, dirs):
+    for i in range(files):
+        # Build a fresh directory string per record, like each row fetched from SQLite
+        directory = '/'.join(['/Volumes/DGIngest', 'exports', f"collection-{i % dirs:05d}", 'OBJ'])
+        yield (directory, f"grinnell_{10000 + i}_OBJ.tiff")
+
+
+# measured(label, build) - Report the memory still allocated after build( ) returns
+# ---------------------------------------------------------------------------------------
+def measured(label, build):
+    tracemalloc.start( )
+    start = time.perf_counter( )
+    result = build( )
+    elapsed = time.perf_counter( ) - start
+    (current, peak) = tracemalloc.get_traced_memory( )
+    tracemalloc.stop( )
+    print(f"{label:<28} {current / 2**20:8.1f} MB held  {peak / 2**20:8.1f} MB peak  {elapsed:6.2f} s")
+    return (result, current)
+
+
+# bench_catalog(args)
+# ---------------------------------------------------------------------------------------
+def bench_catalog(args):
+    print(f"Synthetic listing: {args.files} files in {args.dirs} directories")
+
+    def parallel_lists( ):
+        file_list = [ ]
+        path_list = [ ]
+        for (directory, name) in synthetic_records(args.files, args.dirs):
+            path_list.append(directory)
+            file_list.append(name)
+        return (file_list, path_list)
+
+    ((file_list, path_list), lists_bytes) = measured("parallel lists", parallel_lists)
+    del file_list, path_list
+    (catalog, catalog_bytes) = measured("FileCatalog", lambda: FileCatalog.from_records(synthetic_records(args.files, args.dirs)))
+    print(f"  FileCatalog uses {catalog_bytes / lists_bytes:.0%} of the memory, nbytes( ) reports {catalog.nbytes( ) / 2**20:.1f} MB")
+
+    # The matcher's indexes are held alongside the catalog for as long as it is
+    (matcher, matcher_bytes) = measured("FileMatcher", lambda: FileMatcher(catalog))
+    print(f"  FileMatcher adds {matcher_bytes / catalog_bytes:.1f}x the catalog, nbytes( ) reports {matcher.nbytes( ) / 2**20:.1f} MB")
+    print(f"  catalog and matcher together use {(catalog_bytes + matcher_bytes) / 2**20:.1f} MB")
+
+
+# run_uploads(service, files, workers) - Upload every file once, returning {result: count} and the time taken
+# ---------------------------------------------------------------------------------------
+def run_uploads(service, files, workers):
+    counts = {'COPIED': 0, 'EXISTS': 0, 'FAILED': 0}
+
+    def done(result, error):
+        counts[result or 'FAILED'] += 1
+
+    start = time.perf_counter( )
+    with UploadPool(service, workers=workers) as uploads:
+        for (blob, path) in files:
+            uploads.submit('objs', blob, path, done)
+    return (counts, time.perf_counter( ) - start)
+
+
+# bench_uploads(args)
+# ---------------------------------------------------------------------------------------
+def bench_uploads(args):
+    with tempfile.TemporaryDirectory( ) as top:
+        files = [ ]
+        for i in range(args.files):
+            path = os.path.join(top, f"grinnell_{10000 + i}_OBJ.jpg")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(1024))
+            files.append((f"benchmark/{os.path.basename(path)}", path))
+
+        print(f"{args.files} files to upload, {args.existing} of them already in the container")
+        results = [ ]
+        for workers in sorted({1, args.workers}):
+            if args.connection_string:
+                from azure.storage.blob import BlobServiceClient
+                service = BlobServiceClient.from_connection_string(args.connection_string)
+                container = service.get_container_client('objs')
+                if not container.exists( ):
+                    container.create_container( )
+                for (blob, path) in files:
+                    if container.get_blob_client(blob).exists( ):
+                        container.delete_blob(blob)
+            else:
+                service = StandInBlobService(args.latency / 1000)
+            run_uploads(service, files[:args.existing], 1)
+
+            (counts, elapsed) = run_uploads(service, files, workers)
+            print(f"UploadPool(workers={workers:<2})        {counts}  {elapsed:8.3f} s")
+            results.append((counts, elapsed))
+
+        if any(counts != results[0][0] for (counts, elapsed) in results):
+            print("  !!! the results depend on the number of workers")
+        elif len(results) > 1:
+            print(f"  {results[0][1] / results[-1][1]:.1f}x one worker")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the file finder's building blocks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    walk = commands.add_parser('walk', help='os.walk versus the parallel tree crawler')
+    walk.add_argument('--depth', type=int, default=6)
+    walk.add_argument('--fanout', type=int, default=3)
+    walk.add_argument('--files', type=int, default=20)
+    walk.add_argument('--latency', type=float, default=5.0, help='milliseconds added to each directory listing')
+    walk.add_argument('--workers', type=int, default=tree_index.WORKERS)
+    walk.set_defaults(run=bench_walk)
+
+    catalog = commands.add_parser('catalog', help='memory footprint of parallel lists versus a FileCatalog')
+    catalog.add_argument('--files', type=int, default=1000000)
+    catalog.add_argument('--dirs', type=int, default=5000)
+    catalog.set_defaults(run=bench_catalog)
+
+    uploads = commands.add_parser('uploads', help='serial versus concurrent Azure uploads')
+    uploads.add_argument('--files', type=int, default=200)
+    uploads.add_argument('--existing', type=int, default=50, help='files put in the container beforehand')
+    uploads.add_argument('--latency', type=float, default=50.0, help='milliseconds per stand-in request')
+    uploads.add_argument('--workers', type=int, default=UPLOAD_WORKERS)
+    uploads.add_argument('--connection-string', help='use this storage account (or Azurite) instead of the stand-in')
+    uploads.set_defaults(run=bench_uploads)
+
+    args = parser.parse_args( )
+    sys.exit(args.run(args))
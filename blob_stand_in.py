@@ -0,0 +1,94 @@
+# blob_stand_in.py
+##
+## An in-memory stand-in for Azure Blob Storage with just enough of the BlobServiceClient interface
+## for UploadPool and BlobInventory: blob properties, uploads (from a file or bytes) and container
+## listings.  It keeps every blob's contents, content_md5 and metadata, can wait `latency` seconds per
+## request to mimic the network, and records the requests made so tests can check them.  Used by the
+## tests and by `python benchmark.py uploads`; an Azurite emulator can take its place in the benchmark.
+## -----------------------------------------------------------------------------------------------------
+
+import time
+import threading
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobProperties, ContentSettings
+
+
+# StandInBlobClient(service, container, blob) - One blob in a StandInBlobService
+# ---------------------------------------------------------------------------------------
+class StandInBlobClient:
+
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.key = (container, blob)
+        self.blob_name = blob
+
+    def get_blob_properties(self):
+        self.service.request('properties', self.key)
+        with self.service.lock:
+            if self.key not in self.service.blobs:
+                raise ResourceNotFoundError("The specified blob does not exist.")
+            return self.service.blobs[self.key]
+
+    def upload_blob(self, data, overwrite=False, content_settings=None, metadata=None):
+        contents = data if isinstance(data, bytes) else data.read( )
+        self.service.request('upload', self.key)
+        with self.service.lock:
+            if self.key in self.service.blobs and not overwrite:
+                raise ResourceExistsError("The specified blob already exists.")
+            properties = BlobProperties(name=self.key[1], size=len(contents), metadata=metadata or { })
+            properties.content_settings = content_settings or ContentSettings( )
+            self.service.blobs[self.key] = properties
+            self.service.contents[self.key] = contents
+
+
+# StandInContainerClient(service, container) - One container of a StandInBlobService, for listing
+# ---------------------------------------------------------------------------------------
+class StandInContainerClient:
+
+    def __init__(self, service, container):
+        self.service = service
+        self.container = container
+
+    def list_blobs(self, name_starts_with=None, include=None):
+        self.service.request('list', (self.container, name_starts_with))
+        with self.service.lock:
+            return [properties for ((container, blob), properties) in sorted(self.service.blobs.items( ))
+                    if container == self.container and blob.startswith(name_starts_with or '')]
+
+
+class StandInBlobService:
+
+    # StandInBlobService(latency=0) - Just enough of a BlobServiceClient, kept in memory
+    # `latencies` maps a blob name to its own latency, and `failures` maps a blob name to the exception
+    # any request for it raises, or a container name to the exception listing it raises.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.latencies = { }
+        self.failures = { }
+        self.blobs = { }        # (container, blob): BlobProperties
+        self.contents = { }     # (container, blob): bytes
+        self.requests = [ ]     # (kind, key) in the order they were made
+        self.lock = threading.Lock( )
+
+    def get_blob_client(self, container, blob):
+        return StandInBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return StandInContainerClient(self, container)
+
+    # request(kind, key) - Record one request, wait out the latency and fail it if it's meant to
+    # ---------------------------------------------------------------------------------------
+    def request(self, kind, key):
+        with self.lock:
+            self.requests.append((kind, key))
+        name = key[0] if kind == 'list' else key[1]
+        time.sleep(self.latencies.get(name, self.latency))
+        if name in self.failures:
+            raise self.failures[name]
+
+    # count(kind) - How many requests of `kind` ('properties', 'upload' or 'list') were made
+    # ---------------------------------------------------------------------------------------
+    def count(self, kind):
+        with self.lock:
+            return sum(1 for (made, key) in self.requests if made == kind)
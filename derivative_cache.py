@@ -0,0 +1,101 @@
+# derivative_cache.py
+##
+## A local cache of the thumbnail and small derivatives already made, so a rerun over the same originals
+## doesn't decode and scale them all again.  Each derivative is stored in `derivative-cache/` under its
+## `source_fingerprint( )` (see derivatives.py), which changes whenever the original's path, size or
+## mtime, or the derivative options, do.  An SQLite index in the same directory records each file's size
+## and when it was last used, and the least recently used files are removed once the cache holds more
+## than `max_bytes`.  Files used during the current run are never evicted, since their uploads may
+## still be waiting to read them.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import time
+import sqlite3
+
+CACHE_DIR = 'derivative-cache'
+CACHE_BYTES = 2**30     # default size limit, 1 GB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    size INTEGER,
+    used REAL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+
+
+class DerivativeCache:
+
+    # DerivativeCache(directory=CACHE_DIR, max_bytes=CACHE_BYTES)
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.started = time.time( )
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+        self.db.executescript(SCHEMA)
+
+    # close( ) - Trim the cache to max_bytes, now that nothing from this run is waiting to be uploaded
+    # ---------------------------------------------------------------------------------------
+    def close(self):
+        self.started = time.time( )
+        self.evict( )
+        self.db.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
+
+    # path(key, suffix) - Where the derivative with `key` should be written, e.g. path(key, '_TN.jpg')
+    # ---------------------------------------------------------------------------------------
+    def path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    # get(key) - The cached file for `key`, or None
+    # ---------------------------------------------------------------------------------------
+    def get(self, key):
+        row = self.db.execute("SELECT file FROM entries WHERE key = ?", (key,)).fetchone( )
+        if not row:
+            return None
+        if not os.path.isfile(row[0]):
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        with self.db:
+            self.db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time( ), key))
+        return row[0]
+
+    # add(key, file) - Record a derivative just written to path(key, ...), then trim the cache
+    # ---------------------------------------------------------------------------------------
+    def add(self, key, file):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries (key, file, size, used) VALUES (?, ?, ?, ?)",
+                            (key, file, os.path.getsize(file), time.time( )))
+        self.evict( )
+
+    # evict( ) - Remove least recently used files, not used in this run, until the cache fits max_bytes
+    # ---------------------------------------------------------------------------------------
+    def evict(self):
+        (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone( )
+        if total <= self.max_bytes:
+            return
+        victims = [ ]
+        for (key, file, size) in self.db.execute(
+                "SELECT key, file, size FROM entries WHERE used < ? ORDER BY used", (self.started,)):
+            if total <= self.max_bytes:
+                break
+            victims.append((key, file))
+            total -= size
+        with self.db:
+            for (key, file) in victims:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
@@ -0,0 +1,270 @@
+# derivatives.py
+##
+## Thumbnail (_TN.jpg) and small (_SMALL.jpg) derivatives for CollectionBuilder's `image_thumb` and
+## `image_small` columns.
+##
+## Decoding a full-resolution original (often a 500 MB TIFF) is by far the most expensive step, so each
+## original is read ONCE with Wand and every derivative wanted from it is made from that one copy in
+## memory, largest first: the original is scaled down to the 800px small, and the 400px thumbnail is
+## scaled down from the small rather than from the original again.  For JPEGs the decoder is asked for
+## no more than twice the largest size needed, which lets libjpeg skip most of the work.
+##
+## Generating derivatives is CPU-bound while uploading them is network-bound, so `post_processing`
+## runs them as a pipeline: a DerivativePool makes derivatives on a pool of worker processes while an
+## UploadPool (see azure_uploads.py) sends the finished ones.  At most WINDOW jobs per worker are
+## outstanding before submit( ) waits, and each finished job's derivatives are handed to the (also
+## bounded) upload pool, so only a handful of derivatives are ever waiting in memory.  As with
+## uploads, each job's `on_done` callback runs on the submitting thread in submission order, so the
+## `image_thumb`/`image_small` columns are filled in worksheet row order.
+##
+## Derivatives are encoded in memory and the JPEG bytes are handed straight to the upload, unless an
+## output is given a path, in which case it's written there instead (see PostProcessor.derive( )).
+##
+## The images match what `convert -geometry <width> -extent <width>X<height> -colorspace RGB` made for
+## the `thumbnail` package: scaled to the derivative's width, then cropped or padded to its box.
+##
+## PDFs are rendered with Wand too, rather than by a `magick` shell command per derivative: only the
+## first page is rasterized, once, at just enough resolution for twice the largest derivative, and
+## then scaled down the same way.  A broken or pathological PDF can't hang a worker or eat the
+## machine's memory.  The page is rendered in a short-lived child process that is stopped after
+## PDF_TIMEOUT seconds (ImageMagick's own time limit counts from the first image a process reads and
+## then aborts the whole process, so it's no use in a long-lived worker), with ImageMagick's memory
+## and disk limits lowered so it fails with an error instead of growing without bound.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
+from wand.image import Image
+from wand.color import Color
+from wand.resource import limits
+
+DERIVATIVE_WORKERS = max(1, (os.cpu_count( ) or 2) // 2)   # default number of worker processes
+WINDOW = 2                                                  # jobs queued per worker before submit( ) waits
+
+PDF_TIMEOUT = 60              # seconds ImageMagick may spend rendering one PDF page
+PDF_MEMORY = 512 * 2**20      # bytes of memory (and twice that of disk) it may use doing so
+
+# Derivative options, keyed by the names PostProcessor( ) is given in `derivatives`
+DERIVATIVES = {
+    'thumbnail': {
+        'trim': False,
+        'height': 400,
+        'width': 400,
+        'quality': 85,
+        'type': 'thumbnail',
+        'container': 'thumbs',
+        'suffix': '_TN.jpg',
+        'column': 'image_thumb'
+    },
+    'small': {
+        'trim': False,
+        'height': 800,
+        'width': 800,
+        'quality': 85,
+        'type': 'thumbnail',
+        'container': 'smalls',
+        'suffix': '_SMALL.jpg',
+        'column': 'image_small'
+    }
+}
+
+IMAGE_EXTENSIONS = ['.tiff', '.tif', '.jpg', '.jpeg', '.png']
+
+
+# source_fingerprint(source, options)
+# Identifies the derivative made with `options` from the current version of the original at `source`.
+# It's stored as the derivative blob's 'source_fingerprint' metadata and keys the DerivativeCache.
+# ---------------------------------------------------------------------------------------
+def source_fingerprint(source, options):
+    info = os.stat(source)
+    identity = json.dumps([source, info.st_size, info.st_mtime_ns, options], sort_keys=True)
+    return hashlib.sha1(identity.encode('utf-8', 'surrogateescape')).hexdigest( )
+
+
+# save_derivative(image, options, path) - Crop or pad a scaled `image` to its box and save it as a JPEG
+# Returns the JPEG's bytes if `path` is None, otherwise writes it to `path` and returns None.
+# ---------------------------------------------------------------------------------------
+def save_derivative(image, options, path):
+    with image.clone( ) as derivative:
+        if options['trim']:
+            derivative.trim( )
+        derivative.extent(width=options['width'], height=options['height'])
+        derivative.transform_colorspace('rgb')
+        derivative.format = 'jpeg'
+        derivative.compression_quality = options['quality']
+        if path is None:
+            return derivative.make_blob( )
+        derivative.save(filename=path)
+        return None
+
+
+# largest_first(outputs) - The positions of (options, path) outputs, ordered so each can be scaled down from the one before
+# ---------------------------------------------------------------------------------------
+def largest_first(outputs):
+    return sorted(range(len(outputs)), key=lambda number: outputs[number][0]['width'], reverse=True)
+
+
+# save_derivatives(image, outputs)
+# Scale `image` down to each of the `outputs` in turn and save it.  Returns a list holding, for each
+# output, its JPEG bytes or None if it was written to its path.
+# ---------------------------------------------------------------------------------------
+def save_derivatives(image, outputs):
+    results = [None] * len(outputs)
+    for number in largest_first(outputs):
+        (options, path) = outputs[number]
+        image.transform(resize=str(options['width']))    # each one is scaled from the one before
+        results[number] = save_derivative(image, options, path)
+    return results
+
+
+# make_derivatives(source, outputs)
+# Read the first frame of the image at `source` once and save a derivative for every (options, path)
+# in `outputs`, returning what save_derivatives( ) does.
+# ---------------------------------------------------------------------------------------
+def make_derivatives(source, outputs):
+    largest = outputs[largest_first(outputs)[0]][0]
+
+    with Image( ) as image:
+        image.options['jpeg:size'] = f"{2 * largest['width']}x{2 * largest['height']}"
+        image.read(filename=f"{source}[0]")
+        return save_derivatives(image, outputs)
+
+
+# resource_limits(**caps) - Lower ImageMagick's resource limits, e.g. time=60, for the duration
+# ---------------------------------------------------------------------------------------
+@contextmanager
+def resource_limits(**caps):
+    saved = {name: limits[name] for name in caps}
+    try:
+        for (name, value) in caps.items( ):
+            limits[name] = value
+        yield
+    finally:
+        for (name, value) in saved.items( ):
+            limits[name] = value
+
+
+# render_pdf_page(source, outputs, memory, connection) - Runs in the child process make_pdf_derivatives( ) starts
+# ---------------------------------------------------------------------------------------
+def render_pdf_page(source, outputs, memory, connection):
+    try:
+        largest = outputs[largest_first(outputs)[0]][0]
+
+        with resource_limits(memory=memory, map=memory, disk=2 * memory):
+
+            # Page size in points (1/72 inch), to pick a resolution giving twice the largest width
+            with Image.ping(filename=f"{source}[0]") as page:
+                resolution = min(600, max(36, 72 * 2 * largest['width'] // max(1, page.width)))
+
+            with Image(filename=f"{source}[0]", resolution=resolution) as image:
+                image.background_color = Color('white')
+                image.alpha_channel = 'remove'
+                results = save_derivatives(image, outputs)
+
+        connection.send((None, results))
+    except Exception as e:
+        connection.send((f"{type(e).__name__}: {e}", None))
+    finally:
+        connection.close( )
+
+
+# make_pdf_derivatives(source, outputs, timeout=PDF_TIMEOUT, memory=PDF_MEMORY)
+# Render the first page of the PDF at `source` once and save a derivative for every (options, path)
+# in `outputs`, returning what save_derivatives( ) does.  Raises TimeoutError if that takes more than
+# `timeout` seconds.
+# ---------------------------------------------------------------------------------------
+def make_pdf_derivatives(source, outputs, timeout=PDF_TIMEOUT, memory=PDF_MEMORY):
+    (receiver, sender) = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.Process(target=render_pdf_page, args=(source, outputs, memory, sender))
+    child.start( )
+    sender.close( )
+
+    try:
+        if not receiver.poll(timeout):
+            raise TimeoutError(f"Rendering the first page of '{source}' took more than {timeout} seconds")
+        (error, results) = receiver.recv( )
+    except EOFError:
+        error = f"the renderer exited with code {child.exitcode}"
+    finally:
+        if child.is_alive( ):
+            child.terminate( )
+        child.join( )
+        receiver.close( )
+
+    if error:
+        raise RuntimeError(f"Rendering the first page of '{source}' failed, {error}")
+    return results
+
+
+# render(source, outputs) - Make the derivatives in `outputs` from the original at `source`.  Runs in a worker.
+# Returns a list with the JPEG bytes of each output that has no path.
+# ---------------------------------------------------------------------------------------
+def render(source, outputs):
+    ext = os.path.splitext(source)[1].lower( )
+    if ext in IMAGE_EXTENSIONS:
+        return make_derivatives(source, outputs)
+    elif ext == '.pdf':
+        return make_pdf_derivatives(source, outputs)
+    else:
+        raise ValueError(f"Can't create derivatives of '{source}'")
+
+
+class DerivativePool:
+
+    # DerivativePool(workers=DERIVATIVE_WORKERS) - With one worker, derivatives are made in this process
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, workers=DERIVATIVE_WORKERS):
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.window = max(1, workers) * WINDOW
+        self.pending = deque( )    # (future, on_done) in submission order
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish( )
+
+    # submit(source, outputs, on_done)
+    # Queue the derivatives in `outputs`, a list of (options, path), to be made from `source`.
+    # on_done(results, error) is called later, on this thread, with the list render( ) returned and
+    # None, or with None and the exception making them raised.  With no `outputs` nothing is made,
+    # but on_done still waits its turn.
+    # ---------------------------------------------------------------------------------------
+    def submit(self, source, outputs, on_done):
+        if outputs and self.executor:
+            future = self.executor.submit(render, source, outputs)
+        else:
+            future = Future( )
+            try:
+                future.set_result(render(source, outputs) if outputs else [ ])
+            except Exception as e:
+                future.set_exception(e)
+        self.pending.append((future, on_done))
+
+        # Don't let the queue run too far ahead of the workers, and report the jobs already finished
+        while len(self.pending) > self.window:
+            self.complete_oldest( )
+        while self.pending and self.pending[0][0].done( ):
+            self.complete_oldest( )
+
+    # complete_oldest( ) - Wait for the oldest pending job and run its callback
+    # ---------------------------------------------------------------------------------------
+    def complete_oldest(self):
+        (future, on_done) = self.pending.popleft( )
+        error = future.exception( )
+        on_done(None if error else future.result( ), error)
+
+    # finish( ) - Wait for every job, run the remaining callbacks and shut the pool down
+    # ---------------------------------------------------------------------------------------
+    def finish(self):
+        try:
+            while self.pending:
+                self.complete_oldest( )
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=True)
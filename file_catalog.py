@@ -0,0 +1,79 @@
+# file_catalog.py
+##
+## The list of files found in a directory tree, in a compact, columnar form:
+##   - every filename is UTF-8 encoded into ONE contiguous buffer, with an array of offsets marking
+##     where each name starts and ends, instead of one Python string object per file
+##   - each directory string is stored once and every file just records the index of its directory,
+##     so a tree with a million files in a few thousand folders doesn't carry a million folder paths
+##
+## A FileCatalog is a read-only {index: filename} Mapping, so it can be handed to FileMatcher,
+## SignificantFilter or fuzzywuzzy's `process.extract` without copying the names into a dict, and
+## `dirname(index)` gives the folder each file lives in.  Names are decoded from the buffer on demand.
+## -----------------------------------------------------------------------------------------------------
+
+import sys
+import operator
+from array import array
+from collections.abc import Mapping
+
+
+class FileCatalog(Mapping):
+
+    def __init__(self):
+        self.buffer = bytearray( )     # every filename, UTF-8 encoded, back to back
+        self.offsets = array('Q', [0]) # name `i` is buffer[offsets[i]:offsets[i + 1]]
+        self.dirs = [ ]                # each directory path, once
+        self.dir_ids = array('I')      # ...and the index into `dirs` for every file
+        self.dir_index = { }           # directory path -> index into `dirs`
+
+    # FileCatalog.from_records(records) - Build a catalog from (directory, filename, ...) records
+    # ---------------------------------------------------------------------------------------
+    @classmethod
+    def from_records(cls, records):
+        catalog = cls( )
+        for record in records:
+            catalog.add(record[0], record[1])
+        return catalog
+
+    # add(directory, name) - Append one file to the catalog
+    # ---------------------------------------------------------------------------------------
+    def add(self, directory, name):
+        dir_id = self.dir_index.get(directory)
+        if dir_id is None:
+            dir_id = len(self.dirs)
+            self.dir_index[directory] = dir_id
+            self.dirs.append(directory)
+        self.dir_ids.append(dir_id)
+        self.buffer += name.encode('utf-8', 'surrogateescape')   # os.scandir's encoding of undecodable names
+        self.offsets.append(len(self.buffer))
+
+    def __len__(self):
+        return len(self.dir_ids)
+
+    def __getitem__(self, index):
+        try:
+            index = operator.index(index)
+        except TypeError:
+            raise KeyError(index)
+        if not 0 <= index < len(self.dir_ids):
+            raise KeyError(index)
+        view = memoryview(self.buffer)[self.offsets[index]:self.offsets[index + 1]]
+        return str(view, 'utf-8', 'surrogateescape')
+
+    def __iter__(self):
+        return iter(range(len(self.dir_ids)))
+
+    # dirname(index) - The directory holding file number `index`
+    # ---------------------------------------------------------------------------------------
+    def dirname(self, index):
+        return self.dirs[self.dir_ids[index]]
+
+    # nbytes( ) - Approximate memory held by the catalog, in bytes
+    # ---------------------------------------------------------------------------------------
+    def nbytes(self):
+        total = sys.getsizeof(self.buffer)
+        total += self.offsets.buffer_info( )[1] * self.offsets.itemsize
+        total += self.dir_ids.buffer_info( )[1] * self.dir_ids.itemsize
+        total += sys.getsizeof(self.dirs) + sum(sys.getsizeof(path) for path in self.dirs)
+        total += sys.getsizeof(self.dir_index)
+        return total
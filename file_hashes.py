@@ -0,0 +1,70 @@
+# file_hashes.py
+##
+## MD5 hashes of local files, for comparing with the `content_md5` Azure keeps for each blob.  Files
+## are hashed a megabyte at a time so even multi-GB TIFFs need little memory.  Each hash is remembered
+## in `hash-cache.sqlite` under the file's path, size and mtime, so a file that hasn't changed is only
+## ever read once, however many runs upload (or skip) it.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import hashlib
+import sqlite3
+import threading
+
+HASH_CACHE = 'hash-cache.sqlite'
+CHUNK = 2**20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    md5 BLOB
+);
+"""
+
+
+# file_md5(path) - The MD5 digest of the file at `path`, read CHUNK bytes at a time
+# ---------------------------------------------------------------------------------------
+def file_md5(path):
+    md5 = hashlib.md5( )
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            md5.update(chunk)
+    return md5.digest( )
+
+
+class HashCache:
+
+    # HashCache(db_path=HASH_CACHE) - Open (or create) the cache stored in `db_path`
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, db_path=HASH_CACHE):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock( )   # hashes are looked up from upload worker threads
+
+    def close(self):
+        self.db.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
+
+    # md5(path) - The MD5 digest of `path`, from the cache if the file hasn't changed since it was hashed
+    # ---------------------------------------------------------------------------------------
+    def md5(self, path):
+        info = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT md5 FROM hashes WHERE path = ? AND size = ? AND mtime = ?",
+                                  (path, info.st_size, info.st_mtime_ns)).fetchone( )
+        if row:
+            return bytes(row[0])
+
+        digest = file_md5(path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO hashes (path, size, mtime, md5) VALUES (?, ?, ?, ?)",
+                            (path, info.st_size, info.st_mtime_ns, digest))
+        return digest
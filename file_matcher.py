@@ -0,0 +1,424 @@
+# file_matcher.py
+##
+## Indexed candidate matching for `fuzzy_search_for_files`.  A FileMatcher is built once per directory
+## tree and answers the same top-N queries as fuzzywuzzy's `process.extract(target, choices, limit=N)`
+## with its default WRatio scorer... same scores, same ordering (ties go to the earliest file)... but
+## without scoring every file in the tree for every worksheet row.
+##
+## How it works:
+##   - Every filename is run through the same `full_process` step that `process.extract` applies, ONCE,
+##     and the results are kept in one buffer with offsets, like the FileCatalog's names.
+##   - A hash index (sorted CRCs) of the processed names resolves targets already in the tree at once.
+##   - An ID index (the embedded number `check_numeric_part` compares -> file indices, also kept as
+##     sorted CRCs) lets targets like 'grinnell_13229_OBJ' be ranked against just the handful of files
+##     carrying the same number.
+##   - A trigram inverted index (trigram -> file indices) picks a shortlist of likely candidates, and
+##     that shortlist is scored exactly with `fuzz.WRatio` to seed the top-N.
+##   - A per-file character count profile gives a cheap, vectorized UPPER BOUND on the WRatio score of
+##     every remaining file.  Only files whose bound can still beat the current N-th best score are
+##     scored, best bound first, so the result is identical to a full `process.extract` scan.
+##
+## A SignificantFilter, built over the same names, pares the tree down to the files containing the
+## text a --regex (significant) pattern matched in the target, caching the resulting subsets.
+##
+## `match_rows( )` runs `match_target( )` over a worksheet's rows, optionally spread across a pool of
+## worker processes that each receive the matcher and filter once, when the worker starts.
+## -----------------------------------------------------------------------------------------------------
+
+import re
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+
+# `full_process(force_ascii=True)` leaves only lowercase ASCII letters, digits, underscores and spaces
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789_'
+CHAR_SLOTS = {c: i for i, c in enumerate(ALPHABET)}
+OTHER_SLOT = len(ALPHABET)      # anything unexpected is lumped together, which only loosens the bound
+NUM_SLOTS = len(ALPHABET) + 1
+
+SHORTLIST = 32   # number of trigram-ranked candidates scored up front to seed the top-N
+CHUNK_SIZE = 32  # worksheet rows handed to a worker process at a time
+
+NUMERIC_ID = re.compile(r'^.*[-_](\d+).*$')   # any ... dash OR underscore ... series of digits ... any
+
+
+# process_choice(name) - The processing `process.extract` applies to each choice
+# ---------------------------------------------------------------------------------------
+def process_choice(name):
+    return utils.full_process(name, force_ascii=True)
+
+
+# process_query(target) - The processing `process.extract` applies to the query
+# ---------------------------------------------------------------------------------------
+def process_query(target):
+    return utils.full_process(utils.full_process(target), force_ascii=True)
+
+
+# numeric_id(name) - The embedded numeric ID of a name, e.g. '13229' in 'grinnell_13229_OBJ.tiff', or None
+# ---------------------------------------------------------------------------------------
+def numeric_id(name):
+    m = NUMERIC_ID.match(name)
+    if m:
+        return m.group(1)
+    return None
+
+
+# check_numeric_part(score, target, candidate)
+# A best match whose embedded numeric ID is EXACTLY the target's is accepted with a score of 95
+# ---------------------------------------------------------------------------------------
+def check_numeric_part(score, target, candidate):
+    tn = numeric_id(target)
+    if tn and tn == numeric_id(candidate):   # an EXACT numeric match!
+        return 95
+    return score
+
+
+# compile_significant(regex) - Compile a --regex (significant) pattern once, adding a (group) if it has none
+# Raises re.error for an invalid pattern, so callers should check --regex with it before a search.
+# ---------------------------------------------------------------------------------------
+@lru_cache(maxsize=256)
+def compile_significant(regex):
+    if '(' in regex:             # regex already has a (group), do not add one
+        return re.compile(regex)
+    return re.compile(f"({regex})")     # regex is raw, add a (group) pair of parenthesis
+
+
+# check_significant(regex, filename) - The significant part of a filename, or False
+# ---------------------------------------------------------------------------------------
+def check_significant(regex, filename):
+    match = compile_significant(regex).search(filename)
+    if match and match.group( ):
+        return match.group( )
+    return False
+
+
+# trigrams(processed) - The set of 3-character substrings of a processed name
+# ---------------------------------------------------------------------------------------
+def trigrams(processed):
+    return {processed[i:i + 3] for i in range(len(processed) - 2)}
+
+
+# unique_token_length(processed) - Length of the de-duplicated token string `token_set_ratio` builds
+# ---------------------------------------------------------------------------------------
+def unique_token_length(processed):
+    return len(' '.join(set(processed.split())))
+
+
+# char_profile(processed) - Count of each non-space character in a processed name
+# ---------------------------------------------------------------------------------------
+def char_profile(processed):
+    counts = [0] * NUM_SLOTS
+    for c in processed:
+        if c != ' ':
+            counts[CHAR_SLOTS.get(c, OTHER_SLOT)] += 1
+    return counts
+
+
+# hash_index(hashes) - (order, sorted hashes) for an array('q') of one hash per file, -1 for none
+# Files with equal hashes stay in index order.
+# ---------------------------------------------------------------------------------------
+def hash_index(hashes):
+    hashes = np.frombuffer(hashes, dtype=np.int64)
+    order = np.argsort(hashes, kind='stable').astype(np.int32)
+    return (order, hashes[order])
+
+
+# hash_lookup(order, sorted_hashes, code) - Indices, ascending, of the files whose hash in a hash_index( ) is `code`
+# ---------------------------------------------------------------------------------------
+def hash_lookup(order, sorted_hashes, code):
+    (lo, hi) = (np.searchsorted(sorted_hashes, code, 'left'), np.searchsorted(sorted_hashes, code, 'right'))
+    return order[lo:hi]
+
+
+class FileMatcher:
+
+    # FileMatcher(names) - Index filenames held in a list or FileCatalog; `names[index]` identifies each file
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, names):
+        self.names = names
+        n = len(names)
+
+        # Like the catalog's names, the processed names (pure ASCII) are kept back to back in ONE buffer
+        # with offsets, not as a Python string per file.  The exact-name index holds a CRC of each
+        # processed name, sorted, instead of a dict keyed by the names themselves.
+        buffer = bytearray( )
+        offsets = array('q', [0])
+        lengths = array('i')
+        spaces = array('i')
+        unique_lengths = array('i')
+        name_hashes = array('q')
+        id_hashes = array('q')
+
+        # Character profiles live in one flat buffer, one row of NUM_SLOTS counts per file.  Filenames
+        # are limited to 255 characters so a uint8 count can never overflow.
+        profiles = bytearray(n * NUM_SLOTS)
+        postings = { }
+        for idx in range(n):
+            name = names[idx]
+            p = process_choice(name)
+            encoded = p.encode('utf-8')
+            buffer += encoded
+            offsets.append(len(buffer))
+            lengths.append(len(p))
+            spaces.append(p.count(' '))
+            unique_lengths.append(unique_token_length(p))
+            name_hashes.append(zlib.crc32(encoded) if p else -1)    # empty names are never looked up
+
+            file_id = numeric_id(name)
+            id_hashes.append(zlib.crc32(file_id.encode('ascii')) if file_id else -1)
+            base = idx * NUM_SLOTS
+            for c in p:
+                if c != ' ':
+                    profiles[base + CHAR_SLOTS.get(c, OTHER_SLOT)] += 1
+            for gram in trigrams(p):
+                postings.setdefault(gram, []).append(idx)
+
+        self.buffer = bytes(buffer)
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.lengths = np.frombuffer(lengths, dtype=np.int32)
+        self.spaces = np.frombuffer(spaces, dtype=np.int32)
+        self.unique_lengths = np.frombuffer(unique_lengths, dtype=np.int32)
+        (self.hash_order, self.sorted_hashes) = hash_index(name_hashes)
+
+        # The ID index is kept the same way, as a sorted CRC of each file's numeric ID
+        (self.id_order, self.sorted_ids) = hash_index(id_hashes)
+
+        self.profiles = np.frombuffer(bytes(profiles), dtype=np.uint8).reshape(n, NUM_SLOTS)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # processed(idx) - File `idx`'s name as `process.extract` processes it, decoded from the buffer
+    # ---------------------------------------------------------------------------------------
+    def processed(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8')
+
+    # nbytes( ) - Approximate memory held by the matcher's indexes, in bytes (the names are the catalog's)
+    # ---------------------------------------------------------------------------------------
+    def nbytes(self):
+        total = sys.getsizeof(self.buffer)
+        total += sum(a.nbytes for a in (self.offsets, self.lengths, self.spaces, self.unique_lengths, self.profiles,
+                                         self.hash_order, self.sorted_hashes, self.id_order, self.sorted_ids))
+        total += sys.getsizeof(self.postings)
+        total += sum(sys.getsizeof(gram) + sys.getsizeof(ids) for gram, ids in self.postings.items( ))
+        return total
+
+    # lookup(target, limit=3)
+    # The O(1) path for targets already in the tree.  A file scores 100 if, and only if, its processed
+    # name equals the processed target, so these hits are exactly the files `extract` would rank first.
+    # Returns (kind, matches) where kind is 'exact', 'case-insensitive' or None if nothing was found.
+    # ---------------------------------------------------------------------------------------
+    def lookup(self, target, limit=3, subset=None):
+        query = process_query(target)
+        hits = [ ]
+        if query:
+            candidates = hash_lookup(self.hash_order, self.sorted_hashes, zlib.crc32(query.encode('utf-8')))
+            hits = [int(idx) for idx in candidates if self.processed(idx) == query]
+        if hits and subset is not None:
+            hits = [int(idx) for idx in np.intersect1d(hits, subset)]
+        if not hits:
+            return (None, [ ])
+        kind = 'exact' if any(self.names[idx] == target for idx in hits) else 'case-insensitive'
+        return (kind, [(self.names[idx], 100, idx) for idx in hits[:limit]])
+
+    # extract_by_id(target, limit=3, subset=None)
+    # Rank only the files that carry the target's embedded numeric ID.  Returns [ ] if the target has no
+    # ID or no file in the tree carries it, in which case the caller should fall back to `extract`.
+    # ---------------------------------------------------------------------------------------
+    def extract_by_id(self, target, limit=3, subset=None):
+        target_id = numeric_id(target)
+        if not target_id:
+            return [ ]
+        candidates = hash_lookup(self.id_order, self.sorted_ids, zlib.crc32(target_id.encode('ascii')))
+        bucket = [int(idx) for idx in candidates if numeric_id(self.names[idx]) == target_id]
+        if bucket and subset is not None:
+            bucket = np.intersect1d(bucket, subset)
+        if len(bucket) == 0:
+            return [ ]
+        return self.extract(target, limit=limit, subset=bucket)
+
+    # extract(target, limit=3, subset=None)
+    # Returns [(name, score, index), ...] exactly as `process.extract(target, {index: name}, limit=limit)`
+    # would.  If `subset` (an ascending sequence of indices) is given, only those files are considered.
+    # ---------------------------------------------------------------------------------------
+    def extract(self, target, limit=3, subset=None):
+        if subset is None:
+            candidates = np.arange(len(self))
+        else:
+            candidates = np.asarray(subset, dtype=np.int64)
+
+        if len(candidates) == 0:
+            return [ ]
+
+        query = process_query(target)
+
+        # An empty query scores 0 against everything, so `process.extract` keeps the first `limit` files
+        if not query:
+            return [(self.names[i], 0, int(i)) for i in candidates[:limit]]
+
+        scored = { }
+        best = [ ]    # (score, index) pairs, best first, ties broken by lowest index
+
+        def consider(pos):
+            idx = int(candidates[pos])
+            score = fuzz.WRatio(query, self.processed(idx), full_process=False)
+            scored[pos] = score
+            best.append((score, idx))
+            best.sort(key=lambda item: (-item[0], item[1]))
+            del best[limit:]
+
+        # Seed the top-N with the files sharing the most trigrams with the target
+        overlap = self.trigram_overlap(query)[candidates]
+        for pos in np.argsort(-overlap, kind='stable')[:SHORTLIST]:
+            consider(pos)
+
+        # Score whatever else could still make the cut, most promising first
+        bounds = self.upper_bounds(query, candidates)
+        threshold = best[-1][0] if len(best) == limit else -1
+        survivors = np.nonzero(bounds >= threshold)[0]
+        for pos in survivors[np.argsort(-bounds[survivors], kind='stable')]:
+            if len(best) == limit and bounds[pos] < best[-1][0]:
+                break
+            if pos not in scored:
+                consider(pos)
+
+        return [(self.names[idx], score, idx) for score, idx in best]
+
+    # trigram_overlap(query) - Number of the query's trigrams found in each file
+    # ---------------------------------------------------------------------------------------
+    def trigram_overlap(self, query):
+        hits = [self.postings[gram] for gram in trigrams(query) if gram in self.postings]
+        if not hits:
+            return np.zeros(len(self), dtype=np.int64)
+        return np.bincount(np.concatenate(hits), minlength=len(self))
+
+    # upper_bounds(query, candidates)
+    # An upper bound on `fuzz.WRatio(query, file)` for each candidate.  Every ratio WRatio takes is
+    # 2M / (len_a + len_b) (or M / len_short for partials) over strings built from the two names'
+    # characters, so M can never exceed the characters the names have in common, and the longer
+    # string in each comparison is never shorter than the smaller de-duplicated token string.
+    # ---------------------------------------------------------------------------------------
+    def upper_bounds(self, query, candidates):
+        q_profile = np.array(char_profile(query), dtype=np.uint8)
+        q_length = len(query)
+
+        common = np.minimum(self.profiles[candidates], q_profile).sum(axis=1, dtype=np.int64)
+        common += np.minimum(self.spaces[candidates], query.count(' '))
+        floor = np.minimum(self.unique_lengths[candidates], unique_token_length(query))
+        ratio = np.minimum(1.0, 2.0 * common / np.maximum(common + floor, 1))
+
+        # Names of very different lengths also get WRatio's partial comparisons, where a single shared
+        # token is enough for partial_token_set_ratio to return 100 * .95 * partial_scale
+        lengths = self.lengths[candidates]
+        len_ratio = np.maximum(lengths, q_length) / np.maximum(np.minimum(lengths, q_length), 1)
+        partial = np.where(len_ratio > 8, 100 * .95 * .6, 100 * .95 * .9)
+        bounds = np.where(len_ratio >= 1.5, np.maximum(100 * ratio, partial), 100 * ratio)
+
+        bounds = np.ceil(bounds)
+        bounds[lengths == 0] = 0
+        return bounds
+
+
+class SignificantFilter:
+
+    # SignificantFilter(names, maxsize=64) - Filter a sequence of filenames by --regex (significant) tokens
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, names, maxsize=64):
+        self.names = names
+        self.maxsize = maxsize
+        self.cache = OrderedDict( )   # pattern -> ascending array of matching indices, least recent first
+
+    # subset(text) - Indices of every filename containing `text`, the significant part of a target
+    # The text is what a --regex matched, not a pattern itself, so it's escaped: 'a(1' or 'a.1' is
+    # looked for literally.
+    # ---------------------------------------------------------------------------------------
+    def subset(self, text):
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            return self.cache[text]
+
+        search = re.compile(f"({re.escape(text)})").search
+        keep = [ ]
+        for idx in range(len(self.names)):
+            match = search(self.names[idx])
+            if match and match.group( ):
+                keep.append(idx)
+
+        indices = np.array(keep, dtype=np.int64)
+        self.cache[text] = indices
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return indices
+
+
+# match_target(matcher, significant_filter, target, regex=False, resolve_ids=False, runners_up=False, limit=3)
+# Find the best `limit` matches for one worksheet target.  Returns (kind, significant_text, matches)
+# where `kind` names the path that resolved it: 'exact', 'case-insensitive', 'numeric ID' or 'fuzzy'.
+# Targets already in the tree skip fuzzy scoring, unless `runners_up` asks for the runner-up matches
+# the name index can't supply.  With `resolve_ids`, targets carrying a numeric ID found in the tree are
+# only ranked against the files with that ID.
+# ---------------------------------------------------------------------------------------
+def match_target(matcher, significant_filter, target, regex=False, resolve_ids=False, runners_up=False, limit=3):
+
+    # If a --regex (significant) was specified see if our target has a matching component, and if it
+    # does, pare the tree down to only significant matches
+    significant_text = False
+    subset = None
+    if regex:
+        significant_text = check_significant(regex, target)
+        if significant_text:
+            subset = significant_filter.subset(significant_text)
+
+    (kind, matches) = matcher.lookup(target, limit=limit, subset=subset)
+    if kind and (len(matches) == limit or not runners_up):
+        return (kind, significant_text, matches)
+
+    if resolve_ids:
+        matches = matcher.extract_by_id(target, limit=limit, subset=subset)
+        if matches:
+            return ('numeric ID', significant_text, matches)
+
+    return ('fuzzy', significant_text, matcher.extract(target, limit=limit, subset=subset))
+
+
+# Each worker process gets its own copy of the matcher and filter, once, from init_worker( )
+worker_matcher = None
+worker_filter = None
+
+
+# init_worker(matcher, significant_filter)
+# ---------------------------------------------------------------------------------------
+def init_worker(matcher, significant_filter):
+    global worker_matcher, worker_filter
+    worker_matcher = matcher
+    worker_filter = significant_filter
+
+
+# match_chunk(rows, options) - Match a chunk of (row, target) pairs in a worker process
+# ---------------------------------------------------------------------------------------
+def match_chunk(rows, options):
+    return [(x, target) + match_target(worker_matcher, worker_filter, target, **options) for (x, target) in rows]
+
+
+# match_rows(matcher, significant_filter, rows, workers=1, **options)
+# Yield (row, target, kind, significant_text, matches) for every (row, target) pair, in row order.
+# With more than one worker, chunks of rows are matched concurrently in a process pool; `options` are
+# passed along to match_target( ).
+# ---------------------------------------------------------------------------------------
+def match_rows(matcher, significant_filter, rows, workers=1, **options):
+    if workers <= 1 or len(rows) <= CHUNK_SIZE:
+        for (x, target) in rows:
+            yield (x, target) + match_target(matcher, significant_filter, target, **options)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(matcher, significant_filter)) as pool:
+        chunks = [rows[i:i + CHUNK_SIZE] for i in range(0, len(rows), CHUNK_SIZE)]
+        futures = [pool.submit(match_chunk, chunk, options) for chunk in chunks]
+        for future in futures:
+            yield from future.result( )
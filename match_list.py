@@ -0,0 +1,109 @@
+# match_list.py
+##
+## Streaming output for `match-list.csv`.  The file is opened once per run, the header is written once,
+## and each result row is appended and flushed as soon as it is produced, so a run that dies part way
+## through still leaves a valid CSV holding every row it finished.  `MatchListWriter(resume=True)`
+## picks such a file up again: it reads back the finished rows and appends after them.
+##
+## Rows are only keyed by their worksheet row number, so the run that wrote the file (its run journal
+## key, see run_key( ) in run_journal.py) is kept beside it in `<path>.run`.  A file written by another
+## run, for another worksheet, column, tree or settings, or with no `.run` file at all (like the sample
+## `match-list.csv`), is never resumed: it's started afresh.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import csv
+from loguru import logger
+
+MATCH_LIST = 'match-list.csv'
+
+HEADER = [
+    'No.', 'Target', 'Significant --regex', 'Best Match Score',
+    'Best Match', 'Best Match Path', '2nd Match Score',
+    '2nd Match', '2nd Match Path', '3rd Match Score',
+    '3rd Match', '3rd Match Path'
+]
+
+
+# parse_line(row) - Turn a row read from the CSV back into the csv_line `fuzzy_search_for_files` built
+# ---------------------------------------------------------------------------------------
+def parse_line(row):
+    line = [value if value != '' else None for value in row[:7]]
+    line += [None] * (7 - len(line))
+    line[0] = int(line[0])
+    if line[3] is not None:
+        line[3] = int(line[3])
+    return line
+
+
+class MatchListWriter:
+
+    # MatchListWriter(path=MATCH_LIST, key=None, resume=False)
+    # Start a fresh match list for the run `key`, or with `resume` keep the rows already in `path` if
+    # that same run wrote them.  Those rows are available from `completed`, a {row number: csv_line} dict.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, path=MATCH_LIST, key=None, resume=False):
+        self.path = path
+        self.completed = { }
+
+        if resume and os.path.exists(path) and not (key and self.run_key( ) == key):
+            logger.warning(f"'{path}' was not written by this run, so it's started afresh instead of resumed")
+            resume = False
+
+        if resume and os.path.exists(path):
+            self.truncate_partial_row( )
+            with open(path, 'r', newline='') as csvfile:
+                rows = list(csv.reader(csvfile))
+            for row in rows[1:]:
+                try:
+                    line = parse_line(row)
+                except (ValueError, IndexError):
+                    continue
+                self.completed[line[0]] = line
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL)
+            if not rows:
+                self.writer.writerow(HEADER)
+        else:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL)
+            self.writer.writerow(HEADER)
+
+        self.file.flush( )
+        with open(f"{path}.run", 'w') as run:
+            run.write(key or '')
+
+    # run_key( ) - The key of the run that wrote the file at `path`, or None
+    # ---------------------------------------------------------------------------------------
+    def run_key(self):
+        try:
+            with open(f"{self.path}.run", 'r') as run:
+                return run.read( ).strip( ) or None
+        except OSError:
+            return None
+
+    # truncate_partial_row( ) - Drop a row that was only partly written when a run died
+    # ---------------------------------------------------------------------------------------
+    def truncate_partial_row(self):
+        with open(self.path, 'rb+') as f:
+            data = f.read( )
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    # write(line) - Append one result row and push it to disk right away
+    # ---------------------------------------------------------------------------------------
+    def write(self, line):
+        self.writer.writerow(line)
+        self.file.flush( )
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush( )
+            os.fsync(self.file.fileno( ))
+            self.file.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
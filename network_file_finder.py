@@ -0,0 +1,252 @@
+# network_file_finder.py
+##
+## The headless, batch successor to the old `network-file-finder` command line utility, for cron jobs
+## and for working through many worksheets without a browser.  It runs the same pipeline as
+## streamlit_app.py, built from the same pieces:
+##
+##   python network_file_finder.py --sheet <URL or sheets.json name> --worksheet <title> [--worksheet ...]
+##       --column <letter, number or header> --tree <directory> [--regex <significant>]
+##       [--copy-to-azure] [--thumbnails] [--smalls] [--transcripts] [--processing-mode CollectionBuilder]
+##       [--save] [--offline] [--resume] [--output-csv] ...
+##
+## The tree is refreshed in its tree index and loaded into one FileCatalog and FileMatcher, ONCE, then
+## every worksheet is matched against it in turn.  Each worksheet is its own run in the run journal,
+## so --resume picks up each one where it stopped.  With --copy-to-azure, matches scoring 90 or more
+## (or carrying the target's numeric ID) are uploaded through an UploadPool, checked against one
+## listing of the containers made for all the worksheets, and with --thumbnails/--smalls their
+## derivatives are made on a DerivativePool and uploaded from memory, all by the same PostProcessor
+## (post_processor.py) the app uses.  With --processing-mode the found URLs go into the worksheet's
+## dataframe, and --save writes just the changed cells back to the sheet, unless its rows have moved
+## since it was read.  Worksheets are read through the sheet cache, so --offline runs without any
+## Google API calls (and can't --save).
+##
+## Progress goes to stdout as JSON Lines, one object per event, each with an "event" name: 'tree',
+## 'worksheet', 'match', 'skipped', 'upload', 'derivative', 'saved', 'worksheet_done', 'error' and
+## finally 'done'.  A failed upload is an 'upload' event with a false result and a message.  Log
+## messages go to stderr.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from loguru import logger
+from tree_index import TreeIndex, tree_index_path, WORKERS
+from file_catalog import FileCatalog
+from file_matcher import FileMatcher, SignificantFilter, match_rows, compile_significant
+from match_list import MatchListWriter, MATCH_LIST
+from run_journal import RunJournal, match_settings
+from sheet_snapshots import WorksheetSnapshots
+from sheet_store import SheetStore
+from sheet_updates import DirtyCells
+from azure_uploads import UploadPool, BlobInventory, UPLOAD_WORKERS
+from derivatives import DerivativePool, DERIVATIVE_WORKERS
+from post_processor import PostProcessor
+from service_clients import google_client, azure_client
+from gspread.utils import a1_to_rowcol, extract_id_from_url
+
+TRANSCRIPT_EXTENSIONS = ['.csv', '.vtt', '.pdf', '.xml']
+SKIP_ROWS = 1          # header rows at the top of each worksheet
+
+
+# emit(event, **fields) - Write one JSON Lines progress record to stdout
+# ---------------------------------------------------------------------------------------
+def emit(event, **fields):
+    print(json.dumps({'event': event, 'time': round(time.time( ), 3), **fields}, default=str), flush=True)
+
+
+# column_number(headers, column) - The 1-based number of `column`, given as a letter ('G'), a number or a header
+# ---------------------------------------------------------------------------------------
+def column_number(headers, column):
+    if column in headers:
+        return headers.index(column) + 1
+    if column.isdigit( ):
+        return int(column)
+    if re.fullmatch(r'[A-Za-z]{1,3}', column):
+        return a1_to_rowcol(f"{column.upper( )}1")[1]
+    raise ValueError(f"There's no column '{column}' in the worksheet")
+
+
+# sheet_url(sheet) - A sheet URL, or the URL `sheets.json` lists under that name
+# ---------------------------------------------------------------------------------------
+def sheet_url(sheet):
+    if sheet.startswith('https://'):
+        return sheet
+    with open('sheets.json', 'r') as j:
+        return json.load(j)[sheet]
+
+
+# load_tree(args) - Refresh the tree index for --tree and build the catalog, matcher and filter from it
+# ---------------------------------------------------------------------------------------
+def load_tree(args):
+    exclude = [pattern.strip( ) for pattern in (args.exclude or '').split(',') if pattern.strip( )]
+    with TreeIndex(tree_index_path(args.root or os.path.basename(os.path.normpath(args.tree)))) as tree_index:
+        refreshed = tree_index.refresh(args.tree, workers=args.crawler_workers, max_depth=args.max_depth or None,
+                                       exclude=exclude)
+        catalog = FileCatalog.from_records(tree_index.files(args.tree))
+    emit('tree', path=args.tree, files=len(catalog), dirs=len(catalog.dirs), **refreshed)
+    return (catalog, FileMatcher(catalog), SignificantFilter(catalog))
+
+
+# search_worksheet(title, filenames, catalog, matcher, significant_filter, args, journal)
+# Match every filename in the worksheet's column against the catalog.  Returns the csv_lines, as
+# fuzzy_search_for_files( ) builds them, in row order, and {row: transcript directory}.
+# ---------------------------------------------------------------------------------------
+def search_worksheet(title, filenames, catalog, matcher, significant_filter, args, journal):
+    completed = journal.completed_matches( ) if args.resume else { }
+    match_list = None
+    if args.output_csv:
+        path = MATCH_LIST if len(args.worksheet) == 1 else f"match-list-{re.sub(r'[^A-Za-z0-9._-]+', '-', title)}.csv"
+        match_list = MatchListWriter(path, key=journal.key, resume=args.resume)
+
+    try:
+        if match_list:
+            for (x, line) in sorted(completed.items( )):
+                if x not in match_list.completed:
+                    match_list.write(line)
+            completed.update(match_list.completed)
+
+        rows = [(x, filenames[x]) for x in range(SKIP_ROWS, len(filenames)) if filenames[x] and x not in completed]
+        csvlines = list(completed.values( ))
+        transcript_dirs = { }
+
+        results = match_rows(matcher, significant_filter, rows, workers=args.matching_workers, regex=args.regex or False,
+                             resolve_ids=args.resolve_numeric_ids, runners_up=args.transcripts)
+        for (x, target, kind, significant_text, matches) in results:
+            csv_line = [x, target, None, None, None, None, None]
+            for found, (match, score, index) in enumerate(matches or [ ]):
+                if found == 0:
+                    (csv_line[3], csv_line[4], csv_line[5]) = (score, match, catalog.dirname(index))
+                if args.transcripts and score > 89 and os.path.splitext(match)[1].lower( ) in TRANSCRIPT_EXTENSIONS:
+                    csv_line[6] = match
+                    transcript_dirs[x] = catalog.dirname(index)
+
+            emit('match', worksheet=title, row=x, target=target, kind=kind, score=csv_line[3], match=csv_line[4],
+                 path=csv_line[5], transcript=csv_line[6])
+            csvlines.append(csv_line)
+            if match_list:
+                match_list.write(csv_line)
+            journal.record_match(x, csv_line)
+
+    finally:
+        if match_list:
+            match_list.close( )
+
+    csvlines.sort(key=lambda line: line[0])
+    return (csvlines, transcript_dirs)
+
+
+# run(args) - Match, upload and save every --worksheet.  Returns the exit status.
+# ---------------------------------------------------------------------------------------
+def run(args):
+    url = sheet_url(args.sheet)
+    gc = None if args.offline else google_client( )
+
+    def revision(url):
+        return gc.http_client.get_file_drive_metadata(extract_id_from_url(url))['modifiedTime']
+
+    snapshots = WorksheetSnapshots(lambda url: gc.open_by_url(url), revision=revision, store=SheetStore( ))
+    (catalog, matcher, significant_filter) = load_tree(args)
+    if len(catalog) == 0:
+        emit('error', message=f"The tree '{args.tree}' holds NO files!  Check the path and the network connection.")
+        return 1
+
+    blob_service_client = None
+    inventory = None
+    if args.copy_to_azure:
+        blob_service_client = azure_client(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
+        inventory = BlobInventory(blob_service_client, prefix=args.blob_prefix)
+
+    exclude = [pattern.strip( ) for pattern in (args.exclude or '').split(',') if pattern.strip( )]
+    settings = match_settings(regex=args.regex, resolve_ids=args.resolve_numeric_ids, exclude=exclude,
+                              max_depth=args.max_depth, transcripts=args.transcripts)
+    derivatives = [name for (name, on) in (('thumbnail', args.thumbnails), ('small', args.smalls)) if on]
+    totals = { }
+    failures = 0
+    with RunJournal( ) as journal:
+        for title in args.worksheet:
+            try:
+                snapshot = snapshots.snapshot(url, title, offline=args.offline, fresh=args.save)
+                column = column_number(snapshot.headers( ), args.column)
+                journal.start(url, title, column, args.tree, settings=settings, resume=args.resume)
+                emit('worksheet', worksheet=title, column=column, rows=len(snapshot.values), revision=snapshot.revision)
+
+                (csvlines, transcript_dirs) = search_worksheet(title, snapshot.column(column), catalog, matcher,
+                                                               significant_filter, args, journal)
+
+                # Every upload for this worksheet is finished when the pools close, before its URLs are saved
+                dirty_cells = DirtyCells(snapshot.dataframe( )) if args.processing_mode else None
+                with UploadPool(blob_service_client, workers=args.upload_workers, inventory=inventory) as uploads, \
+                     DerivativePool(workers=args.derivative_workers) as derivative_pool:
+                    def report(event, **fields):
+                        emit(event, worksheet=title, **fields)
+
+                    processor = PostProcessor(uploads, derivative_pool, report, journal=journal, dirty_cells=dirty_cells,
+                                              copy=args.copy_to_azure, derivatives=derivatives)
+                    for line in csvlines:
+                        processor.process(line, transcript_dirs.get(line[0]))
+
+                # Cells are written by row position, so not if rows have been inserted, deleted or sorted since
+                if dirty_cells is not None and args.save and snapshots.moved(url, title, snapshot, column):
+                    failures += 1
+                    emit('error', worksheet=title, message="Rows were added, removed or reordered since the worksheet was read; it was NOT saved")
+                elif dirty_cells is not None and args.save:
+                    written = dirty_cells.flush(snapshots.worksheet(url, title))
+                    snapshots.invalidate(url, snapshots.worksheets(url)[title])
+                    emit('saved', worksheet=title, cells=written)
+
+                emit('worksheet_done', worksheet=title, **processor.counts)
+                for (key, value) in processor.counts.items( ):
+                    totals[key] = totals.get(key, 0) + value
+
+            except Exception as e:
+                failures += 1
+                logger.exception(e)
+                emit('error', worksheet=title, message=f"{type(e).__name__}: {e}")
+
+    emit('done', worksheets=len(args.worksheet), failed_worksheets=failures, **totals)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find each worksheet's files in a directory tree and copy them to Azure, without a browser")
+    parser.add_argument('--sheet', required=True, help="Google Sheet URL, or its name in sheets.json")
+    parser.add_argument('--worksheet', required=True, action='append', help="worksheet (tab) title; repeat for more")
+    parser.add_argument('--column', required=True, help="filename column: a letter, a number or a header")
+    parser.add_argument('--tree', required=True, help="directory tree to search")
+    parser.add_argument('--root', help="name of the tree index to use, e.g. a paths.json key (default: the tree's basename)")
+    parser.add_argument('--regex', help="significant pattern: when it matches a target, only files whose names contain the text it matched are considered")
+    parser.add_argument('--exclude', help="comma-separated file and folder name patterns to skip")
+    parser.add_argument('--max-depth', type=int, default=0, help="directory levels to search (0 for no limit)")
+    parser.add_argument('--resolve-numeric-ids', action='store_true', help="match names with an embedded numeric ID only against files with that ID")
+    parser.add_argument('--transcripts', action='store_true', help="also find and copy CSV, VTT, PDF or XML transcripts")
+    parser.add_argument('--copy-to-azure', action='store_true', help="copy accepted matches to Azure Blob Storage")
+    parser.add_argument('--blob-prefix', help="only list blobs starting with this prefix up front")
+    parser.add_argument('--thumbnails', action='store_true', help="make and upload thumbnails")
+    parser.add_argument('--smalls', action='store_true', help="make and upload small images")
+    parser.add_argument('--processing-mode', choices=['CollectionBuilder'], help="put the URLs found into the worksheet")
+    parser.add_argument('--save', action='store_true', help="write the changed cells back to the Google Sheet")
+    parser.add_argument('--offline', action='store_true', help="use only the worksheets in the local sheet cache")
+    parser.add_argument('--resume', action='store_true', help="skip the rows and uploads each worksheet's last run finished")
+    parser.add_argument('--output-csv', action='store_true', help="save matches to match-list.csv (match-list-<worksheet>.csv for several)")
+    parser.add_argument('--matching-workers', type=int, default=1)
+    parser.add_argument('--crawler-workers', type=int, default=WORKERS)
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS)
+    parser.add_argument('--derivative-workers', type=int, default=DERIVATIVE_WORKERS)
+
+    args = parser.parse_args( )
+    if args.save and (args.offline or not args.processing_mode):
+        parser.error("--save needs --processing-mode and can't be used --offline")
+    if (args.thumbnails or args.smalls) and not args.copy_to_azure:
+        parser.error("--thumbnails and --smalls need --copy-to-azure")
+    if args.regex:
+        try:
+            compile_significant(args.regex)
+        except re.error as e:
+            parser.error(f"--regex '{args.regex}' is not a valid pattern: {e}")
+
+    logger.remove( )
+    logger.add(sys.stderr, level="INFO")
+    sys.exit(run(args))
@@ -0,0 +1,250 @@
+# post_processor.py
+##
+## The per-row post-processing both streamlit_app.py and network_file_finder.py run over a worksheet's
+## matches, so a fix to one is a fix to both.  For each csv_line a PostProcessor:
+##   - accepts the best match if it scores 90 or more, or carries the target's numeric ID,
+##   - uploads it, and any transcript found with it, through an UploadPool, unless the run journal has
+##     them uploaded in the last run,
+##   - makes its thumbnail and/or small on a DerivativePool (or reuses them from the DerivativeCache,
+##     or from Azure if they were made from this version of the original) and uploads them from memory,
+##   - and puts the URLs into the worksheet's DirtyCells, in processing mode.
+##
+## Uploads and derivatives finish later, in row order, when their pools report them.  What happens is
+## passed to `report(event, **fields)`, which the app turns into messages and the command line into
+## JSON Lines.  Every event has the worksheet `row`; the events are:
+##   'skipped'      target, match, score... the best match scored too low to be accepted
+##   'error'        message... the match can't be uploaded, e.g. its name doesn't fit a blob URL
+##   'upload'       url, blob, container, result ("COPIED", "EXISTS" or False), message (if it failed)
+##   'derivative'   url, filename, container, result: 'MADE' (with bytes, if it's in memory), 'CACHED', 'EXISTS', 'REPLACE',
+##                  or 'UNSUPPORTED'/False (with source and message) if it couldn't be made
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import tempfile
+from file_matcher import check_numeric_part
+from azure_uploads import AZURE_BASE_URL, container_for, blob_url
+from derivatives import DERIVATIVES, IMAGE_EXTENSIONS, source_fingerprint
+from loguru import logger
+
+
+class PostProcessor:
+
+    # PostProcessor(uploads, derivative_pool, report, journal=None, dirty_cells=None, copy=True,
+    #               derivatives=( ), cache=None, on_disk=False, base_url=AZURE_BASE_URL)
+    # Post-process one worksheet's matches.  `derivatives` names the DERIVATIVES to make, `cache` is a
+    # DerivativeCache to keep them in, and `on_disk` writes those not cached to temporary files rather
+    # than keeping them in memory.  `dirty_cells` is None outside processing mode.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, uploads, derivative_pool, report, journal=None, dirty_cells=None, copy=True,
+                 derivatives=( ), cache=None, on_disk=False, base_url=AZURE_BASE_URL):
+        self.uploads = uploads
+        self.derivative_pool = derivative_pool
+        self.report = report
+        self.journal = journal
+        self.dirty_cells = dirty_cells
+        self.copy = copy
+        self.derivatives = [DERIVATIVES[name] for name in derivatives]
+        self.cache = cache
+        self.on_disk = on_disk
+        self.base_url = base_url
+        self.counts = {'copied': 0, 'exists': 0, 'skipped': 0, 'resumed': 0, 'failed': 0}
+
+    # set_cell(x, column, value) - Put `value` in the dataframe for worksheet row `x`, in processing mode
+    # ---------------------------------------------------------------------------------------
+    def set_cell(self, x, column, value):
+        if self.dirty_cells is not None:
+            self.dirty_cells.set(self.dirty_cells.df.index[x - 1], column, value)   # adjust for header row!
+
+    # process(line, transcript_dir=None)
+    # Upload one csv_line's match, its transcript and its derivatives.  The transcript is looked for
+    # in `transcript_dir`, or next to the match if that isn't known.
+    # ---------------------------------------------------------------------------------------
+    def process(self, line, transcript_dir=None):
+        (x, target, regex, score, match, path, transcript) = line
+        if not match:
+            return
+
+        # A match is accepted with a score of 90 or more, or an EXACT numeric ID
+        score = int(score)
+        if score > 49:
+            score = check_numeric_part(score, target, match)
+        if score < 90:
+            self.counts['skipped'] += 1
+            self.report('skipped', row=x, target=target, match=match, score=score)
+            return
+        try:
+            url = blob_url(match, base_url=self.base_url)
+        except ValueError as e:
+            self.counts['skipped'] += 1
+            self.report('error', row=x, message=str(e))
+            return
+
+        local_storage_path = os.path.join(path, match)
+        self.upload(x, url, match, local_storage_path, 'object_location')
+        if transcript:
+            try:
+                transcript_url = blob_url(transcript, 'TRANSCRIPT', self.base_url)
+            except ValueError as e:
+                transcript_url = None
+                self.report('error', row=x, message=str(e))
+            if transcript_url:
+                self.upload(x, transcript_url, transcript, os.path.join(transcript_dir or path, transcript), 'object_transcript',
+                            transcript=True)
+        if self.derivatives:
+            self.derive(x, url, local_storage_path)
+
+    # upload(x, url, blob, source, column, transcript=False, metadata=None, replace=False, on_done=None)
+    # Upload the file (or bytes) `source` for row `x` to `url`'s container, unless the journal has it
+    # already, and put `url` in `column`.  on_done(result) is called once it's finished.
+    # ---------------------------------------------------------------------------------------
+    def upload(self, x, url, blob, source, column, transcript=False, metadata=None, replace=False, on_done=None):
+        if not self.copy:
+            if on_done:
+                on_done(False)
+            return
+        previous = self.journal.upload_result(x, url) if self.journal else None
+        if previous:
+            self.counts['resumed'] += 1
+            self.uploaded(x, url, column, transcript, previous)
+            if on_done:
+                on_done(previous)
+            return
+
+        container = container_for(url, transcript)
+
+        def done(result, error):
+            if error:
+                self.counts['failed'] += 1
+                result = False
+            elif column == 'object_location':    # objects are counted, not transcripts or derivatives
+                self.counts['copied' if result == "COPIED" else 'exists'] += 1
+            if result and self.journal:
+                self.journal.record_upload(x, url, result)
+            self.report('upload', row=x, url=url, blob=blob, container=container, result=result,
+                        message=str(error) if error else None)
+            self.uploaded(x, url, column, transcript, result)
+            if on_done:
+                on_done(result)
+
+        self.uploads.submit(container, blob, source, done, metadata=metadata, replace=replace)
+
+    # uploaded(x, url, column, transcript, result) - Save a successful upload's URL to the dataframe
+    # ---------------------------------------------------------------------------------------
+    def uploaded(self, x, url, column, transcript, result):
+        if result:
+            self.set_cell(x, column, url)
+            if transcript:
+                self.set_cell(x, 'display_template', 'transcript')
+
+    # derive(x, url, local_storage_path)
+    # Make the derivatives of the original at `local_storage_path` from one reading of it, upload them
+    # and put their URLs in the dataframe.  Temporary files are removed once they're uploaded.
+    # ---------------------------------------------------------------------------------------
+    def derive(self, x, url, local_storage_path):
+        (root, ext) = os.path.splitext(os.path.basename(local_storage_path))
+        wanted = [ ]
+
+        for options in self.derivatives:
+            derivative_url = url.replace('/objs/', f"/{options['container']}/").replace(ext, options['suffix'])
+            filename = f"{root}{options['suffix']}"
+            container = container_for(derivative_url)
+            try:
+                fingerprint = source_fingerprint(local_storage_path, options)
+            except OSError:
+                fingerprint = None
+            derivative = {
+                'options': options,
+                'url': derivative_url,
+                'filename': filename,
+                'container': container,
+                'path': None,     # None while the derivative is only in memory, as 'data'
+                'data': None,
+                'temporary': False,
+                'fingerprint': fingerprint,
+                'replace': False,
+                'make': False,
+                'upload': False
+            }
+            wanted.append(derivative)
+
+            # If the run journal has this derivative uploaded in the last run, just put it back in the dataframe
+            if self.copy and self.journal and self.journal.upload_result(x, derivative_url):
+                self.counts['resumed'] += 1
+                continue
+
+            # If the container listing says the derivative is already there, and was made from this
+            # version of the original (or doesn't say what it was made from), don't make it again
+            inventory = self.uploads.inventory
+            if inventory is not None and inventory.exists(container, filename):
+                if inventory.metadata(container, filename).get('source_fingerprint') in (None, fingerprint):
+                    self.report('derivative', row=x, url=derivative_url, filename=filename, container=container, result='EXISTS')
+                    continue
+                self.report('derivative', row=x, url=derivative_url, filename=filename, container=container, result='REPLACE')
+                derivative['replace'] = True
+
+            derivative['upload'] = True
+
+            # Reuse a derivative made from this version of the original in an earlier run, or make one
+            cached = self.cache.get(fingerprint) if self.cache and fingerprint else None
+            if cached:
+                derivative['path'] = cached
+                self.report('derivative', row=x, url=derivative_url, filename=filename, container=container, result='CACHED')
+            else:
+                derivative['make'] = True
+                if self.cache and fingerprint:
+                    derivative['path'] = self.cache.path(fingerprint, options['suffix'])
+                elif self.on_disk:
+                    (handle, derivative['path']) = tempfile.mkstemp(prefix=f"{root}_", suffix=options['suffix'])
+                    os.close(handle)
+                    derivative['temporary'] = True
+
+        to_make = [derivative for derivative in wanted if derivative['make']]
+
+        # Only images and PDFs can be made into derivatives
+        if to_make and ext.lower( ) not in IMAGE_EXTENSIONS + ['.pdf']:
+            self.report('derivative', row=x, source=local_storage_path, result='UNSUPPORTED',
+                        message=f"Sorry, we can't create a thumbnail for '{local_storage_path}'")
+            for derivative in to_make:
+                derivative['url'] = False
+            to_make = [ ]
+
+        # remove_temporary(derivative) - Delete the temporary file a derivative was written to, if any
+        def remove_temporary(derivative):
+            if derivative['temporary']:
+                try:
+                    os.remove(derivative['path'])
+                except OSError as e:
+                    logger.warning(f"Could not remove temporary file '{derivative['path']}': {e}")
+
+        # Once the derivatives are made (in a worker process), upload them and save them to the dataframe
+        def made(results, error):
+            if not error:
+                for (derivative, data) in zip(to_make, results):
+                    derivative['data'] = data
+                    self.report('derivative', row=x, url=derivative['url'], filename=derivative['filename'],
+                                container=derivative['container'], result='MADE', bytes=len(data) if data is not None else None)
+            elif to_make:
+                self.report('derivative', row=x, source=local_storage_path, result=False,
+                            message=f"Derivatives of '{local_storage_path}' could not be created: {error}")
+                for derivative in to_make:
+                    derivative['url'] = False
+
+            for derivative in wanted:
+                derivative_url = derivative['url']
+
+                # Keep what was just made for next time
+                if derivative_url and derivative['make'] and self.cache and derivative['fingerprint']:
+                    self.cache.add(derivative['fingerprint'], derivative['path'])
+
+                if derivative_url and derivative['upload']:
+                    metadata = {'source_fingerprint': derivative['fingerprint']} if derivative['fingerprint'] else None
+                    source = derivative['data'] if derivative['path'] is None else derivative['path']
+                    self.upload(x, derivative_url, derivative['filename'], source, derivative['options']['column'],
+                                metadata=metadata, replace=derivative['replace'],
+                                on_done=lambda result, derivative=derivative: remove_temporary(derivative))
+                else:
+                    remove_temporary(derivative)
+                    if derivative_url:
+                        self.set_cell(x, derivative['options']['column'], derivative_url)
+
+        self.derivative_pool.submit(local_storage_path, [(derivative['options'], derivative['path']) for derivative in to_make], made)
@@ -0,0 +1,142 @@
+# run_journal.py
+##
+## A checkpoint journal so a search and post-processing run that dies part way through (a closed
+## browser tab, a dropped network mount) can pick up where it left off instead of starting over.
+##
+## A run is identified by the Google Sheet, worksheet, filename column and directory tree it works on,
+## and by the settings that decide what a row matches (--regex, numeric ID resolution, exclusions,
+## depth and transcripts), so rows matched under other settings are never resumed.
+## For each run the journal (one SQLite file, `run-journal.sqlite`) records:
+##   - every matched row's csv_line, as `fuzzy_search_for_files` built it
+##   - every successful upload, keyed by row and Azure URL, with its result ("COPIED" or "EXISTS")
+## Each record is committed as soon as it is made.  Starting a run without `resume` forgets anything
+## recorded for the same sheet/worksheet/column/tree; with `resume` the finished rows and uploads are
+## handed back so they can be skipped.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+JOURNAL = 'run-journal.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT PRIMARY KEY,
+    sheet TEXT,
+    worksheet TEXT,
+    column TEXT,
+    tree TEXT,
+    started REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS matches (
+    run TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    PRIMARY KEY (run, row)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    run TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (run, row, url)
+);
+"""
+
+
+# match_settings(regex=None, resolve_ids=False, exclude=( ), max_depth=None, transcripts=False)
+# The settings that change what a row matches, in one form however the app or the CLI was given them
+# ---------------------------------------------------------------------------------------
+def match_settings(regex=None, resolve_ids=False, exclude=( ), max_depth=None, transcripts=False):
+    return {'regex': regex or None, 'resolve_ids': bool(resolve_ids), 'exclude': sorted(exclude),
+            'max_depth': max_depth or None, 'transcripts': bool(transcripts)}
+
+
+# run_key(sheet, worksheet, column, tree, settings=None) - A short, stable key for one sheet/worksheet/column/tree and match_settings( )
+# ---------------------------------------------------------------------------------------
+def run_key(sheet, worksheet, column, tree, settings=None):
+    identity = [sheet, worksheet, column, os.path.normpath(tree) if tree else tree]
+    if settings:
+        identity.append(settings)
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest( )[:16]
+
+
+class RunJournal:
+
+    # RunJournal(db_path=JOURNAL) - Open (or create) the journal stored in `db_path`
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, db_path=JOURNAL):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock( )   # records may come from upload worker threads
+        self.key = None
+
+    def close(self):
+        self.db.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
+
+    # start(sheet, worksheet, column, tree, settings=None, resume=False)
+    # Begin recording the run for this sheet/worksheet/column/tree and match_settings( ).  Returns a
+    # dict holding the number of 'matches' and 'uploads' already recorded, which is zero unless `resume`
+    # is set.
+    # ---------------------------------------------------------------------------------------
+    def start(self, sheet, worksheet, column, tree, settings=None, resume=False):
+        self.key = run_key(sheet, worksheet, column, tree, settings)
+        now = time.time( )
+        with self.lock, self.db:
+            if not resume:
+                self.db.execute("DELETE FROM matches WHERE run = ?", (self.key,))
+                self.db.execute("DELETE FROM uploads WHERE run = ?", (self.key,))
+                self.db.execute("DELETE FROM runs WHERE key = ?", (self.key,))
+            self.db.execute("INSERT OR IGNORE INTO runs (key, sheet, worksheet, column, tree, started, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.key, sheet, worksheet, str(column), tree, now, now))
+            counts = { }
+            for table in ('matches', 'uploads'):
+                counts[table] = self.db.execute(f"SELECT COUNT(*) FROM {table} WHERE run = ?", (self.key,)).fetchone( )[0]
+        return counts
+
+    # completed_matches( ) - {row number: csv_line} for every row already matched in this run
+    # ---------------------------------------------------------------------------------------
+    def completed_matches(self):
+        with self.lock:
+            rows = self.db.execute("SELECT row, line FROM matches WHERE run = ?", (self.key,)).fetchall( )
+        return {row: json.loads(line) for (row, line) in rows}
+
+    # record_match(row, line) - Remember the csv_line matched for worksheet `row`
+    # ---------------------------------------------------------------------------------------
+    def record_match(self, row, line):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO matches (run, row, line) VALUES (?, ?, ?)",
+                            (self.key, row, json.dumps(line)))
+            self.touch( )
+
+    # upload_result(row, url) - The recorded result of uploading `url` for worksheet `row`, or None
+    # ---------------------------------------------------------------------------------------
+    def upload_result(self, row, url):
+        with self.lock:
+            found = self.db.execute("SELECT result FROM uploads WHERE run = ? AND row = ? AND url = ?",
+                                    (self.key, row, url)).fetchone( )
+        return found[0] if found else None
+
+    # record_upload(row, url, result) - Remember that `url` was uploaded (or already existed) for `row`
+    # ---------------------------------------------------------------------------------------
+    def record_upload(self, row, url, result):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO uploads (run, row, url, result) VALUES (?, ?, ?, ?)",
+                            (self.key, row, url, result))
+            self.touch( )
+
+    def touch(self):
+        self.db.execute("UPDATE runs SET updated = ? WHERE key = ?", (time.time( ), self.key))
@@ -0,0 +1,133 @@
+# service_clients.py
+##
+## Long-lived Google Sheets and Azure Blob Storage clients, shared across Streamlit reruns.
+##
+## Streamlit reruns the whole script on every widget change, and each rerun used to read the service
+## account file and authenticate a new gspread client, and each post-processing run set up a new
+## BlobServiceClient and its connections.  A CachedClient (held by `st.cache_resource` in the app)
+## creates its client once and hands the same one out until:
+##   - it's older than `max_age` seconds, or
+##   - a health check, made at most every `check_interval` seconds, fails.
+## Either way the next get( ) quietly creates a new one, so expired or rotated credentials are picked
+## up without restarting the app.
+##
+## Both clients talk HTTP through `requests`, whose connection pools keep only 10 connections per host
+## by default.  That's enough for Sheets, but UPLOAD_WORKERS uploads each staging BLOCK_CONCURRENCY
+## blocks at once need more, or connections are thrown away and re-opened (with a fresh TLS
+## handshake) all through a run.  So the Azure client gets a pool sized for that.
+## -----------------------------------------------------------------------------------------------------
+
+import time
+import threading
+import requests
+import gspread as gs
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import Request
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from azure_uploads import UPLOAD_WORKERS, BLOCK_CONCURRENCY, CONTAINERS
+from loguru import logger
+
+GOOGLE_POOL = 10                                        # connections kept open to the Sheets API
+AZURE_POOL = UPLOAD_WORKERS * (BLOCK_CONCURRENCY + 1)   # connections kept open to the storage account
+CHECK_INTERVAL = 300                                    # seconds between health checks of a cached client
+MAX_AGE = 12 * 3600                                     # seconds before a cached client is replaced anyway
+
+
+# pooled_session(pool_size, session=None) - `session` (or a new requests Session) keeping up to `pool_size` connections per host
+# ---------------------------------------------------------------------------------------
+def pooled_session(pool_size, session=None):
+    session = session or requests.Session( )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)    # Azurite
+    return session
+
+
+# google_client(pool_size=GOOGLE_POOL) - A gspread client authenticated with the default service account file
+# ---------------------------------------------------------------------------------------
+def google_client(pool_size=GOOGLE_POOL):
+    client = gs.service_account( )
+    pooled_session(pool_size, client.http_client.session)
+    return client
+
+
+# google_client_healthy(client) - True if the client's credentials are valid, refreshing them if they've expired
+# ---------------------------------------------------------------------------------------
+def google_client_healthy(client):
+    credentials = client.http_client.auth
+    if not credentials.valid:
+        credentials.refresh(Request( ))
+    return credentials.valid
+
+
+# azure_client(connection_string, pool_size=AZURE_POOL) - A BlobServiceClient with a connection pool of `pool_size`
+# ---------------------------------------------------------------------------------------
+def azure_client(connection_string, pool_size=AZURE_POOL):
+    transport = RequestsTransport(session=pooled_session(pool_size))
+    return BlobServiceClient.from_connection_string(connection_string, transport=transport)
+
+
+# azure_client_healthy(client, container=CONTAINERS[0])
+# True if the storage account answers with the client's credentials.  A container- or blob-scoped SAS
+# may not be allowed to read the container's properties, but any answer other than a failed
+# authentication (a 403 for a missing permission, a 404...) still means the account was reached with
+# credentials it accepts, so the client is kept.
+# ---------------------------------------------------------------------------------------
+def azure_client_healthy(client, container=CONTAINERS[0]):
+    try:
+        client.get_container_client(container).get_container_properties( )
+    except HttpResponseError as e:
+        if e.status_code == 401 or e.error_code == 'AuthenticationFailed':
+            raise
+    return True
+
+
+class CachedClient:
+
+    # CachedClient(create, healthy, check_interval=CHECK_INTERVAL, max_age=MAX_AGE)
+    # Hold the client create( ) returns.  healthy(client) returns False, or raises, if it must be replaced.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, create, healthy, check_interval=CHECK_INTERVAL, max_age=MAX_AGE):
+        self.create = create
+        self.healthy = healthy
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.client = None
+        self.created = 0
+        self.checked = 0
+        self.lock = threading.Lock( )   # shared by every session of the app
+
+    # get( ) - The cached client, or a new one if it was too old or failed its health check
+    # ---------------------------------------------------------------------------------------
+    def get(self):
+        with self.lock:
+            now = time.time( )
+            if self.client is not None and now - self.created > self.max_age:
+                self.discard( )
+            elif self.client is not None and now - self.checked > self.check_interval:
+                self.checked = now
+                try:
+                    healthy = self.healthy(self.client)
+                except Exception as e:
+                    logger.warning(f"Replacing {type(self.client).__name__} after a failed health check: {e}")
+                    healthy = False
+                if not healthy:
+                    self.discard( )
+
+            if self.client is None:
+                self.client = self.create( )
+                self.created = self.checked = now
+            return self.client
+
+    # reset( ) - Replace the client on the next get( ), e.g. after it was refused authentication
+    # ---------------------------------------------------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.discard( )
+
+    # discard( ) - Drop the client, without closing it, as another session may still be using it
+    # ---------------------------------------------------------------------------------------
+    def discard(self):
+        self.client = None
@@ -0,0 +1,229 @@
+# sheet_snapshots.py
+##
+## A short-lived cache of what the app reads from Google Sheets, so a run asks the Sheets API for each
+## thing once instead of on every Streamlit rerun.
+##
+## Choosing a sheet, worksheet and column, searching and post-processing used to open the spreadsheet
+## again and again and read the same worksheet piecemeal: `row_values(1)` for the headers,
+## `col_values(column)` for the filenames and `get_all_values( )` for the dataframe, with the filenames
+## also kept in `file-list.tmp` to save a call.  Now each worksheet is read with ONE `get_all_values( )`
+## into a WorksheetSnapshot, keyed by the sheet's URL and the worksheet's gid, and the header row, the
+## filename column and the dataframe are all derived from it.  Each spreadsheet's list of worksheets
+## is kept the same way, keyed by URL.
+##
+## Everything is re-read once it is older than `ttl` seconds, or straight away after invalidate( ),
+## e.g. when the sheet has been edited by hand or after post-processing has written to it.
+##
+## Given a SheetStore (see sheet_store.py), every worksheet list and worksheet read is also kept on
+## disk with the spreadsheet's revision.  "Re-reading" then starts with one Drive API call for the
+## spreadsheet's current revision, and only if it has changed since the stored copy was made (or can't
+## be had) is the worksheet fetched again.  With `offline` set nothing is fetched at all: the stored copies are used
+## as they are, so the search and post-processing can run again, complete with the dataframe for
+## processing mode, without touching the Google APIs.
+##
+## Edits are written back by row position (see DirtyCells in sheet_updates.py), so before they're saved
+## moved( ) checks that the worksheet's rows are still where the snapshot had them.  A run that will
+## save asks for a `fresh` snapshot, so it starts from the sheet as it is rather than one up to `ttl`
+## seconds old.
+## -----------------------------------------------------------------------------------------------------
+
+import time
+import threading
+import requests
+import pandas as pd
+from gspread.exceptions import GSpreadException
+from loguru import logger
+
+SNAPSHOT_TTL = 600    # seconds before a worksheet (or worksheet list) is read, or revalidated, again
+
+
+class WorksheetSnapshot:
+
+    # WorksheetSnapshot(values, revision=None, fetched=None)
+    # Everything in a worksheet, as get_all_values( ) returned it when the spreadsheet was at `revision`
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, values, revision=None, fetched=None):
+        self.values = values
+        self.revision = revision
+        self.fetched = fetched or time.time( )
+        self.checked = time.time( )   # when it was last known to be current
+
+    # headers( ) - The worksheet's first row
+    # ---------------------------------------------------------------------------------------
+    def headers(self):
+        return list(self.values[0]) if self.values else [ ]
+
+    # column(number) - Column `number` ('A' = 1) from the top, to its last non-blank cell, like col_values( )
+    # ---------------------------------------------------------------------------------------
+    def column(self, number):
+        cells = [row[number - 1] if len(row) >= number else '' for row in self.values]
+        while cells and not cells[-1]:
+            cells.pop( )
+        return cells
+
+    # dataframe( ) - The rows below the header as a new DataFrame, with the header row as its columns
+    # ---------------------------------------------------------------------------------------
+    def dataframe(self):
+        return pd.DataFrame([list(row) for row in self.values[1:]], columns=self.headers( ))
+
+
+class WorksheetSnapshots:
+
+    # WorksheetSnapshots(open_sheet, revision=None, store=None, ttl=SNAPSHOT_TTL)
+    # `open_sheet(url)` returns a gspread Spreadsheet and `revision(url)` its current Drive modifiedTime.
+    # `store` is a SheetStore to keep what's read in.
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, open_sheet, revision=None, store=None, ttl=SNAPSHOT_TTL):
+        self.open_sheet = open_sheet
+        self.revision = revision
+        self.store = store
+        self.ttl = ttl
+        self.sheets = { }       # url: (checked, {title: gid})
+        self.opened = { }       # url: {title: gspread Worksheet}
+        self.revisions = { }    # url: (checked, revision)
+        self.snapshots = { }    # (url, gid): WorksheetSnapshot
+        self.lock = threading.Lock( )   # shared by every session of the app
+
+    def fresh(self, checked):
+        return time.time( ) - checked < self.ttl
+
+    # current_revision(url)
+    # The spreadsheet's revision, asked for at most once every `ttl` seconds.  The Drive API isn't
+    # needed to read a sheet, so if it can't be asked (not enabled, 403, network) the revision is None,
+    # unknown, and worksheets are simply fetched again.
+    # ---------------------------------------------------------------------------------------
+    def current_revision(self, url):
+        if not self.revision:
+            return None
+        with self.lock:
+            cached = self.revisions.get(url)
+        if cached and self.fresh(cached[0]):
+            return cached[1]
+
+        try:
+            revision = self.revision(url)
+        except (GSpreadException, requests.RequestException, KeyError) as e:
+            logger.warning(f"Could not get the revision of '{url}' from the Drive API: {e}")
+            revision = None
+        with self.lock:
+            self.revisions[url] = (time.time( ), revision)
+        return revision
+
+    # worksheets(url, offline=False) - {title: gid} for every worksheet of the spreadsheet at `url`
+    # ---------------------------------------------------------------------------------------
+    def worksheets(self, url, offline=False):
+        with self.lock:
+            cached = self.sheets.get(url)
+        if cached and (offline or self.fresh(cached[0])):
+            return cached[1]
+
+        stored = self.store.worksheets(url) if self.store else None
+        if offline:
+            if stored is None:
+                raise LookupError(f"The worksheets of '{url}' aren't in the local sheet cache yet")
+            worksheets = stored[2]
+            checked = 0    # so the next online call revalidates it
+        else:
+            revision = self.current_revision(url)
+            if stored and revision and stored[0] == revision:
+                worksheets = stored[2]
+            else:
+                with self.lock:
+                    self.opened.pop(url, None)    # worksheets may have been added, renamed or removed
+                worksheets = {title: worksheet.id for (title, worksheet) in self.open(url).items( )}
+                if self.store:
+                    self.store.save_worksheets(url, revision, worksheets)
+            checked = time.time( )
+
+        with self.lock:
+            self.sheets[url] = (checked, worksheets)
+        return worksheets
+
+    # open(url) - {title: gspread Worksheet} for the spreadsheet at `url`, opening it if it isn't already
+    # ---------------------------------------------------------------------------------------
+    def open(self, url):
+        with self.lock:
+            opened = self.opened.get(url)
+        if opened is None:
+            opened = {worksheet.title: worksheet for worksheet in self.open_sheet(url).worksheets( )}
+            with self.lock:
+                self.opened[url] = opened
+        return opened
+
+    # worksheet(url, title) - The gspread Worksheet called `title`, for writing to; always goes online
+    # ---------------------------------------------------------------------------------------
+    def worksheet(self, url, title):
+        if title not in self.open(url):
+            with self.lock:
+                self.opened.pop(url, None)    # maybe it's been added since
+        return self.open(url)[title]
+
+    # snapshot(url, title, offline=False, fresh=False)
+    # A WorksheetSnapshot of the worksheet called `title` in the spreadsheet at `url`.  With `fresh` set
+    # (and online) any snapshot read before is revalidated first, whatever its age.
+    # ---------------------------------------------------------------------------------------
+    def snapshot(self, url, title, offline=False, fresh=False):
+        gid = self.worksheets(url, offline)[title]
+        if fresh and not offline:
+            self.invalidate(url, gid)
+        key = (url, gid)
+        with self.lock:
+            cached = self.snapshots.get(key)
+        if cached and (offline or self.fresh(cached.checked)):
+            return cached
+
+        stored = self.store.load(url, gid) if self.store else None
+        if offline:
+            if stored is None:
+                raise LookupError(f"Worksheet '{title}' of '{url}' isn't in the local sheet cache yet")
+            snapshot = WorksheetSnapshot(stored[2], revision=stored[0], fetched=stored[1])
+            snapshot.checked = 0    # so the next online call revalidates it
+        else:
+            revision = self.current_revision(url)
+            if stored and revision and stored[0] == revision:
+                self.store.touch(url, gid)
+                snapshot = WorksheetSnapshot(stored[2], revision=revision, fetched=stored[1])
+            else:
+                snapshot = WorksheetSnapshot(self.worksheet(url, title).get_all_values( ), revision=revision)
+                if self.store:
+                    self.store.save(url, gid, title, revision, snapshot.values)
+
+        with self.lock:
+            self.snapshots[key] = snapshot
+        return snapshot
+
+    # moved(url, title, snapshot, column)
+    # True if the rows of worksheet `title` may no longer be where `snapshot` has them.  If the
+    # spreadsheet's revision is still the snapshot's they can't have moved; otherwise (an edit anywhere
+    # in the spreadsheet, or a revision that couldn't be had) the worksheet's `column` is read again and
+    # compared with the snapshot's, so rows inserted, deleted or sorted since are caught.
+    # ---------------------------------------------------------------------------------------
+    def moved(self, url, title, snapshot, column):
+        with self.lock:
+            self.revisions.pop(url, None)
+        revision = self.current_revision(url)
+        if revision and revision == snapshot.revision:
+            return False
+        return self.worksheet(url, title).col_values(column) != snapshot.column(column)
+
+    # invalidate(url=None, gid=None)
+    # Forget the snapshot of worksheet `gid` in the spreadsheet at `url`, or with no `gid` everything
+    # read from that spreadsheet, or with no `url` everything at all.  Copies in the store are kept, but
+    # are checked against the spreadsheet's revision before they're used again.
+    # ---------------------------------------------------------------------------------------
+    def invalidate(self, url=None, gid=None):
+        with self.lock:
+            if url is None:
+                self.sheets.clear( )
+                self.opened.clear( )
+                self.revisions.clear( )
+                self.snapshots.clear( )
+            else:
+                self.revisions.pop(url, None)
+                if gid is None:
+                    self.sheets.pop(url, None)
+                    self.opened.pop(url, None)
+                    for key in [key for key in self.snapshots if key[0] == url]:
+                        del self.snapshots[key]
+                else:
+                    self.snapshots.pop((url, gid), None)
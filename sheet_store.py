@@ -0,0 +1,93 @@
+# sheet_store.py
+##
+## A local copy of every Google worksheet the app has read, so a later run can work from it with no
+## Sheets API calls at all, or check with one cheap Drive API call that it's still current.
+##
+## One SQLite file, `sheet-cache.sqlite`, holds:
+##   - for each spreadsheet URL, its worksheets' titles and gids
+##   - for each worksheet, keyed by URL and gid, everything `get_all_values( )` returned (every column,
+##     header row included, as JSON)
+## each with the time it was fetched and the spreadsheet's revision at the time, its Drive
+## `modifiedTime`.  While the spreadsheet's `modifiedTime` is unchanged the stored copy is as good as
+## a fresh read (see WorksheetSnapshots in sheet_snapshots.py).
+## -----------------------------------------------------------------------------------------------------
+
+import json
+import time
+import sqlite3
+import threading
+
+SHEET_CACHE = 'sheet-cache.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    url TEXT PRIMARY KEY,
+    revision TEXT,
+    fetched REAL,
+    worksheets TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS worksheets (
+    url TEXT NOT NULL,
+    gid INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    revision TEXT,
+    fetched REAL,
+    cells TEXT NOT NULL,
+    PRIMARY KEY (url, gid)
+);
+"""
+
+
+class SheetStore:
+
+    # SheetStore(db_path=SHEET_CACHE) - Open (or create) the store kept in `db_path`
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, db_path=SHEET_CACHE):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock( )   # shared by every session of the app
+
+    def close(self):
+        self.db.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
+
+    # save_worksheets(url, revision, worksheets) - Remember the {title: gid} worksheets of the spreadsheet at `url`
+    # ---------------------------------------------------------------------------------------
+    def save_worksheets(self, url, revision, worksheets):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO sheets (url, revision, fetched, worksheets) VALUES (?, ?, ?, ?)",
+                            (url, revision, time.time( ), json.dumps(worksheets)))
+
+    # worksheets(url) - (revision, fetched, {title: gid}) as last saved for the spreadsheet at `url`, or None
+    # ---------------------------------------------------------------------------------------
+    def worksheets(self, url):
+        with self.lock:
+            found = self.db.execute("SELECT revision, fetched, worksheets FROM sheets WHERE url = ?", (url,)).fetchone( )
+        return (found[0], found[1], json.loads(found[2])) if found else None
+
+    # save(url, gid, title, revision, values) - Remember the `values` of worksheet `gid`, all its rows and columns
+    # ---------------------------------------------------------------------------------------
+    def save(self, url, gid, title, revision, values):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO worksheets (url, gid, title, revision, fetched, cells) VALUES (?, ?, ?, ?, ?, ?)",
+                            (url, gid, title, revision, time.time( ), json.dumps(values)))
+
+    # load(url, gid) - (revision, fetched, values) as last saved for worksheet `gid`, or None
+    # ---------------------------------------------------------------------------------------
+    def load(self, url, gid):
+        with self.lock:
+            found = self.db.execute("SELECT revision, fetched, cells FROM worksheets WHERE url = ? AND gid = ?",
+                                    (url, gid)).fetchone( )
+        return (found[0], found[1], json.loads(found[2])) if found else None
+
+    # touch(url, gid) - Note that worksheet `gid` was found to be current just now
+    # ---------------------------------------------------------------------------------------
+    def touch(self, url, gid):
+        with self.lock, self.db:
+            self.db.execute("UPDATE worksheets SET fetched = ? WHERE url = ? AND gid = ?", (time.time( ), url, gid))
@@ -0,0 +1,125 @@
+# sheet_updates.py
+##
+## Writing post-processing results back to the Google worksheet.
+##
+## `post_processing` only ever changes a handful of columns (`object_location`, `object_transcript`,
+## `image_thumb`, `image_small` and `display_template`), yet `set_with_dataframe( )` rewrote every cell
+## of the worksheet, which is slow on large sheets and eats into the Sheets API quota.  Instead, every
+## edit of the worksheet dataframe goes through a DirtyCells, which makes the edit and remembers the
+## cell if its value actually changed.  flush( ) then sends only those cells, merged into runs of
+## consecutive rows in the same column, with as few `batch_update` requests as the MAX_CELLS and
+## MAX_CHARS limits on each request allow.
+##
+## The dataframe's columns are the worksheet's header row and its rows start on worksheet row 2.  A
+## column the dataframe didn't have (e.g. `image_small` on an older sheet) is added after the last one,
+## as set_with_dataframe( ) would have done, and its header cell is written along with its values.
+## -----------------------------------------------------------------------------------------------------
+
+import pandas as pd
+from gspread.utils import rowcol_to_a1
+
+MAX_CELLS = 10000            # cells per batch_update request
+MAX_CHARS = 1000000          # characters of cell values per batch_update request, well under the API's payload limit
+VALUE_INPUT = 'USER_ENTERED'  # as set_with_dataframe( ) sends them
+
+
+class DirtyCells:
+
+    # DirtyCells(df) - Track the edits made to `df`, a dataframe of the worksheet below its header row
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, df):
+        self.df = df
+        self.headers = list(df.columns)   # the columns the worksheet already has
+        self.cells = set( )               # (row label, column name)
+
+    # set(row, column, value) - Put `value` in the dataframe at `row` (a label), `column` and remember it if it changed
+    # ---------------------------------------------------------------------------------------
+    def set(self, row, column, value):
+        if column in self.df.columns and self.df.at[row, column] == value:
+            return
+        self.df.at[row, column] = value
+        self.cells.add((row, column))
+
+    # ranges( ) - The changed cells as a list of {'range': A1 range, 'values': [[value], ...]}, one per run of rows
+    # ---------------------------------------------------------------------------------------
+    def ranges(self):
+        columns = {name: number + 1 for (number, name) in enumerate(self.df.columns)}
+        by_column = { }
+        for (row, column) in self.cells:
+            by_column.setdefault(column, [ ]).append(self.df.index.get_loc(row) + 2)   # header is row 1
+
+        ranges = [ ]
+        for (column, rows) in sorted(by_column.items( ), key=lambda item: columns[item[0]]):
+            col = columns[column]
+            if column not in self.headers:
+                ranges.append({'range': rowcol_to_a1(1, col), 'values': [[column]]})
+            rows.sort( )
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i] != rows[i - 1] + 1:
+                    values = [[self.value(rows[n] - 2, column)] for n in range(start, i)]
+                    ranges.append({'range': f"{rowcol_to_a1(rows[start], col)}:{rowcol_to_a1(rows[i - 1], col)}",
+                                   'values': values})
+                    start = i
+        return ranges
+
+    # value(position, column) - The worksheet value of the dataframe cell at row `position`, with NaN as blank
+    # ---------------------------------------------------------------------------------------
+    def value(self, position, column):
+        value = self.df[column].iat[position]
+        return '' if pd.isna(value) else value
+
+    # batches(max_cells=MAX_CELLS, max_chars=MAX_CHARS) - Split ranges( ) into lists small enough for one request each
+    # ---------------------------------------------------------------------------------------
+    def batches(self, max_cells=MAX_CELLS, max_chars=MAX_CHARS):
+        batch = [ ]
+        (cells, chars) = (0, 0)
+        for update in self.ranges( ):
+
+            # A run longer than a whole request is sent a piece at a time
+            pieces = [update] if len(update['values']) <= max_cells else split_range(update, max_cells)
+
+            for piece in pieces:
+                size = len(piece['values'])
+                length = sum(len(str(row[0])) for row in piece['values'])
+                if batch and (cells + size > max_cells or chars + length > max_chars):
+                    yield batch
+                    batch = [ ]
+                    (cells, chars) = (0, 0)
+                batch.append(piece)
+                cells += size
+                chars += length
+        if batch:
+            yield batch
+
+    # flush(worksheet, max_cells=MAX_CELLS, max_chars=MAX_CHARS)
+    # Write the changed cells to `worksheet` and forget them.  Returns the number of cells written.
+    # ---------------------------------------------------------------------------------------
+    def flush(self, worksheet, max_cells=MAX_CELLS, max_chars=MAX_CHARS):
+        if not self.cells:
+            return 0
+
+        # Make room for any new columns first
+        missing = len(self.df.columns) - worksheet.col_count
+        if missing > 0:
+            worksheet.add_cols(missing)
+
+        written = 0
+        for batch in self.batches(max_cells, max_chars):
+            worksheet.batch_update(batch, value_input_option=VALUE_INPUT)
+            written += sum(len(update['values']) for update in batch)
+
+        self.headers = list(self.df.columns)
+        self.cells.clear( )
+        return written
+
+
+# split_range(update, size) - Split one single-column {'range', 'values'} update into pieces of at most `size` rows
+# ---------------------------------------------------------------------------------------
+def split_range(update, size):
+    (first, last) = update['range'].split(':')
+    column = first.rstrip('0123456789')
+    start = int(first[len(column):])
+    values = update['values']
+    return [{'range': f"{column}{start + n}:{column}{start + min(n + size, len(values)) - 1}",
+             'values': values[n:n + size]} for n in range(0, len(values), size)]
@@ -19,30 +19,37 @@
 ## -----------------------------------------------------------------------------------------------------
 
 import os
+import re
 import streamlit as st
 import json
-import gspread as gs
-from gspread_dataframe import set_with_dataframe
-import re
-import csv
 import shutil
-from fuzzywuzzy import process
+import time
+from file_matcher import FileMatcher, SignificantFilter, match_rows, compile_significant
+from tree_index import TreeIndex, tree_index_path, WORKERS
+from file_catalog import FileCatalog
+from match_list import MatchListWriter
+from run_journal import RunJournal, match_settings
+from file_hashes import HashCache
+from sheet_updates import DirtyCells
+from sheet_snapshots import WorksheetSnapshots, SNAPSHOT_TTL
+from sheet_store import SheetStore
+from gspread.utils import extract_id_from_url
+from service_clients import CachedClient, google_client, google_client_healthy, azure_client, azure_client_healthy
+from azure_uploads import UploadPool, BlobInventory, UPLOAD_WORKERS, BLOCK_SIZE, MAX_BLOCK_SIZE, BLOCK_CONCURRENCY, LARGE_FILE, AZURE_BASE_URL
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
 import pandas as pd
-from thumbnail import generate_thumbnail
-from wand.image import Image
+from derivatives import DerivativePool, DERIVATIVE_WORKERS
+from post_processor import PostProcessor
+from derivative_cache import DerivativeCache, CACHE_BYTES
 from loguru import logger
 # from streamlit.logger import get_logger
-from subprocess import call
 
 # Globals
 
-azure_base_url = "https://dgobjects.blob.core.windows.net/"
+azure_base_url = AZURE_BASE_URL
 column = 7     # Default column for filenames is 'G' = 7
 skip_rows = 1  # Default number of header rows to skip = 1
 levehstein_ratio = 90
-significant = False
 kept_file_list = False
 copy_to_azure = False
 extended = False
@@ -50,11 +57,6 @@ grinnell = False
 use_match_list = False
 counter = 0
 csvlines = [ ]
-big_file_list = [ ]   # need a list of just filenames...
-big_path_list = [ ]   # ...and parallel list of just the paths
-significant_file_list = [ ]
-significant_path_list = [ ]
-significant_dict = { }
 sheet_url = False
 
 # Functions defined and used in https://gist.github.com/benlansdell/44000c264d1b373c77497c0ea73f0ef2
@@ -95,100 +97,70 @@ def st_file_selector(st_placeholder, path, label='Select a file/folder', key='di
 # ---------------------------------------------------------------------
 
 
-# upload_to_azure( ) - Just what the name says post-processing
+# report_post_processing(event, **fields)
+# Show and log what the PostProcessor reports for a worksheet row: 'skipped', 'error', 'upload' or
+# 'derivative', as described in post_processor.py.
 # ----------------------------------------------------------------------------------------------
-def upload_to_azure(blob_service_client, url, match, local_storage_path, transcript=False):
-
-    try:
+def report_post_processing(event, **fields):
 
-        if transcript:
-            container_name = "transcripts"
-        elif "thumbs/" in url:
-            container_name = "thumbs"
-        elif "smalls/" in url:
-            container_name = "smalls"
-        else:
-            container_name = "objs"
-
-        # Create a blob client using the local file name as the name for the blob
-        if container_name:
-            blob_client = blob_service_client.get_blob_client(
-                container=container_name, blob=match)
-            if blob_client.exists():
-                txt = f"Blob '{match}' already exists in Azure Storage container '{container_name}'.  Skipping this upload."
-                st.success(txt)
-                state('logger').success(txt)
-                return "EXISTS"
-            else:
-                txt = f"Uploading '{match}' to Azure Storage container '{container_name}'"
-                st.success(txt)
-                state('logger').success(txt)
+    if event == 'skipped':
+        txt = f"Best match for '{fields['target']}' has an insufficient match score of {fields['score']}.  It will NOT be accepted nor copied to Azure storage."
+        st.warning(txt)
+        state('logger').warning(txt)
 
-                # Upload the file
-                with open(file=local_storage_path, mode="rb") as data:
-                    blob_client.upload_blob(data)
-                return "COPIED"
+    elif event == 'error':
+        st.error(fields['message'])
+        state('logger').error(fields['message'])
 
-        else:
-            txt = f"No container available for uploading '{match}' to Azure Storage!'"
+    elif event == 'upload':
+        if not fields['result']:
+            txt = f"Upload of '{fields['blob']}' to Azure Storage container '{fields['container']}' failed: {fields['message']}"
             st.error(txt)
-            state('logger').error(txt)
-            return False
-
-    except Exception as ex:
-        state('logger').critical(ex)
-        st.exception(ex)
-        pass
-
-
-# check_significant(regex, filename)
-# ---------------------------------------------------------------------------------------
-def check_significant(regex, filename):
-    import re
-
-    if '(' in regex:             # regex already has a (group), do not add one
-        pattern = regex
-    else:
-        pattern = f"({regex})"     # regex is raw, add a (group) pair of parenthesis
-
-    try:
-        match = re.search(pattern, filename)
-        if match:
-            return match.group( )
+            state('logger').critical(txt)
+        elif fields['result'] == "EXISTS":
+            txt = f"Blob '{fields['blob']}' already exists in Azure Storage container '{fields['container']}'.  Skipping this upload."
+            st.success(txt)
+            state('logger').success(txt)
         else:
-            return False
-    except Exception as e:
-        assert False, f"Exception: {e}"
-
+            txt = f"Uploaded '{fields['blob']}' to Azure Storage container '{fields['container']}'"
+            st.success(txt)
+            state('logger').success(txt)
 
-# build_lists_and_dict(significant, target, files_list, paths_list)
-# ---------------------------------------------------------------------------------------
-def build_lists_and_dict(significant, target, files_list, paths_list):
-    significant_file_list = []
-    significant_path_list = []
-    significant_match = False
-    is_significant = "*"
+    elif event == 'derivative':
+        result = fields['result']
+        if result == 'EXISTS':
+            txt = f"Blob '{fields['filename']}' already exists in Azure Storage container '{fields['container']}'.  Skipping this derivative."
+            st.success(txt)
+            state('logger').success(txt)
+        elif result == 'REPLACE':
+            txt = f"Blob '{fields['filename']}' in Azure Storage container '{fields['container']}' was made from a different version of its original.  It will be replaced."
+            st.warning(txt)
+            state('logger').warning(txt)
+        elif result == 'CACHED':
+            state('logger').info(f"Reusing cached derivative '{fields['filename']}'")
+        elif result == 'MADE':
+            state('logger').info(f"Created derivative '{fields['filename']}'")
+        elif result == 'UNSUPPORTED':
+            st.warning(fields['message'])
+            state('logger').warning(fields['message'])
+        else:
+            st.error(fields['message'])
+            state('logger').error(fields['message'])
 
-    # If a --regex (significant) was specified see if our target has a matching component...
-    if significant:
-        significant_match = check_significant(significant, target)
-        if significant_match:   # ...it does, pare the significant_*_list down to only significant matches
-            for i, f in enumerate(files_list):
-                is_significant = check_significant(significant_match, f)
-            if is_significant:
-                significant_file_list.append(f)
-                significant_path_list.append(paths_list[i])
 
-    # If there's no significant_match... make the output lists match the input lists
-    if not significant_match:
-        significant_file_list = files_list
-        significant_path_list = paths_list
+# google_clients( ) - The gspread client, kept across Streamlit reruns and re-created when it goes stale
+# --------------------------------------------------------------
+@st.cache_resource
+def google_clients( ):
+    return CachedClient(google_client, google_client_healthy)
 
-    # Now, per https://github.com/seatgeek/fuzzywuzzy/issues/165 build an indexed dict of significant files
-    file_dict = {idx: el for idx, el in enumerate(significant_file_list)}
 
-    # Return a tuple of significant match and the three significant lists
-    return (significant_match, significant_file_list, significant_path_list, file_dict)
+# azure_clients(connect_str) - The BlobServiceClient for `connect_str`, kept across Streamlit reruns
+# and re-created when it goes stale.  A new connection string (e.g. a rotated key) gets a new client.
+# --------------------------------------------------------------
+@st.cache_resource
+def azure_clients(connect_str):
+    return CachedClient(lambda: azure_client(connect_str), azure_client_healthy)
 
 
 # open_google_sheet(sheet_url)
@@ -196,7 +168,7 @@ def build_lists_and_dict(significant, target, files_list, paths_list):
 def open_google_sheet(sheet_url):
 
     try:
-        sa = gs.service_account()
+        sa = google_clients( ).get( )
     except Exception as e:
         state('logger').critical(e)
         st.exception(e)
@@ -204,6 +176,7 @@ def open_google_sheet(sheet_url):
     try:
         sh = sa.open_by_url(sheet_url)
     except Exception as e:
+        google_clients( ).reset( )    # in case it was the client's credentials at fault
         state('logger').critical(e)
         st.exception(e)
 
@@ -214,20 +187,44 @@ def open_google_sheet(sheet_url):
 # --------------------------------------------------------------
 def open_google_worksheet(sheet_url, worksheet_title):
 
-    sh = open_google_sheet(sheet_url)
-
-    # Open the specified worksheet (tab) and return it
-    worksheet = sh.worksheet(worksheet_title)
+    # Find the specified worksheet (tab) in the (already open) sheet and return it
+    worksheet = sheet_snapshots( ).worksheet(sheet_url, worksheet_title)
     return worksheet
 
 
+# google_sheet_revision(sheet_url) - The sheet's Drive `modifiedTime`, which changes with every edit
+# --------------------------------------------------------------
+def google_sheet_revision(sheet_url):
+    metadata = google_clients( ).get( ).http_client.get_file_drive_metadata(extract_id_from_url(sheet_url))
+    return metadata['modifiedTime']
+
+
+# sheet_snapshots( )
+# What's been read from Google Sheets, shared across Streamlit reruns and kept in 'sheet-cache.sqlite'.
+# It's revalidated after SNAPSHOT_TTL seconds, or sooner with the sidebar's re-read button.
+# --------------------------------------------------------------
+@st.cache_resource
+def sheet_snapshots( ):
+    return WorksheetSnapshots(open_google_sheet, revision=google_sheet_revision, store=SheetStore( ), ttl=SNAPSHOT_TTL)
+
+
+# load_catalog(index_path, path, generation)
+# Load the catalog of files under `path` from the tree index and build its matcher and filter.  Cached
+# across Streamlit reruns; `generation` changes whenever the index does, so stale catalogs aren't reused.
+# --------------------------------------------------------------------------------------
+@st.cache_resource(max_entries=2, show_spinner="Loading the file catalog...")
+def load_catalog(index_path, path, generation):
+    with TreeIndex(index_path) as tree_index:
+        catalog = FileCatalog.from_records(tree_index.files(path))
+    return (catalog, FileMatcher(catalog), SignificantFilter(catalog))
+
+
 # fuzzy-search-for-files(status)
 # All parameters come from st.session_state...
 # --------------------------------------------------------------------------------------
 def fuzzy_search_for_files(status):
 
     # Get st.session_state parameters
-    kept_file_list = state('use_previous_file_list')
     sheet_url = state('google_sheet_url')
     worksheet_title = state('google_worksheet_selection')
     column = state('worksheet_column_number')
@@ -237,73 +234,63 @@ def fuzzy_search_for_files(status):
     csvlines =  [ ]
     counter = 0
     filenames = [ ]
+    resolved = {'exact': 0, 'case-insensitive': 0, 'numeric ID': 0, 'fuzzy': 0}
+    st.session_state['transcript_dirs'] = { }
 
-    # Check the --kept-file-list switch.  If it is True then attempt to open the `file-list.tmp` file
-    # saved from a previous run.  The intent is to cut-down on Google API calls.
-    if kept_file_list:
-        try:
-            with open('file-list.tmp', 'r') as file_list:
-                for filename in file_list:
-                    if filename:
-                        filenames.append(filename.strip())
-                    else:
-                        filenames.append("")
-
-        except Exception as e:
-            kept_file_list = False
-            pass
-
-        # If processing_mode is selected, issue an apology... can't do that
-        # unless a Google Sheet is specified.
-
-        if state('processing_mode'):
-            txt = f"Sorry, we can't write to your Google Sheet if you don't select one for processing."
-            st.warning(txt)
-            state('logger').warning(txt)
-
-    # If we aren't using a kept file list... Open the Google service account and sheet
-    else:
-
-        worksheet = open_google_worksheet(sheet_url, worksheet_title)
-
-        # Grab all filenames from --column
-        filenames = worksheet.col_values(column)
-
-        # Save the filename list in 'file-list.tmp' for later
-        try:
-            with open('file-list.tmp', 'w') as file_list:
-                for filename in filenames:
-                    file_list.write(f"{filename}\n")
-        except Exception as e:
-            state('logger').critical(e)
-            st.exception(e)
-            exit( )
-
-        # If processing_mode is selected, copy the contents of the Google Sheet into a dataframe
-        # so we can post updates/additions to the sheet without calling the Google API too many times.
-
-        if state('processing_mode'):
-            data = worksheet.get_all_values( )
-            headers = data.pop(0)
-            st.session_state['df'] = pd.DataFrame(data, columns=headers)
-
-    # Grab all non-hidden filenames from the target directory tree so we only have to get the list once
-    # Exclusion of dot files per https://stackoverflow.com/questions/13454164/os-walk-without-hidden-folders
-
-    for root, dirs, files in os.walk(path):
-        files = [f for f in files if not f[0] == '.']
-        dirs[:] = [d for d in dirs if not d[0] == '.']
-        for filename in files:
-            big_path_list.append(root)
-            big_file_list.append(filename)
-
-    # Check for ZERO network files in the big_file_list
-    if len(big_file_list) == 0:
+    # Read the worksheet once, or reuse what was read in the last SNAPSHOT_TTL seconds (or whatever
+    # copy is in the sheet cache, working offline), and take the filenames from --column.  If the
+    # results are to be saved to the sheet, start from the sheet as it is now.
+    saving = state('processing_mode') and state('save_dataframe') and not state('sheets_offline')
+    try:
+        snapshot = sheet_snapshots( ).snapshot(sheet_url, worksheet_title, offline=state('sheets_offline'), fresh=saving)
+    except LookupError as e:
+        st.error(f"{e}; untick 'work offline' to read it from Google")
+        st.stop( )
+    filenames = snapshot.column(column)
+
+    if state('sheets_offline'):
+        txt = f"Working offline from the copy of worksheet '{worksheet_title}' cached at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.fetched))}"
+        st.info(txt)
+        state('logger').info(txt)
+
+    # If processing_mode is selected, copy the contents of the Google Sheet into a dataframe
+    # so we can post updates/additions to the sheet without calling the Google API too many times.
+
+    if state('processing_mode'):
+        st.session_state['df'] = snapshot.dataframe( )
+        st.session_state['dirty_cells'] = DirtyCells(st.session_state['df'])
+        st.session_state['df_snapshot'] = snapshot
+
+    # Grab all non-hidden filenames from the target directory tree so we only have to get the list once.
+    # The tree index remembers the listing between runs and only re-lists directories that have changed.
+
+    index_path = tree_index_path(state('root_directory_selection'))
+    with TreeIndex(index_path) as tree_index:
+        exclude = [pattern.strip( ) for pattern in (state('exclude_globs') or '').split(',') if pattern.strip( )]
+        refreshed = tree_index.refresh(path, workers=state('crawler_workers') or WORKERS,
+                                       max_depth=state('max_depth') or None, exclude=exclude)
+        generation = tree_index.generation( )
+
+    txt = f"Tree index for '{path}' refreshed: {refreshed['rescanned']} directories re-listed, {refreshed['unchanged']} unchanged"
+    if refreshed['unlisted']:
+        txt += f", {refreshed['unlisted']} could NOT be listed and keep their previous contents"
+    st.info(txt)
+    state('logger').info(txt)
+
+    # The catalog and its indexes are only rebuilt when the tree has changed
+    (catalog, matcher, significant_filter) = load_catalog(index_path, path, generation)
+
+    # Check for ZERO network files in the catalog
+    if len(catalog) == 0:
         txt = f"The specified --tree-path of '{path}' returned NO files!  Check your path specification and network connection!\n"
         st.error(txt)
         state('logger').error(txt)
         exit()
 
+    txt = f"File catalog holds {len(catalog)} files in {len(catalog.dirs)} directories using {catalog.nbytes( ) / 2**20:.1f} MB, its matcher {matcher.nbytes( ) / 2**20:.1f} MB"
+    st.info(txt)
+    state('logger').info(txt)
+
     # # Report our --regex option...
     # if significant:
     #   my_colorama.green(f"\nProcessing only files matching signifcant --regex of '{significant}'!")
@@ -313,119 +300,152 @@ def fuzzy_search_for_files(status):
     progress_text = "Fuzzy search in progress.  Be patient."
     search_progress = st.progress(0, progress_text)
 
-    # Now the main matching loop...
-    num_filenames = len(filenames)
-
-    for x in range(num_filenames):
-
-        percent_complete = min(x / num_filenames, 100)
-        search_progress.progress(percent_complete, progress_text)
-
-        if x < skip_rows:  # skip this row if instructed to do so
-            txt = f"Skipping match for '{filenames[x]}' in worksheet row {x}"
-            st.warning(txt)
-            state('logger').warning(txt)
-            continue  # move on and process the next row
-
-        if len(filenames[x]) < 1:  # filename is empty, skip this row 
-            txt = f"Skipping match for BLANK filename in worksheet row {x}"
-            # st.warning(txt)
-            state('logger').warning(txt)
-            continue  # move on and process the next row
-
-        counter += 1
-        target = filenames[x]
-
-        # # If --grinnell is specified and the 'target' begins with 'grinnell_' AND does not contain '_OBJ'... make it so
-        # if grinnell and ('grinnell_' in target) and ('_OBJ' not in target):
-        #     target += '_OBJ.'
-
-        status.update(
-            label=
-            f"{counter}. Finding best fuzzy filename matches for '{target}'...",
-            expanded=True,
-            state="running")
-
-        # st.write(f"{counter}. Finding best fuzzy filename matches for '{target}'...")
-
-        csv_line = [None] * 7
-        significant_text = ''
-
-        csv_line[0] = x             # was 'counter', but that does not account for skipped filenames!
-        csv_line[1] = target
-        csv_line[2] = None            # Hold our regex expression...later
-
-        (significant_text, significant_file_list, significant_path_list, significant_dict) = build_lists_and_dict(significant, target, big_file_list, big_path_list)
-
-        # If target is blank, skip the search and set matches = False
-        matches = False
-        if len(target) > 0:
-            matches = process.extract(target, significant_dict, limit=3)
-
-        # Report the top three matches
-        if matches:
-            for found, (match, score, index) in enumerate(matches):
-                path = significant_path_list[index]
-
-                if found == 0:
-                    csv_line[3] = score
-                    csv_line[4] = match
-                    csv_line[5] = path
+    # If --output-csv is true, open a .csv file to receive the matching filenames, one row at a time.
+    # When resuming, the rows already in the file are kept and not matched again.
+    # The file is tied to this run's journal key, so one written for another worksheet isn't resumed.
+    journal = state('journal')
+    match_list = None
+    completed = { }
+    if state('output_to_csv'):
+        match_list = MatchListWriter(key=journal.key if journal else None, resume=state('resume_match_list'))
+        completed = match_list.completed
+        if completed:
+            txt = f"Resuming from {len(completed)} rows already saved in 'match-list.csv'"
+            st.info(txt)
+            state('logger').info(txt)
+
+    # When resuming the last run, rows the run journal has already matched are not matched again.  The
+    # match list is closed (and synced to disk) however the search ends.
+    try:
+        if journal and state('resume_run'):
+            journaled = journal.completed_matches( )
+            for (x, line) in sorted(journaled.items( )):
+                if x not in completed:
+                    completed[x] = line
+                    if match_list:
+                        match_list.write(line)
+            txt = f"Resuming the last run, {len(journaled)} rows were already matched"
+            st.info(txt)
+            state('logger').info(txt)
+
+        # Pick out the rows to be matched...
+        num_filenames = len(filenames)
+        rows = [ ]
+
+        for x in range(num_filenames):
+
+            if x in completed:
+                csvlines.append(completed[x])
+                continue
+
+            if x < skip_rows:  # skip this row if instructed to do so
+                txt = f"Skipping match for '{filenames[x]}' in worksheet row {x}"
+                st.warning(txt)
+                state('logger').warning(txt)
+                continue  # move on and process the next row
+
+            if len(filenames[x]) < 1:  # filename is empty, skip this row 
+                txt = f"Skipping match for BLANK filename in worksheet row {x}"
+                # st.warning(txt)
+                state('logger').warning(txt)
+                continue  # move on and process the next row
+
+            # # If --grinnell is specified and the 'target' begins with 'grinnell_' AND does not contain '_OBJ'... make it so
+            # if grinnell and ('grinnell_' in target) and ('_OBJ' not in target):
+            #     target += '_OBJ.'
+
+            rows.append((x, filenames[x]))
+
+        # Now the main matching loop... rows may be matched in parallel, but results arrive in row order
+        results = match_rows(matcher, significant_filter, rows, workers=state('matching_workers') or 1,
+                             regex=regex, resolve_ids=bool(state('resolve_numeric_ids')),
+                             runners_up=bool(state('transfer_transcripts')))
+
+        for (x, target, kind, significant_text, matches) in results:
+
+            percent_complete = min(x / num_filenames, 100)
+            search_progress.progress(percent_complete, progress_text)
+
+            counter += 1
+            resolved[kind] += 1
+
+            status.update(
+                label=
+                f"{counter}. Found best fuzzy filename matches for '{target}'...",
+                expanded=True,
+                state="running")
+
+            # st.write(f"{counter}. Finding best fuzzy filename matches for '{target}'...")
+
+            csv_line = [None] * 7
+
+            csv_line[0] = x             # was 'counter', but that does not account for skipped filenames!
+            csv_line[1] = target
+            csv_line[2] = None            # Hold our regex expression...later
+
+            # Report the top three matches
+            if matches:
+                for found, (match, score, index) in enumerate(matches):
+                    path = catalog.dirname(index)
+
+                    if found == 0:
+                        csv_line[3] = score
+                        csv_line[4] = match
+                        csv_line[5] = path
             
-                    if score == 100:
-                        txt = f"!!! Found a 100 matching file: {format(csv_line)}"
-                        st.success(txt)
-                        state('logger').success(txt)
-
-                    elif score > 89:
-                        txt = f"!!! Found BEST but NOT 100 matching file: {format(csv_line)}"
-                        st.warning(txt)
-                        state('logger').success(txt)
-
-                    else:
-                        txt = f"!!! Found BEST matching file but with a poor score: {format(csv_line)}"
-                        st.error(txt)
-                        state('logger').warning(txt)
-
-                # Transcript processing, if enabled... look for a .csv, .vtt, .pdf or .xml file
-                if state('transfer_transcripts') and (score > 89):
-                    (root, extension) = os.path.splitext(match)
-                    if extension.lower( ) in ['.csv', '.vtt', '.pdf', '.xml']:
-                        txt = f"!!! Transcript processing is ON and this was found: {format(csv_line)}"
-                        st.success(txt)
-                        state('logger').success(txt)
-
-                        # Save the transcript filename to csv_line[ ] element 6
-                        csv_line[6] = match
+                        if score == 100:
+                            txt = f"!!! Found a 100 matching file: {format(csv_line)}"
+                            st.success(txt)
+                            state('logger').success(txt)
+
+                        elif score > 89:
+                            txt = f"!!! Found BEST but NOT 100 matching file: {format(csv_line)}"
+                            st.warning(txt)
+                            state('logger').success(txt)
+
+                        else:
+                            txt = f"!!! Found BEST matching file but with a poor score: {format(csv_line)}"
+                            st.error(txt)
+                            state('logger').warning(txt)
+
+                    # Transcript processing, if enabled... look for a .csv, .vtt, .pdf or .xml file
+                    if state('transfer_transcripts') and (score > 89):
+                        (root, extension) = os.path.splitext(match)
+                        if extension.lower( ) in ['.csv', '.vtt', '.pdf', '.xml']:
+                            txt = f"!!! Transcript processing is ON and this was found: {format(csv_line)}"
+                            st.success(txt)
+                            state('logger').success(txt)
+
+                            # Save the transcript filename to csv_line[ ] element 6, and where it is for post-processing
+                            csv_line[6] = match
+                            st.session_state['transcript_dirs'][x] = path
                     
-        else:
-            txt = f"*** Found NO match for: {format(' | '.join(csv_line))}"
-            st.error(txt)
-            state('logger').error(txt)
+            else:
+                txt = f"*** Found NO match for: {format(' | '.join(str(c) for c in csv_line))}"
+                st.error(txt)
+                state('logger').error(txt)
 
-        # Save this fuzzy search result in 'csvlines' for return
-        csvlines.append(csv_line)
+            # Save this fuzzy search result in 'csvlines' for return
+            csvlines.append(csv_line)
 
-        # If --output-csv is true, open a .csv file to receive the matching filenames and add a heading
-        if state('output_to_csv'):
-            with open('match-list.csv', 'w', newline='') as csvfile:
-                list_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+            # If --output-csv is true, append this row to the .csv file
+            if match_list:
+                match_list.write(csv_line)
 
-                if state('significant'):
-                    significant_header = f"\'{state('significant')}\' Match"
-                else:
-                    significant_header = "Undefined"
+            # ...and checkpoint it in the run journal
+            if journal:
+                journal.record_match(x, csv_line)
+
+    finally:
+        if match_list:
+            match_list.close( )
 
-                header = [
-                    'No.', 'Target', 'Significant --regex', 'Best Match Score',
-                    'Best Match', 'Best Match Path', '2nd Match Score',
-                    '2nd Match', '2nd Match Path', '3rd Match Score',
-                    '3rd Match', '3rd Match Path'
-                ]
-                list_writer.writerow(header)
+    # Rows picked up from a resumed 'match-list.csv' were collected first, put everything back in row order
+    csvlines.sort(key=lambda line: line[0])
 
-                for line in csvlines:
-                    list_writer.writerow(line)
+    txt = f"Rows resolved by exact name: {resolved['exact']}, by case-insensitive name: {resolved['case-insensitive']}, by numeric ID: {resolved['numeric ID']}, by fuzzy scoring: {resolved['fuzzy']}"
+    st.info(txt)
+    state('logger').info(txt)
 
     txt = f"**Fuzzy search output is saved in 'match-list.csv**"
     st.success(txt)
@@ -460,19 +480,6 @@ def state(key):
         return False
 
 
-# transform_list_to_dict(worksheet_list)
-# ---------------------------------------------------------------------
-def transform_list_to_dict(wks_dict, worksheet_list):
-    for w in worksheet_list:
-        parts = re.split('\'|:', str(w))
-        if len(parts) > 3:
-            wks_dict[parts[1]] = parts[3].rstrip('>')
-        else: 
-            logger.error(f"Not enough 'parts' in {parts}!")
-            return False    
-    return wks_dict
-
-
 # get_tree( )
 # ---------------------------------------------------------------------
 def get_tree( ):
@@ -526,12 +533,13 @@ def get_worksheet_column_selection( ):
             state('logger').success(txt)
 
             selected_worksheet = state("google_worksheet_selection")
-            sh = open_google_sheet(sheet_url)
 
-            # Fetch list of worksheets and build a name:gid dict
-            worksheet_list = sh.worksheets( )
-            worksheet_dict = { }
-            worksheet_dict = transform_list_to_dict(worksheet_dict, worksheet_list)
+            # Fetch (or reuse) the list of worksheets as a name:gid dict
+            try:
+                worksheet_dict = sheet_snapshots( ).worksheets(sheet_url, offline=state('sheets_offline'))
+            except LookupError as e:
+                st.error(f"{e}; untick 'work offline' to read it from Google")
+                st.stop( )
 
             # Select the worksheet to be processed
             selected_worksheet = st.selectbox('Choose the worksheet you wish to work with', worksheet_dict.keys( ), index=None, key='worksheet_selectbox')
@@ -542,12 +550,12 @@ def get_worksheet_column_selection( ):
                 st.success(txt)
                 state('logger').success(txt)
 
-                # Open the selected worksheet
-                worksheet = sh.worksheet(state("google_worksheet_selection"))
-                st.session_state['worksheet'] = worksheet
-
-                # Now fetch a list of columns from the selected sheet
-                column_list = worksheet.row_values(1)
+                # Now take the list of columns from a snapshot of the selected sheet
+                try:
+                    column_list = sheet_snapshots( ).snapshot(sheet_url, selected_worksheet, offline=state('sheets_offline')).headers( )
+                except LookupError as e:
+                    st.error(f"{e}; untick 'work offline' to read it from Google")
+                    st.stop( )
 
                 # Make your column selection
                 selected_column = st.selectbox('Choose the column containing your filenames', column_list, index=None, key='column_selector')
@@ -566,88 +574,6 @@ def get_worksheet_column_selection( ):
     return
 
 
-# get_network_path(path, fname)
-# ----------------------------------------------------------------------
-def get_network_path(path, fname):
-    return os.path.join(path, fname)
-
-
-# check_numeric_part(score, target, candidate)
-# ----------------------------------------------------------------
-def check_numeric_part(score, target, candidate):
-    pattern = re.compile(r'^.*[-_](\d+).*$')   # any ... dash OR underscore ... series of digits ... any
-    m_target = pattern.match(target)
-    if m_target:
-        tn = m_target.group(1)
-        m_candidate = pattern.match(candidate)
-        if m_candidate:
-            cn = m_candidate.group(1)
-            if tn == cn:                 # an EXACT numeric match!
-                return 95
-    return score
-
-
-# build_azure_url( )
-# ----------------------------------------------------------------------
-def build_azure_url(target, score, match, mode='OBJ'):
-
-    # Special logic... if the score > 49 check the embedded numeric portion ONLY and
-    # if that's an EXACT match we will accept it as a match
-    if score > 49:
-        score = check_numeric_part(score, target, match)
-
-    try:
-
-        # Check if the match score was 90 or above, if not, skip it!
-        if score < 90:
-            txt = f"Best match for '{target}' has an insufficient match score of {score}.  It will NOT be accepted nor copied to Azure storage."
-            st.warning(txt)
-            state('logger').warning(txt)
-
-            return False
-
-        # Check for obvious mode/match errors
-        if "_TN." in match and mode != 'TN':
-            txt = f"_TN in '{match}' and mode '{mode}' is an error!"
-            st.error(txt)
-            state('logger').error(txt)
-
-            return False
-        elif "_JPG." in match and mode != 'JPG':
-            txt = f"_JPG in '{match}' and mode '{mode}' is an error!"
-            st.error(txt)
-            state('logger').error(txt)
-
-            return False
-        elif "_OBJ." in match and mode != 'OBJ':
-            txt = "_OBJ in '{match}' and mode '{mode}' is an error!"
-            st.error(txt)
-            state('logger').error(txt)
-            return False
-
-        # Determine the type of URL to build... OBJ, TN, JPG or TRANSCRIPT
-        if mode == 'TRANSCRIPT':
-            url = azure_base_url + "transcripts/" + match
-        elif "_TN." in match or mode == 'TN':
-            url = azure_base_url + "thumbs/" + match
-        elif "_JPG." in match or mode == 'JPG':
-            url = azure_base_url + "smalls/" + match
-        elif "_OBJ." in match or mode == 'OBJ':
-            url = azure_base_url + "objs/" + match
-        else:
-            txt = f"'{match}' and mode '{mode}' is an error!"
-            st.error(txt)
-            state('logger').error(txt)
-            return False
-
-        return url
-
-    except Exception as ex:
-        state('logger').critical(ex)
-        st.exception(ex)
-        pass
-
-
 # post_processing(status, csv_results, df)
 #
 # If --copy-to-azure is true... for each '_OBJ.' (and if --extended '_TN.' or '_JPG.') match
@@ -659,9 +585,7 @@ def post_processing(csv_results):
 
     with st.status(f"Beginning post-processing for {len(csv_results)} objects.", expanded=True, state="running") as status:
 
-        st.session_state['copied'] = 0
-        st.session_state['exists'] = 0
-        st.session_state['skipped'] = 0
+        processor = None
 
         try:
 
@@ -674,8 +598,8 @@ def post_processing(csv_results):
 
             connect_str = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 
-            # Create the BlobServiceClient object
-            blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+            # Get the (cached) BlobServiceClient object
+            blob_service_client = azure_clients(connect_str).get( )
 
             # Loop on all the "matches"
             progress_text = "Post processing in progress.  Be patient."
@@ -683,27 +607,54 @@ def post_processing(csv_results):
 
             num_matches = len(csv_results)
 
-            for i, line in enumerate(csv_results):
-                percent_complete = min(i / num_matches, 100)
-                post_progress.progress(percent_complete, progress_text)
-                # print(line)
-                index = int(line[0])
-                target = line[1]
-                regex = line[2]
-                score = int(line[3])
-                match = line[4]
-                path = line[5]
-                transcript = line[6]
-
-                # Build a network file path for the best match
-                local_storage_path = get_network_path(path, match)
+            # List the containers once so most uploads don't need their own exists( ) check
+            inventory = None
+            if state('azure_blob_storage'):
+                inventory = BlobInventory(blob_service_client, prefix=state('blob_prefix') or None)
+                txt = f"Listed {len(inventory)} blobs in Azure Storage containers {', '.join(inventory.names)}"
+                st.info(txt)
+                state('logger').info(txt)
 
-                # Call our file_handler for the main object
-                result = file_handler(index, blob_service_client, target, score, match, local_storage_path, False)
-
-                # If we have a transcript, call the file_handler again
-                if result and transcript:
-                    file_handler(index, blob_service_client, target, score, match, local_storage_path, transcript)
+            # The caches are closed however post-processing ends
+            hashes = None
+            try:
+                # Compare MD5 hashes of the local files with those of existing blobs?
+                hashes = HashCache( ) if state('compare_md5') else None
+
+                # Keep derivatives between runs?
+                if state('cache_derivatives'):
+                    st.session_state.derivative_cache = DerivativeCache(max_bytes=(state('derivative_cache_mb') or CACHE_BYTES // 2**20) * 2**20)
+
+                # Thumbnails and "smalls" are only made for CollectionBuilder
+                derivative_types = [ ]
+                if state('processing_mode') == 'CollectionBuilder':
+                    derivative_types = [name for (name, on) in (('thumbnail', state('generate_thumb')), ('small', state('generate_small'))) if on]
+
+                # Uploads run concurrently, and derivatives are made in worker processes; their results are
+                # counted and saved back here, in row order, as they finish
+                with UploadPool(blob_service_client, workers=state('upload_workers') or UPLOAD_WORKERS, inventory=inventory, hashes=hashes,
+                                block_size=(state('block_size_mb') or BLOCK_SIZE // 2**20) * 2**20,
+                                max_concurrency=state('block_concurrency') or BLOCK_CONCURRENCY) as uploads, \
+                     DerivativePool(workers=state('derivative_workers') or DERIVATIVE_WORKERS) as derivative_pool:
+
+                    processor = PostProcessor(uploads, derivative_pool, report_post_processing, journal=st.session_state.get('journal'),
+                                              dirty_cells=st.session_state.get('dirty_cells') if state('processing_mode') else None,
+                                              copy=bool(state('azure_blob_storage')), derivatives=derivative_types,
+                                              cache=state('derivative_cache'), on_disk=bool(state('derivatives_on_disk')),
+                                              base_url=azure_base_url)
+                    transcript_dirs = st.session_state.get('transcript_dirs', { })
+
+                    for i, line in enumerate(csv_results):
+                        percent_complete = min(i / num_matches, 100)
+                        post_progress.progress(percent_complete, progress_text)
+                        processor.process(line, transcript_dirs.get(line[0]))
+
+            finally:
+                if hashes:
+                    hashes.close( )
+                if st.session_state.derivative_cache is not None:
+                    st.session_state.derivative_cache.close( )
+                    st.session_state.derivative_cache = None
 
             # Done!
             status.update(label=f"Azure post processing is complete!", expanded=True, state="complete")
@@ -713,7 +664,8 @@ def post_processing(csv_results):
             st.exception(ex)
 
     # Declare success!
-    txt = f"Azure processing results: copied={state('copied')} exists={state('exists')} skipped={state('skipped')}"
+    counts = processor.counts if processor else { }
+    txt = "Azure processing results: " + ' '.join(f"{key}={value}" for (key, value) in counts.items( ))
     st.success(txt)
     state('logger').success(txt)
 
@@ -732,9 +684,20 @@ def post_processing(csv_results):
 
                 worksheet = open_google_worksheet(
                     state('google_sheet_url'), state('google_worksheet_selection'))
-                if worksheet:
-                    set_with_dataframe(worksheet, st.session_state.df, 1, 1)
-                    txt = f"Updated file URLs have been saved to the selected Google worksheet."
+                # Cells are written by row position, so not if rows have been inserted, deleted or sorted since
+                if worksheet and sheet_snapshots( ).moved(state('google_sheet_url'), state('google_worksheet_selection'),
+                                                          state('df_snapshot'), state('worksheet_column_number')):
+                    txt = f"Google worksheet {state('google_worksheet_selection')} has had rows added, removed or reordered since it was read, so it was NOT updated.  Please run the search again."
+                    st.error(txt)
+                    state('logger').error(txt)
+                    st.write(f"Dumping the updated worksheet DataFrame...")
+                    st.dataframe(st.session_state.df)
+
+                elif worksheet:
+                    # Only the cells post-processing changed are sent, in as few requests as possible
+                    written = state('dirty_cells').flush(worksheet) if state('dirty_cells') else 0
+                    sheet_snapshots( ).invalidate(state('google_sheet_url'), worksheet.id)
+                    txt = f"Updated file URLs have been saved to the selected Google worksheet, {written} cells changed."
                     st.success(txt)
                     state('logger').success(txt)
 
@@ -759,144 +722,6 @@ def post_processing(csv_results):
         state('logger').error(txt)
 
 
-# file_handler(index, blob_service_client, target, score, match, local_storage_path, transcript=False)
-# ---------------------------------------------------------------------------------------
-def file_handler(index, blob_service_client, target, score, match, local_storage_path, transcript=False):
-    
-    url = None
-
-    # Build an Azure Blob URL for the object
-    if transcript:
-        url = build_azure_url(target, score, transcript, mode="TRANSCRIPT")
-        match = transcript
-    else:
-        url = build_azure_url(target, score, match)
-        if not url:
-            st.session_state['skipped'] += 1
-
-    result = False
-
-    # Upload the file to Azure Blob storage
-    if url and state('azure_blob_storage'):
-        result = upload_to_azure(blob_service_client, url, match, local_storage_path, transcript)
-        if not transcript:
-            if result == "EXISTS":
-                st.session_state['exists'] += 1
-            elif result == "COPIED":
-                st.session_state['copied'] += 1
-
-    # If result is NOT False and processing_mode is targeted, put the found filename into the worksheet dataframe
-    col = False
-    if result and state('processing_mode'):
-        if state('processing_mode') == 'CollectionBuilder':  # CollectionBuilder
-            if transcript:     
-                col = 'object_transcript'
-            else:
-                col = 'object_location'
-                # col = 'WORKSPACE1'
-        # elif state('processing_mode') == 'Migration to Alma':  # Alma migration
-        #     col = 'file_name_1'
-        else:
-            txt = f"Sorry, the 'processing_mode' state of \'{st.session_state['processing_mode']}\' is not recognized"
-            st.error(txt)
-            state('logger').error(txt)
-            return False
-
-    if col and isinstance(st.session_state.df, pd.DataFrame):
-        row = st.session_state.df.index[index - 1]  # adjust for header row!
-        st.session_state.df.at[row, col] = url
-
-        # And if this is a transcript, set the 'display_template' value to 'transcript'
-        if transcript:
-            st.session_state.df.at[row, 'display_template'] = 'transcript'
-
-    # Thumbnail creation
-    if url and state('generate_thumb'):
-        result = create_derivative('thumbnail', index, url, local_storage_path, blob_service_client)
-
-    # "Small" creation
-    if url and state('generate_small'):
-        result = create_derivative('small', index, url, local_storage_path, blob_service_client)
-
-    return True
-
-
-# create_derivative(derivative_type, index, url, local_storage_path, blob_service_client)
-# ------------------------------------------------------------
-def create_derivative(derivative_type, index, url, local_storage_path, blob_service_client):
-
-    derivative_filename = None
-
-    dirname, basename = os.path.split(local_storage_path)
-    root, ext = os.path.splitext(basename)
-
-    # If creating derivative(s) for CollectionBuilder...
-    if state('processing_mode') == 'CollectionBuilder':
-        
-        if derivative_type == 'thumbnail':
-            col = 'image_thumb'
-            options = {
-                'trim': False,
-                'height': 400,
-                'width': 400,
-                'quality': 85,
-                'type': 'thumbnail'
-            }
-            derivative_url = url.replace('/objs/', '/thumbs/').replace(ext, '_TN.jpg')
-            derivative_filename = f"{root}_TN.jpg"
-
-        elif derivative_type == 'small':
-            if state('processing_mode') != 'CollectionBuilder':
-                txt = f"Call to create_derivative( ) with option other than CollectionBuilder is not necessary!"
-                st.error(txt)
-                state('logger').error(txt)
-                return False
-
-            col = 'image_small'
-            options = {
-                'trim': False,
-                'height': 800,
-                'width': 800,
-                'quality': 85,
-                'type': 'thumbnail'
-            }
-            derivative_url = url.replace('/objs/', '/smalls/').replace(ext, '_SMALL.jpg')
-            derivative_filename = f"{root}_SMALL.jpg"
-
-        else:
-            txt = f"Call to create_derivative( ) has an unknown 'derivative_type' of '{derivative_type}'."
-            st.error(txt)
-            state('logger').error(txt)
-
-        derivative_path = f"/tmp/{derivative_filename}"
-
-        # If original is an image...
-        if ext.lower( ) in ['.tiff', '.tif', '.jpg', '.jpeg', '.png']:
-            generate_thumbnail(st, local_storage_path, derivative_path, options)
-
-        # If original is a PDF...
-        elif ext.lower( ) == '.pdf':
-            cmd = 'magick ' + local_storage_path + '[0] ' + derivative_path
-            st.info(f"Derivative command: {cmd}")
-            call(cmd, shell=True)
-
-        else:
-            txt = f"Sorry, we can't create a thumbnail for '{local_storage_path}'"
-            st.warning(txt)
-            state('logger').warning(txt)
-
-            derivative_url = False
-
-        # Upload the file to Azure Blob storage
-        if derivative_url and state('azure_blob_storage'):
-            result = upload_to_azure(blob_service_client, derivative_url, derivative_filename, derivative_path)
-
-        # Save it to the dataframe
-        if derivative_url and col and isinstance(st.session_state['df'], pd.DataFrame):
-            df = st.session_state['df']
-            row = df.index[index - 1]  # adjust for header row!
-            df.at[row, col] = derivative_url
-
 # ----------------------------------------------------------------------
 # --- Main
 
@@ -921,8 +746,6 @@ if __name__ == '__main__':
         st.session_state.worksheet_column_number = None
     if not state('stfs_path_selection'):
         st.session_state.stfs_path_selection = None
-    if not state('use_previous_file_list'):
-        st.session_state.use_previous_file_list = False
     if not state('check_worksheet_column_headings'):
         st.session_state.check_worksheet_column_headings = False
     if not state('regex_text'):
@@ -939,10 +762,50 @@ if __name__ == '__main__':
         st.session_state.azure_blob_storage = False
     if not state('transfer_transcripts'):
         st.session_state.transfer_transcripts = False
+    if not state('resolve_numeric_ids'):
+        st.session_state.resolve_numeric_ids = False
     if not state('save_dataframe'):
         st.session_state.save_dataframe = False
+    if not state('resume_match_list'):
+        st.session_state.resume_match_list = False
+    if not state('resume_run'):
+        st.session_state.resume_run = False
+    if not state('matching_workers'):
+        st.session_state.matching_workers = 1
+    if not state('compare_md5'):
+        st.session_state.compare_md5 = False
+    if not state('blob_prefix'):
+        st.session_state.blob_prefix = False
+    if not state('cache_derivatives'):
+        st.session_state.cache_derivatives = False
+    if not state('derivative_cache_mb'):
+        st.session_state.derivative_cache_mb = CACHE_BYTES // 2**20
+    if not state('derivative_cache'):
+        st.session_state.derivative_cache = None
+    if not state('derivatives_on_disk'):
+        st.session_state.derivatives_on_disk = False
+    if not state('derivative_workers'):
+        st.session_state.derivative_workers = DERIVATIVE_WORKERS
+    if not state('upload_workers'):
+        st.session_state.upload_workers = UPLOAD_WORKERS
+    if not state('block_size_mb'):
+        st.session_state.block_size_mb = BLOCK_SIZE // 2**20
+    if not state('block_concurrency'):
+        st.session_state.block_concurrency = BLOCK_CONCURRENCY
+    if not state('crawler_workers'):
+        st.session_state.crawler_workers = WORKERS
+    if not state('max_depth'):
+        st.session_state.max_depth = 0
+    if not state('exclude_globs'):
+        st.session_state.exclude_globs = False
     if not state('df'):
         st.session_state.df = pd.DataFrame( )  # Empty Pandas dataframe for our Google Sheet
+    if not state('sheets_offline'):
+        st.session_state.sheets_offline = False
+    if not state('dirty_cells'):
+        st.session_state.dirty_cells = None    # Edits of that dataframe still to be saved to the sheet
+    if not state('df_snapshot'):
+        st.session_state.df_snapshot = None    # The worksheet snapshot that dataframe was made from
 
     # Display and fetch options from the sidebar
     with st.sidebar:
@@ -996,6 +859,44 @@ if __name__ == '__main__':
                 disabled=True)
             st.session_state.generate_small = False
 
+        # Compare content hashes?
+        if state('azure_blob_storage'):
+            compare_md5 = st.checkbox(
+                "Check here to compare MD5 hashes and replace blobs whose local file has changed, instead of skipping every blob that exists",
+                value=False,
+                key='compare_md5_checkbox')
+            st.session_state.compare_md5 = compare_md5
+        else:
+            st.session_state.compare_md5 = False
+
+        # Keep derivatives between runs?
+        if state('generate_thumb') or state('generate_small'):
+            cache_derivatives = st.checkbox(
+                "Check here to keep thumbnail and small images in 'derivative-cache' and reuse them while their originals are unchanged",
+                value=False,
+                key='cache_derivatives_checkbox')
+            st.session_state.cache_derivatives = cache_derivatives
+
+            if state('cache_derivatives'):
+                derivative_cache_mb = st.number_input(
+                    label="Maximum size of the derivative cache in MB",
+                    min_value=10,
+                    value=CACHE_BYTES // 2**20,
+                    key='derivative_cache_mb_input')
+                st.session_state.derivative_cache_mb = derivative_cache_mb
+        else:
+            st.session_state.cache_derivatives = False
+
+        # Write derivatives to temporary files instead of keeping them in memory?
+        if (state('generate_thumb') or state('generate_small')) and not state('cache_derivatives'):
+            derivatives_on_disk = st.checkbox(
+                "Check here to write thumbnail and small images to temporary files before uploading them, instead of keeping them in memory",
+                value=False,
+                key='derivatives_on_disk_checkbox')
+            st.session_state.derivatives_on_disk = derivatives_on_disk
+        else:
+            st.session_state.derivatives_on_disk = False
+
         st.divider( )
 
         # Search for Transcript files
@@ -1015,13 +916,31 @@ if __name__ == '__main__':
                 disabled=False)
             st.session_state.transfer_transcripts = False
 
-        # Use previous file list?
-        use_previous_file_list = st.checkbox(
+        # Resolve numeric IDs through the ID index?
+        resolve_numeric_ids = st.checkbox(
+            label=
+            "Check here to match names with an embedded numeric ID (like 'grinnell_13229_OBJ') only against files carrying the same ID",
+            value=False,
+            key='resolve_numeric_ids_checkbox')
+        st.session_state.resolve_numeric_ids = resolve_numeric_ids
+
+        # Forget what's been read from Google Sheets?
+        if st.button(f"Re-read the Google Sheet now (otherwise it's re-read every {SNAPSHOT_TTL // 60} minutes)",
+                     key='reread_google_sheet_button'):
+            sheet_snapshots( ).invalidate( )
+
+        # Work from the sheet cache without calling Google?
+        sheets_offline = st.checkbox(
             label=
-            "Check here to use the previous list of filenames stored in 'file-list.tmp'",
+            "Check here to work offline from the copies of worksheets kept in 'sheet-cache.sqlite', with no Google API calls",
             value=False,
-            key='use_previous_file_list_checkbox')
-        st.session_state.use_previous_file_list = use_previous_file_list
+            key='sheets_offline_checkbox')
+        st.session_state.sheets_offline = sheets_offline
+
+        # Saving back to the sheet needs it as it is now, not a cached copy
+        if sheets_offline and state('save_dataframe'):
+            st.warning("Changes can't be saved to the Google Sheet while working offline, so the dataframe will be dumped for review instead.")
+            st.session_state.save_dataframe = False
 
         # Output to CSV?
         output_to_csv = st.checkbox(
@@ -1030,34 +949,122 @@ if __name__ == '__main__':
             key='output_to_csv_checkbox')
         st.session_state.output_to_csv = output_to_csv
 
+        # Resume from a partial CSV?
+        if state('output_to_csv'):
+            resume_match_list = st.checkbox(
+                label="Check here to keep the rows already in 'match-list.csv' and match only the rest",
+                value=False,
+                key='resume_match_list_checkbox')
+            st.session_state.resume_match_list = resume_match_list
+        else:
+            st.session_state.resume_match_list = False
+
+        # Resume the last run from the run journal?
+        resume_run = st.checkbox(
+            label="Check here to resume the last run of this worksheet, column and folder, skipping rows and uploads it finished",
+            value=False,
+            key='resume_run_checkbox')
+        st.session_state.resume_run = resume_run
+
         # Limit search with regex?
         regex_text = st.text_input(label= "Specify a 'regex' pattern here to limit the scope of your search", value=None,key='regex_text_input')
         st.session_state.regex_text = regex_text
 
+        st.divider( )
+
+        # Parallel matching
+        matching_workers = st.number_input(
+            label="Number of worker processes for fuzzy matching (1 matches every row in this process)",
+            min_value=1,
+            max_value=os.cpu_count( ) or 1,
+            value=1,
+            key='matching_workers_input')
+        st.session_state.matching_workers = matching_workers
+
+        # Parallel derivative generation
+        derivative_workers = st.number_input(
+            label="Number of worker processes making thumbnail and small images (1 makes them in this process)",
+            min_value=1,
+            max_value=os.cpu_count( ) or 1,
+            value=min(DERIVATIVE_WORKERS, os.cpu_count( ) or 1),
+            key='derivative_workers_input')
+        st.session_state.derivative_workers = derivative_workers
+
+        # Concurrent uploads
+        upload_workers = st.number_input(
+            label="Number of files to upload to Azure Blob Storage at once",
+            min_value=1,
+            max_value=32,
+            value=UPLOAD_WORKERS,
+            key='upload_workers_input')
+        st.session_state.upload_workers = upload_workers
+
+        # Large file uploads
+        block_size_mb = st.number_input(
+            label=f"Block size in MB for uploading files of {LARGE_FILE // 2**20} MB or more (each block is held in memory while it's sent)",
+            min_value=1,
+            max_value=MAX_BLOCK_SIZE // 2**20,
+            value=BLOCK_SIZE // 2**20,
+            key='block_size_mb_input')
+        st.session_state.block_size_mb = block_size_mb
+
+        block_concurrency = st.number_input(
+            label="Number of blocks of one large file to upload at once",
+            min_value=1,
+            max_value=16,
+            value=BLOCK_CONCURRENCY,
+            key='block_concurrency_input')
+        st.session_state.block_concurrency = block_concurrency
+        st.write(f"Large file uploads may hold up to {block_size_mb * block_concurrency * upload_workers} MB in memory at once (block size x blocks at once x uploads at once).")
+
+        blob_prefix = st.text_input(label="Only list Azure blobs whose names start with this prefix when checking what's already uploaded, e.g. 'grinnell_'", value=None, key='blob_prefix_input')
+        st.session_state.blob_prefix = blob_prefix
+
+        # Directory tree crawler options
+        crawler_workers = st.number_input(
+            label="Number of directories to list at once when refreshing the directory tree index",
+            min_value=1,
+            max_value=64,
+            value=WORKERS,
+            key='crawler_workers_input')
+        st.session_state.crawler_workers = crawler_workers
+
+        max_depth = st.number_input(
+            label="Maximum directory depth to search below the selected folder (0 for no limit)",
+            min_value=0,
+            value=0,
+            key='max_depth_input')
+        st.session_state.max_depth = max_depth
+
+        exclude_globs = st.text_input(label="Comma-separated file and folder name patterns to exclude from the search, e.g. '*.clientThumb, Thumbs.db'", value=None, key='exclude_globs_input')
+        st.session_state.exclude_globs = exclude_globs
+
     # Fetch the --worksheet argument
-    if not state('use_previous_file_list'):
-        get_worksheet_column_selection( )
+    get_worksheet_column_selection( )
 
     # Fetch the --tree-path argument
     get_tree()
 
+    # A regex that won't compile would stop the search part way through, so check it up front
+    regex_ok = True
+    if state('regex_text'):
+        try:
+            compile_significant(state('regex_text'))
+        except re.error as e:
+            txt = f"The regex pattern '{state('regex_text')}' is not valid: {e}"
+            st.error(txt)
+            state('logger').error(txt)
+            regex_ok = False
+
     # Check parameters to see if we have enough input to run a search
-    go1 = state('use_previous_file_list') and state('stfs_path_selection')
-    go2 = state('google_sheet_url') and state(
+    go = state('google_sheet_url') and state(
         'google_worksheet_selection') and state(
-            'worksheet_column_number') and state('stfs_path_selection')
+            'worksheet_column_number') and state('stfs_path_selection') and regex_ok
 
     msg = ""
 
-    # Run a search using previous list of filenames
-    if go1:
-        msg = f"using the previous list of filenames AND specified directory: {state('stfs_path_selection')}"
-        txt = f"Fuzzy search is **ready**... **{msg}**"
-        st.success(txt)
-        state('logger').success(txt)
-
-    # Fetch new filenames for a pristine search
-    elif go2:
+    # Fetch filenames for a pristine search
+    if go:
         msg = f"using the filenames from column \'{state('worksheet_column_selection')}\' of worksheet \'{state('google_worksheet_selection')}\' AND specified directory: {state('stfs_path_selection')}"
         txt = f"Fuzzy search is **ready**... **{msg}**"
         st.success(txt)
@@ -1073,11 +1080,30 @@ if __name__ == '__main__':
         st.session_state
 
     # Ready... prompt for button press to run the search
-    if go1 or go2:
+    if go:
         if st.button("Click HERE to run the search!", key='initiate_search_button'):
-            with st.status(f"Go! {msg}") as status:
-                csv_results = fuzzy_search_for_files(status)
 
-            # Post-processing...
-            if state('azure_blob_storage') or state('processing_mode'):
-                post_processing(csv_results)
+            # Checkpoint the run so it can be resumed if it's interrupted
+            with RunJournal( ) as journal:
+                exclude = [pattern.strip( ) for pattern in (state('exclude_globs') or '').split(',') if pattern.strip( )]
+                settings = match_settings(regex=state('regex_text'), resolve_ids=state('resolve_numeric_ids'), exclude=exclude,
+                                          max_depth=state('max_depth'), transcripts=state('transfer_transcripts'))
+                recorded = journal.start(state('google_sheet_url'), state('google_worksheet_selection'),
+                                         state('worksheet_column_number'), state('stfs_path_selection'),
+                                         settings=settings, resume=state('resume_run'))
+                st.session_state.journal = journal
+                if state('resume_run'):
+                    txt = f"Run journal holds {recorded['matches']} matched rows and {recorded['uploads']} uploads from the last run"
+                    st.info(txt)
+                    state('logger').info(txt)
+
+                try:
+                    with st.status(f"Go! {msg}") as status:
+                        csv_results = fuzzy_search_for_files(status)
+
+                    # Post-processing...
+                    if state('azure_blob_storage') or state('processing_mode'):
+                        post_processing(csv_results)
+
+                finally:
+                    st.session_state.journal = None
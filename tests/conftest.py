@@ -0,0 +1,10 @@
+# conftest.py
+##
+## The app's modules live at the top of the repository, next to streamlit_app.py, rather than in a
+## package, so put it on the path for the tests.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,178 @@
+# test_azure_uploads.py
+##
+## UploadPool and BlobInventory against the in-memory Azure stand-in, StandInBlobService from blob_stand_in.py.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import hashlib
+import pytest
+from azure.core.exceptions import ClientAuthenticationError, HttpResponseError, ServiceRequestError
+from azure_uploads import UploadPool, BlobInventory
+from file_hashes import HashCache
+from blob_stand_in import StandInBlobService
+
+
+# make_files(top, count, size=64) - Write `count` small files under `top`, returning [(blob, path), ...]
+# ---------------------------------------------------------------------------------------
+def make_files(top, count, size=64):
+    files = [ ]
+    for i in range(count):
+        path = os.path.join(top, f"grinnell_{10000 + i}_OBJ.jpg")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        files.append((os.path.basename(path), path))
+    return files
+
+
+# run(service, files, **options) - Upload `files` through one pool, returning [(blob, result, error), ...] in callback order
+# ---------------------------------------------------------------------------------------
+def run(service, files, container='objs', replace=False, **options):
+    results = [ ]
+    with UploadPool(service, **options) as uploads:
+        for (blob, path) in files:
+            uploads.submit(container, blob, path, lambda result, error, blob=blob: results.append((blob, result, error)),
+                           replace=replace)
+    return results
+
+
+def test_new_blobs_are_copied_and_existing_ones_skipped(tmp_path):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 6)
+    run(service, files[:2], workers=1)
+
+    results = run(service, files, workers=4)
+    assert [(blob, result) for (blob, result, error) in results] == \
+        [(blob, 'EXISTS') for (blob, path) in files[:2]] + [(blob, 'COPIED') for (blob, path) in files[2:]]
+    assert all(error is None for (blob, result, error) in results)
+    for (blob, path) in files:
+        with open(path, 'rb') as f:
+            assert service.contents[('objs', blob)] == f.read( )
+
+
+def test_results_do_not_depend_on_the_number_of_workers(tmp_path):
+    files = make_files(tmp_path, 20)
+    outcomes = [ ]
+    for workers in (1, 8):
+        service = StandInBlobService(latency=0.002)
+        run(service, files[:5], workers=1)
+        outcomes.append(run(service, files, workers=workers))
+    assert outcomes[0] == outcomes[1]
+
+
+def test_callbacks_run_in_submission_order(tmp_path):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 12)
+
+    # The first uploads are the slowest, so they finish last
+    for (n, (blob, path)) in enumerate(files):
+        service.latencies[blob] = 0.002 * (len(files) - n)
+
+    results = run(service, files, workers=6)
+    assert [blob for (blob, result, error) in results] == [blob for (blob, path) in files]
+
+
+def test_the_same_blob_twice_is_uploaded_once(tmp_path):
+    service = StandInBlobService(latency=0.005)
+    (blob, path) = make_files(tmp_path, 1)[0]
+    results = run(service, [(blob, path)] * 3, workers=4)
+    assert [result for (name, result, error) in results] == ['COPIED', 'EXISTS', 'EXISTS']
+    assert service.count('upload') == 1
+
+
+def test_replace_overwrites_without_checking(tmp_path):
+    service = StandInBlobService( )
+    (blob, path) = make_files(tmp_path, 1)[0]
+    run(service, [(blob, path)], workers=1)
+    with open(path, 'wb') as f:
+        f.write(b'new contents')
+
+    checks = service.count('properties')
+    results = run(service, [(blob, path)], workers=1, replace=True)
+    assert [result for (name, result, error) in results] == ['COPIED']
+    assert service.count('properties') == checks
+    assert service.contents[('objs', blob)] == b'new contents'
+
+
+def test_bytes_are_uploaded_with_their_md5(tmp_path):
+    service = StandInBlobService( )
+    data = b'\xff\xd8 a derivative made in memory'
+    with HashCache(str(tmp_path / 'hashes.sqlite')) as hashes:
+        results = run(service, [('grinnell_1_TN.jpg', data)], container='thumbs', workers=1, hashes=hashes)
+    assert [result for (blob, result, error) in results] == ['COPIED']
+    assert service.contents[('thumbs', 'grinnell_1_TN.jpg')] == data
+    assert bytes(service.blobs[('thumbs', 'grinnell_1_TN.jpg')].content_settings.content_md5) == hashlib.md5(data).digest( )
+
+
+def test_changed_files_replace_their_blobs_when_hashes_are_compared(tmp_path):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 3)
+    with HashCache(str(tmp_path / 'hashes.sqlite')) as hashes:
+        run(service, files, workers=2, hashes=hashes)
+        with open(files[1][1], 'wb') as f:
+            f.write(b'changed')
+        inventory = BlobInventory(service)
+        results = run(service, files, workers=2, hashes=hashes, inventory=inventory)
+    assert [result for (blob, result, error) in results] == ['EXISTS', 'COPIED', 'EXISTS']
+    assert service.contents[('objs', files[1][0])] == b'changed'
+
+
+def test_errors_reach_the_callback_and_the_rest_carry_on(tmp_path):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 4)
+    service.failures[files[1][0]] = HttpResponseError("Server busy")
+
+    results = run(service, files, workers=2)
+    assert [(blob, result) for (blob, result, error) in results] == \
+        [(files[0][0], 'COPIED'), (files[1][0], None), (files[2][0], 'COPIED'), (files[3][0], 'COPIED')]
+    assert isinstance(results[1][2], HttpResponseError)
+    assert ('objs', files[1][0]) not in service.blobs
+
+
+def test_a_missing_file_is_reported_as_an_error(tmp_path):
+    service = StandInBlobService( )
+    results = run(service, [('gone.jpg', str(tmp_path / 'gone.jpg'))], workers=1)
+    assert results[0][1] is None and isinstance(results[0][2], OSError)
+
+
+def test_inventory_saves_the_exists_checks(tmp_path):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 5)
+    run(service, files[:2], workers=1)
+
+    inventory = BlobInventory(service)
+    checks = service.count('properties')
+    results = run(service, files, workers=3, inventory=inventory)
+    assert [result for (blob, result, error) in results] == ['EXISTS'] * 2 + ['COPIED'] * 3
+    assert service.count('properties') == checks
+    assert all(inventory.exists('objs', blob) for (blob, path) in files)
+
+
+@pytest.mark.parametrize('failure', [
+    ClientAuthenticationError("This request is not authorized to perform this operation."),
+    ServiceRequestError("Failed to resolve 'account.blob.core.windows.net'"),
+])
+def test_inventory_falls_back_when_a_container_cant_be_listed(tmp_path, failure):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 2)
+    run(service, files[:1], workers=1)
+    service.failures['objs'] = failure
+
+    inventory = BlobInventory(service, containers=('objs',))
+    assert inventory.exists('objs', files[0][0]) is None
+    del service.failures['objs']
+
+    checks = service.count('properties')
+    results = run(service, files, workers=2, inventory=inventory)
+    assert [result for (blob, result, error) in results] == ['EXISTS', 'COPIED']
+    assert service.count('properties') == checks + 2
+
+
+@pytest.mark.parametrize('prefix', ['grinnell_1000', None])
+def test_inventory_covers_only_its_prefix(tmp_path, prefix):
+    service = StandInBlobService( )
+    files = make_files(tmp_path, 12)
+    run(service, files, workers=4)
+
+    inventory = BlobInventory(service, containers=('objs',), prefix=prefix)
+    assert len(inventory) == (10 if prefix else 12)
+    assert inventory.exists('objs', files[11][0]) is (None if prefix else True)
@@ -0,0 +1,102 @@
+# test_file_matcher.py
+##
+## FileMatcher and match_target( ) against fuzzywuzzy's brute-force `process.extract` on random corpora,
+## and --regex (significant) filtering in match_target( ) and SignificantFilter.
+## -----------------------------------------------------------------------------------------------------
+
+import re
+import random
+import pytest
+from fuzzywuzzy import fuzz, process
+from file_matcher import FileMatcher, SignificantFilter, match_target, compile_significant, numeric_id
+
+NAMES = ['a(1.tif', 'a(2.tif', 'ab1.tif', 'grinnell_1.tif']
+
+
+def test_significant_text_is_matched_literally( ):
+    (matcher, significant_filter) = (FileMatcher(NAMES), SignificantFilter(NAMES))
+    (kind, significant_text, matches) = match_target(matcher, significant_filter, 'a(1.tif', regex=r'a\(\d')
+    assert (kind, significant_text) == ('exact', 'a(1')
+    assert [name for (name, score, index) in matches] == ['a(1.tif']
+
+
+def test_subset_escapes_the_text( ):
+    significant_filter = SignificantFilter(NAMES)
+    assert list(significant_filter.subset('a(')) == [0, 1]
+    assert list(significant_filter.subset('a.1')) == [ ]    # '.' is not a wildcard
+
+
+def test_invalid_regex_is_caught_up_front( ):
+    with pytest.raises(re.error):
+        compile_significant('a(')
+
+
+# corpus(seed, size) - Random filenames like those on our shares, with IDs shared by a few files each
+# ---------------------------------------------------------------------------------------
+def corpus(seed, size):
+    rng = random.Random(seed)
+    ids = [str(rng.randint(1000, 99999)) for i in range(size // 4)]
+    words = ['grinnell', 'Grinnell', 'dg', 'scan', 'letter', 'Photo', 'obj', 'TN', 'small']
+    names = [ ]
+    for i in range(size):
+        stem = f"{rng.choice(words)}{rng.choice('_-')}{rng.choice(ids)}{rng.choice(['_OBJ', '_TN', '-p2', '', ' copy'])}"
+        names.append(f"{stem}.{rng.choice(['tif', 'tiff', 'jpg', 'pdf'])}")
+    return names
+
+
+# mangle(rng, name) - `name` with a character dropped, doubled or swapped for another
+# ---------------------------------------------------------------------------------------
+def mangle(rng, name):
+    pos = rng.randrange(len(name))
+    return rng.choice([name[:pos] + name[pos + 1:], name[:pos] + name[pos] + name[pos:],
+                       name[:pos] + rng.choice('aeio_0123') + name[pos + 1:]])
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_extract_ranks_like_process_extract(seed):
+    names = corpus(seed, 240)
+    matcher = FileMatcher(names)
+    choices = dict(enumerate(names))
+    rng = random.Random(seed)
+
+    targets = [mangle(rng, rng.choice(names)) for i in range(20)]
+    targets += [rng.choice(names), rng.choice(names).upper( ), 'nothing like it', '']
+    for target in targets:
+        expected = process.extract(target, choices, scorer=fuzz.WRatio, limit=3)
+        assert matcher.extract(target, limit=3) == expected
+
+        # Whichever path match_target( ) takes, it gives the same top matches
+        (kind, significant_text, matches) = match_target(matcher, None, target)
+        if kind == 'fuzzy':
+            assert matches == expected
+        else:
+            assert matches == [match for match in expected if match[1] == 100]
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_exact_hits_are_the_top_of_process_extract(seed):
+    names = corpus(seed, 240)
+    names += [names[7].upper( ), names[7]]    # one name that is in the tree three ways
+    matcher = FileMatcher(names)
+    choices = dict(enumerate(names))
+    rng = random.Random(seed)
+
+    for target in [names[7], names[7].lower( )] + rng.sample(names, 10):
+        (kind, significant_text, matches) = match_target(matcher, None, target)
+        expected = process.extract(target, choices, scorer=fuzz.WRatio, limit=3)
+        assert kind == ('exact' if target in names else 'case-insensitive')
+        assert matches == [match for match in expected if match[1] == 100]
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_numeric_ids_rank_like_process_extract_over_their_files(seed):
+    names = corpus(seed, 240)
+    matcher = FileMatcher(names)
+    rng = random.Random(seed)
+
+    for name in rng.sample(names, 15):
+        target = f"grinnell_{numeric_id(name)}_OBJ"
+        (kind, significant_text, matches) = match_target(matcher, None, target, resolve_ids=True)
+        carrying = {idx: other for (idx, other) in enumerate(names) if numeric_id(other) == numeric_id(name)}
+        assert kind == 'numeric ID'
+        assert matches == process.extract(target, carrying, scorer=fuzz.WRatio, limit=3)
@@ -0,0 +1,135 @@
+# test_sheet_updates.py
+##
+## DirtyCells against a local fake of a gspread Worksheet that records what would be sent to Google.
+## -----------------------------------------------------------------------------------------------------
+
+import pandas as pd
+import sheet_updates
+from sheet_updates import DirtyCells, split_range
+
+
+class FakeWorksheet:
+
+    # FakeWorksheet(col_count) - Records add_cols( ) and batch_update( ) calls instead of making them
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, col_count):
+        self.col_count = col_count
+        self.added = [ ]
+        self.requests = [ ]
+
+    def add_cols(self, cols):
+        self.added.append(cols)
+        self.col_count += cols
+
+    def batch_update(self, data, value_input_option=None):
+        assert value_input_option == sheet_updates.VALUE_INPUT
+        self.requests.append(data)
+
+
+# worksheet_df(rows) - A dataframe like snapshot.dataframe( ) makes, with `rows` filenames and empty URL columns
+# ---------------------------------------------------------------------------------------
+def worksheet_df(rows):
+    return pd.DataFrame({'filename': [f"file_{n}.tif" for n in range(rows)],
+                         'object_location': [''] * rows,
+                         'display_template': ['image'] * rows})
+
+
+def test_consecutive_rows_are_one_range( ):
+    df = worksheet_df(10)
+    dirty = DirtyCells(df)
+    for row in (2, 3, 4, 7):
+        dirty.set(row, 'object_location', f"https://example/objs/{row}.tif")
+
+    worksheet = FakeWorksheet(col_count=3)
+    assert dirty.flush(worksheet) == 4
+    assert worksheet.added == [ ]
+    assert worksheet.requests == [[
+        {'range': 'B4:B6', 'values': [["https://example/objs/2.tif"], ["https://example/objs/3.tif"], ["https://example/objs/4.tif"]]},
+        {'range': 'B9:B9', 'values': [["https://example/objs/7.tif"]]},
+    ]]
+    assert dirty.flush(worksheet) == 0    # nothing left to send
+    assert len(worksheet.requests) == 1
+
+
+def test_unchanged_values_are_skipped( ):
+    df = worksheet_df(5)
+    dirty = DirtyCells(df)
+    dirty.set(1, 'display_template', 'image')    # already 'image'
+    dirty.set(1, 'object_location', '')          # already blank
+    assert dirty.ranges( ) == [ ]
+
+    dirty.set(3, 'display_template', 'transcript')
+    assert dirty.ranges( ) == [{'range': 'C5:C5', 'values': [['transcript']]}]
+    assert df.at[3, 'display_template'] == 'transcript'
+
+
+def test_new_column_gets_its_header( ):
+    df = worksheet_df(4)
+    dirty = DirtyCells(df)
+    dirty.set(0, 'image_small', "https://example/smalls/0_SMALL.jpg")
+    dirty.set(1, 'image_small', "https://example/smalls/1_SMALL.jpg")
+
+    worksheet = FakeWorksheet(col_count=3)
+    assert dirty.flush(worksheet) == 3    # the header cell and two values
+    assert worksheet.added == [1]
+    assert worksheet.requests == [[
+        {'range': 'D1', 'values': [['image_small']]},
+        {'range': 'D2:D3', 'values': [["https://example/smalls/0_SMALL.jpg"], ["https://example/smalls/1_SMALL.jpg"]]},
+    ]]
+
+    # Once written, the column is one of the worksheet's own
+    dirty.set(2, 'image_small', "https://example/smalls/2_SMALL.jpg")
+    assert dirty.ranges( ) == [{'range': 'D4:D4', 'values': [["https://example/smalls/2_SMALL.jpg"]]}]
+
+
+def test_blank_cells_are_sent_as_empty_strings( ):
+    df = worksheet_df(3)
+    df['image_thumb'] = pd.Series([float('nan')] * 3, dtype=object)
+    dirty = DirtyCells(df)
+    dirty.set(0, 'image_thumb', "https://example/thumbs/0_TN.jpg")
+    dirty.set(1, 'image_thumb', "https://example/thumbs/1_TN.jpg")
+    df.at[1, 'image_thumb'] = float('nan')
+    assert dirty.ranges( ) == [{'range': 'D2:D3', 'values': [["https://example/thumbs/0_TN.jpg"], ['']]}]
+
+
+def test_split_range( ):
+    update = {'range': 'AB10:AB14', 'values': [['a'], ['b'], ['c'], ['d'], ['e']]}
+    assert split_range(update, 2) == [
+        {'range': 'AB10:AB11', 'values': [['a'], ['b']]},
+        {'range': 'AB12:AB13', 'values': [['c'], ['d']]},
+        {'range': 'AB14:AB14', 'values': [['e']]},
+    ]
+
+
+def test_batches_respect_max_cells( ):
+    df = worksheet_df(25)
+    dirty = DirtyCells(df)
+    for row in range(25):
+        dirty.set(row, 'object_location', f"u{row}")
+
+    batches = list(dirty.batches(max_cells=10, max_chars=sheet_updates.MAX_CHARS))
+    assert [sum(len(update['values']) for update in batch) for batch in batches] == [10, 10, 5]
+    assert [update['range'] for batch in batches for update in batch] == ['B2:B11', 'B12:B21', 'B22:B26']
+
+
+def test_batches_respect_max_chars( ):
+    df = worksheet_df(6)
+    dirty = DirtyCells(df)
+    for row in (0, 2, 4):                         # three separate one-cell runs of 10 characters
+        dirty.set(row, 'object_location', 'x' * 10)
+
+    batches = list(dirty.batches(max_cells=sheet_updates.MAX_CELLS, max_chars=25))
+    assert [[update['range'] for update in batch] for batch in batches] == [['B2:B2', 'B4:B4'], ['B6:B6']]
+
+
+def test_flush_splits_at_max_cells( ):
+    rows = sheet_updates.MAX_CELLS + 5
+    df = worksheet_df(rows)
+    dirty = DirtyCells(df)
+    for row in range(rows):
+        dirty.set(row, 'object_location', f"u{row}")
+
+    worksheet = FakeWorksheet(col_count=3)
+    assert dirty.flush(worksheet) == rows
+    assert [[update['range'] for update in request] for request in worksheet.requests] == [
+        [f"B2:B{sheet_updates.MAX_CELLS + 1}"], [f"B{sheet_updates.MAX_CELLS + 2}:B{rows + 1}"]]
@@ -0,0 +1,279 @@
+# tree_index.py
+##
+## A persistent, on-disk index of a directory tree so `fuzzy_search_for_files` doesn't have to re-walk
+## a network share (e.g. /Volumes/CollectionBuilder2024) every time the search is run.
+##
+## Each root directory from `paths.json` gets its own SQLite file in `tree-index/` holding every
+## non-hidden directory (path + mtime) and file (name, size, mtime).  A refresh stats each known
+## directory and only re-lists the ones whose mtime changed, since adding, removing or renaming an
+## entry is what bumps a directory's mtime.  Unchanged directories cost one stat instead of a listing.
+##
+## A directory that can't be listed (or stat'ed) right now, e.g. after a transient SMB/AFP error, is
+## NOT taken to be empty: what the index knows about its files and subdirectories is kept, its mtime is
+## cleared so it's re-listed next time, and its known subdirectories are still visited.
+##
+## Directories are visited by `crawl( )`, which lists many of them at once on a bounded thread pool.
+## On a high-latency mount most of a walk is spent waiting on round trips, so overlapping them is
+## where the time goes.  `walk_files( )` uses the same crawler to stream (directory, filename) records
+## without an index.
+## -----------------------------------------------------------------------------------------------------
+
+import os
+import re
+import json
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
+from loguru import logger
+
+INDEX_DIR = 'tree-index'
+COMMIT_EVERY = 500    # directories re-listed between commits, so an interrupted refresh keeps its progress
+MTIME_SLACK = 2       # seconds; directories modified more recently than this are re-listed next time
+WORKERS = 8           # default number of directories listed concurrently
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    dir_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# One crawled directory.  `files` is a list of (name, size, mtime) or None if the directory was not
+# re-listed, and `subdirs` are the subdirectories to visit next.  `mtime` is None if it can't be read.
+# `error` is the OSError that kept the directory from being listed, if one did.
+Listing = namedtuple('Listing', ['path', 'parent', 'depth', 'mtime', 'files', 'subdirs', 'error'], defaults=(None,))
+
+
+# tree_index_path(root_name) - The index file for a `paths.json` root, e.g. 'DGIngest'
+# ---------------------------------------------------------------------------------------
+def tree_index_path(root_name):
+    slug = re.sub(r'[^A-Za-z0-9._-]+', '-', root_name).strip('-')
+    return os.path.join(INDEX_DIR, f"{slug}.sqlite")
+
+
+# excluded(name, exclude) - True for dot files/dirs and names matching any of the `exclude` globs
+# Exclusion of dot files per https://stackoverflow.com/questions/13454164/os-walk-without-hidden-folders
+# ---------------------------------------------------------------------------------------
+def excluded(name, exclude):
+    return name[0] == '.' or any(fnmatch(name, pattern) for pattern in exclude)
+
+
+# list_dir(path, exclude=( ), stat_files=True)
+# List one directory, returning ([(name, size, mtime), ...], [subdirectory paths]).  Sizes and mtimes
+# are only read when `stat_files` is set since each one can cost a round trip of its own.
+# ---------------------------------------------------------------------------------------
+def list_dir(path, exclude=( ), stat_files=True):
+    files = [ ]
+    subdirs = [ ]
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if excluded(entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir( ):
+                    if not entry.is_symlink( ):    # like os.walk, don't follow links
+                        subdirs.append(entry.path)
+                elif stat_files:
+                    info = entry.stat( )
+                    files.append((entry.name, info.st_size, info.st_mtime))
+                else:
+                    files.append((entry.name, None, None))
+            except OSError:
+                continue
+    return (files, subdirs)
+
+
+# crawl(top, visit, workers=WORKERS)
+# Visit `top` and everything below it, running up to `workers` calls of visit(path, parent, depth) at
+# once.  Each call returns a Listing whose `subdirs` are queued for visiting in turn.  Listings are
+# yielded as they complete, so the order is NOT deterministic.
+# ---------------------------------------------------------------------------------------
+def crawl(top, visit, workers=WORKERS):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(visit, top, os.path.dirname(top), 0)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result( )
+                for subdir in listing.subdirs:
+                    pending.add(pool.submit(visit, subdir, listing.path, listing.depth + 1))
+                yield listing
+
+
+# walk_files(top, workers=WORKERS, max_depth=None, exclude=( ))
+# Yield (directory, filename) for every non-hidden, non-excluded file below `top`, like os.walk( )
+# does but listing directories in parallel.  Files deeper than `max_depth` levels are skipped.
+# ---------------------------------------------------------------------------------------
+def walk_files(top, workers=WORKERS, max_depth=None, exclude=( )):
+
+    def visit(path, parent, depth):
+        try:
+            (files, subdirs) = list_dir(path, exclude, stat_files=False)
+        except OSError as e:
+            logger.warning(f"Could not list '{path}': {e}")
+            return Listing(path, parent, depth, None, None, [ ], e)
+        if max_depth is not None and depth >= max_depth:
+            subdirs = [ ]
+        return Listing(path, parent, depth, None, files, subdirs)
+
+    for listing in crawl(os.path.normpath(top), visit, workers):
+        for (name, size, mtime) in listing.files or [ ]:
+            yield (listing.path, name)
+
+
+class TreeIndex:
+
+    # TreeIndex(db_path) - Open (or create) the index stored in `db_path`
+    # ---------------------------------------------------------------------------------------
+    def __init__(self, db_path):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close( )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close( )
+
+    # refresh(top, workers=WORKERS, max_depth=None, exclude=( ))
+    # Bring the index up to date for the `top` directory tree.  Returns a dict counting the
+    # directories that were re-listed, those that were unchanged and those that couldn't be listed.
+    # ---------------------------------------------------------------------------------------
+    def refresh(self, top, workers=WORKERS, max_depth=None, exclude=( )):
+        top = os.path.normpath(top)
+        counts = {'rescanned': 0, 'unchanged': 0, 'unlisted': 0}
+
+        # Don't throw away what we know about a share just because it isn't mounted right now
+        if not os.path.isdir(top):
+            logger.warning(f"'{top}' could not be reached, the tree index was NOT refreshed.")
+            return counts
+
+        # Listings made with other exclusions or depth limits can't be trusted, re-list everything
+        options = json.dumps({'exclude': sorted(exclude), 'max_depth': max_depth,
+                              'top': top if max_depth is not None else None})
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'options'").fetchone( )
+        if not row or row[0] != options:
+            self.db.execute("UPDATE dirs SET mtime = NULL")
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('options', ?)", (options,))
+
+        # Take a snapshot of what's known so the crawler's threads never touch the database
+        below = top.rstrip(os.sep) + os.sep
+        known = { }
+        children = { }
+        for (path, parent, mtime) in self.db.execute(
+                "SELECT path, parent, mtime FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                (top, len(below), below)):
+            known[path] = mtime
+            children.setdefault(parent, []).append(path)
+
+        def visit(path, parent, depth):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError as e:
+                logger.warning(f"Could not stat '{path}': {e}")
+                return Listing(path, parent, depth, None, None, children.get(path, [ ]), e)
+
+            if path in known and known[path] == mtime:
+                subdirs = children.get(path, [ ])
+                return Listing(path, parent, depth, mtime, None, subdirs)
+
+            try:
+                (files, subdirs) = list_dir(path, exclude)
+            except OSError as e:
+                logger.warning(f"Could not list '{path}': {e}")
+                return Listing(path, parent, depth, None, None, children.get(path, [ ]), e)
+            if max_depth is not None and depth >= max_depth:
+                subdirs = [ ]
+            return Listing(path, parent, depth, mtime, files, subdirs)
+
+        changed = False
+        for listing in crawl(top, visit, workers):
+            if listing.error:
+                self.db.execute("UPDATE dirs SET mtime = NULL WHERE path = ?", (listing.path,))    # try again next time
+                counts['unlisted'] += 1
+            elif listing.files is None:
+                counts['unchanged'] += 1
+            else:
+                self.store_listing(listing)
+                changed = True
+                counts['rescanned'] += 1
+                if counts['rescanned'] % COMMIT_EVERY == 0:
+                    self.db.commit( )
+
+        if changed:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (self.generation( ) + 1,))
+        self.db.commit( )
+        return counts
+
+    # generation( ) - A number that goes up whenever a refresh changes the index
+    # ---------------------------------------------------------------------------------------
+    def generation(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone( )
+        return int(row[0]) if row else 0
+
+    # store_listing(listing) - Replace what the index knows about one directory
+    # ---------------------------------------------------------------------------------------
+    def store_listing(self, listing):
+        mtime = listing.mtime
+
+        # Changes made within the filesystem's mtime resolution of our listing could go unnoticed
+        if mtime and time.time( ) - mtime < MTIME_SLACK:
+            mtime = None
+
+        row = self.db.execute("SELECT id FROM dirs WHERE path = ?", (listing.path,)).fetchone( )
+        if row:
+            dir_id = row[0]
+            self.db.execute("UPDATE dirs SET mtime = ? WHERE id = ?", (mtime, dir_id))
+            self.db.execute("DELETE FROM files WHERE dir_id = ?", (dir_id,))
+        else:
+            dir_id = self.db.execute("INSERT INTO dirs (path, parent, mtime) VALUES (?, ?, ?)",
+                                     (listing.path, listing.parent, mtime)).lastrowid
+
+        self.db.executemany("INSERT INTO files (dir_id, name, size, mtime) VALUES (?, ?, ?, ?)",
+                            [(dir_id, name, size, file_mtime) for (name, size, file_mtime) in listing.files])
+
+        # Forget subdirectories that have disappeared (or been excluded) since the last listing
+        known = self.db.execute("SELECT path FROM dirs WHERE parent = ?", (listing.path,)).fetchall( )
+        for (child,) in known:
+            if child not in listing.subdirs:
+                self.remove_dir(child)
+
+    # remove_dir(path) - Drop a directory and everything below it from the index
+    # ---------------------------------------------------------------------------------------
+    def remove_dir(self, path):
+        below = path.rstrip(os.sep) + os.sep
+        ids = [id for (id,) in self.db.execute(
+            "SELECT id FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (path, len(below), below))]
+        self.db.executemany("DELETE FROM files WHERE dir_id = ?", [(id,) for id in ids])
+        self.db.executemany("DELETE FROM dirs WHERE id = ?", [(id,) for id in ids])
+
+    # files(top) - Yield (directory, filename, size, mtime) for every indexed file in the `top` tree
+    # ---------------------------------------------------------------------------------------
+    def files(self, top):
+        top = os.path.normpath(top)
+        below = top.rstrip(os.sep) + os.sep
+        yield from self.db.execute(
+            "SELECT d.path, f.name, f.size, f.mtime FROM files f JOIN dirs d ON f.dir_id = d.id "
+            "WHERE d.path = ? OR substr(d.path, 1, ?) = ? ORDER BY d.path, f.name",
+            (top, len(below), below))